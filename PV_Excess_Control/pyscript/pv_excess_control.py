@@ -3,7 +3,11 @@
 # Automations can be deactivated correctly from the UI!
 # -------------------------------------------------
 from typing import Union
+from array import array
+from collections import namedtuple
+import bisect
 import datetime
+import time
 
 
 def _get_state(entity_id: str) -> Union[str, None]:
@@ -12,15 +16,14 @@ def _get_state(entity_id: str) -> Union[str, None]:
     :param entity_id:  Name of the entity
     :return:            State if entity name is valid, else None
     """
-    # get entity domain
-    domain = entity_id.split('.')[0]
+    _call_counter['state_reads'] += 1
     try:
         entity_state = state.get(entity_id)
     except Exception as e:
         log.error(f'Could not get state from entity {entity_id}: {e}')
         return None
 
-    if domain == 'climate':
+    if entity_id.startswith('climate.'):
         if entity_state.lower() in ['heat', 'cool', 'boost', 'on']:
             return 'on'
         elif entity_state == 'off':
@@ -33,18 +36,62 @@ def _get_state(entity_id: str) -> Union[str, None]:
         return entity_state
 
 
-def _turn_off(entity_id: str) -> bool:
+def _state_age(entity_state) -> Union[float, None]:
+    """
+    Get the time since an entity has last been reported (or updated) by its integration
+    :param entity_state:    State as returned by _get_state
+    :return:                Age in seconds, None if not available
+    """
+    # last_reported is also updated if the value did not change (Home Assistant 2024.3+)
+    updated = getattr(entity_state, 'last_reported', None) or getattr(entity_state, 'last_updated', None)
+    if updated is None:
+        return None
+    return (datetime.datetime.now(datetime.timezone.utc) - updated).total_seconds()
+
+
+# Cache of service availability: (domain, service name) -> bool
+_service_cache = {}
+# Number of state reads and service calls (see Diagnostics)
+_call_counter = {'state_reads': 0, 'service_calls': 0}
+
+
+def _has_service(domain: str, name: str) -> bool:
+    """
+    Checks if a service exists. The result is cached until services are registered or removed.
+    :param domain:  Service domain
+    :param name:    Service name
+    :return:        True if the service exists, else False
+    """
+    key = (domain, name)
+    if key not in _service_cache:
+        _service_cache[key] = service.has_service(domain, name)
+    return _service_cache[key]
+
+
+@event_trigger('service_registered')
+def _service_registered(**kwargs):
+    _service_cache.clear()
+
+
+@event_trigger('service_removed')
+def _service_removed(**kwargs):
+    _service_cache.clear()
+
+
+def _turn_off(entity_id: str, domain: Union[str, None] = None) -> bool:
     """
     Switches an entity off
     :param entity_id: ID of the entity
+    :param domain: Domain of the entity (derived from the entity ID if not given)
     """
-    # get entity domain
-    domain = entity_id.split('.')[0]
+    if domain is None:
+        domain = entity_id.split('.')[0]
     # check if service exists:
-    if not service.has_service(domain, 'turn_off'):
+    if not _has_service(domain, 'turn_off'):
         log.error(f'Cannot switch off appliance: Service "{domain}.turn_off" does not exist.')
         return False
 
+    _call_counter['service_calls'] += 1
     try:
         service.call(domain, 'turn_off', entity_id=entity_id)
     except Exception as e:
@@ -54,18 +101,20 @@ def _turn_off(entity_id: str) -> bool:
         return True
 
 
-def _turn_on(entity_id: str) -> bool:
+def _turn_on(entity_id: str, domain: Union[str, None] = None) -> bool:
     """
     Switches an entity on
     :param entity_id: ID of the entity
+    :param domain: Domain of the entity (derived from the entity ID if not given)
     """
-    # get entity domain
-    domain = entity_id.split('.')[0]
+    if domain is None:
+        domain = entity_id.split('.')[0]
     # check if service exists:
-    if not service.has_service(domain, 'turn_on'):
+    if not _has_service(domain, 'turn_on'):
         log.error(f'Cannot switch on appliance: Service "{domain}.turn_on" does not exist.')
         return False
 
+    _call_counter['service_calls'] += 1
     try:
         service.call(domain, 'turn_on', entity_id=entity_id)
     except Exception as e:
@@ -75,20 +124,22 @@ def _turn_on(entity_id: str) -> bool:
         return True
 
 
-def _set_value(entity_id: str, value: Union[int, float, str]) -> bool:
+def _set_value(entity_id: str, value: Union[int, float, str], domain: Union[str, None] = None) -> bool:
     """
     Sets a number entity to a specific value
     :param entity_id: ID of the entity
     :param value: Numerical value
+    :param domain: Domain of the entity (derived from the entity ID if not given)
     :return:
     """
-    # get entity domain
-    domain = entity_id.split('.')[0]
+    if domain is None:
+        domain = entity_id.split('.')[0]
     # check if service exists:
-    if not service.has_service(domain, 'set_value'):
+    if not _has_service(domain, 'set_value'):
         log.error(f'Cannot set value "{value}": Service "{domain}.set_value" does not exist.')
         return False
 
+    _call_counter['service_calls'] += 1
     try:
         service.call(domain, 'set_value', entity_id=entity_id, value=value)
     except Exception as e:
@@ -98,6 +149,29 @@ def _set_value(entity_id: str, value: Union[int, float, str]) -> bool:
         return True
 
 
+def _get_attributes(entity_id: str) -> dict:
+    """
+    Get the attributes of an entity in Home Assistant
+    :param entity_id:  Name of the entity
+    :return:            Attributes if entity name is valid, else empty dict
+    """
+    _call_counter['state_reads'] += 1
+    try:
+        return state.getattr(entity_id) or {}
+    except Exception as e:
+        log.error(f'Could not get attributes from entity {entity_id}: {e}')
+        return {}
+
+
+@pyscript_compile
+def _debug_enabled() -> bool:
+    """
+    :return:    True if debug logging is enabled for this module. Used to skip expensive debug messages.
+    """
+    import logging
+    return logging.getLogger('custom_components.pyscript.file.pv_excess_control').isEnabledFor(logging.DEBUG)
+
+
 def _get_num_state(entity_id: str, return_on_error: Union[float, None] = None) -> Union[float, None]:
     return _validate_number(_get_state(entity_id), return_on_error)
 
@@ -109,7 +183,7 @@ def _validate_number(num: Union[float, str], return_on_error: Union[float, None]
     :param return_on_error: Value to return in case of error
     :return:                Number if valid, else None
     """
-    if num is None or num == 'unavailable':
+    if num is None or num in ('unavailable', 'unknown'):
         return return_on_error
 
     min_v = -1000000
@@ -120,7 +194,9 @@ def _validate_number(num: Union[float, str], return_on_error: Union[float, None]
         else:
             raise Exception(f'{float(num)} not in range: [{min_v}, {max_v}]')
     except Exception as e:
-        log.error(f'{num=} is not a valid number between 0 and 1000000: {e}')
+        # not logged as error: spikes and garbage values of the power sensors occur on every sample and are tracked by the
+        #  quality score of the sensor health
+        log.debug(f'{num=} is not a valid number between -1000000 and 1000000: {e}')
         return return_on_error
 
 
@@ -135,465 +211,3375 @@ def _replace_vowels(input: str) -> str:
     return ''.join(res)
 
 
-@time_trigger("cron(0 0 * * *)")
-def reset_midnight():
-    log.info("Resetting 'switched_on_today' instance variables.")
-    for e in PvExcessControl.instances.copy().values():
-        inst = e['instance']
-        inst.switched_on_today = False
-        inst.daily_run_time = 0
+def _run_commands(commands: list, settle_delay: float):
+    """
+    Executes the service calls of one appliance in order
+    :param commands:        List of (function, arguments, on_success callback or None)
+    :param settle_delay:    Delay in seconds between two consecutive commands
+    """
+    for i, (func, args, on_success) in enumerate(commands):
+        if i > 0 and settle_delay > 0:
+            task.sleep(settle_delay)
+        if func(*args) and on_success is not None:
+            on_success()
 
 
-@service
-def pv_excess_control(automation_id, appliance_priority, export_power, pv_power, load_power, home_battery_level,
-                      min_home_battery_level, dynamic_current_appliance, appliance_phases, min_current,
-                      max_current, appliance_switch, appliance_switch_interval, appliance_current_set_entity,
-                      actual_power, defined_current, appliance_on_only, grid_voltage, import_export_power,
-                      home_battery_capacity, solar_production_forecast, appliance_once_only):
+class ActuationQueue:
+    """
+    Collects the service calls decided within one control pass and dispatches them at the end of the pass.
+    Commands of different appliances are executed concurrently, commands of the same appliance keep their order and are
+    separated by the settle delay.
+    """
+    __slots__ = ('commands', 'settle_delay')
 
-    automation_id = automation_id[11:] if automation_id[:11] == 'automation.' else automation_id
-    automation_id = _replace_vowels(f"automation.{automation_id.strip().replace(' ', '_').lower()}")
+    def __init__(self, settle_delay: float = 1):
+        self.commands = {}
+        self.settle_delay = settle_delay
 
+    def add(self, key: str, func, args: tuple, on_success=None):
+        """
+        Queue a service call
+        :param key:         Key of the appliance (commands with the same key are executed in order)
+        :param func:        Function executing the service call, returning True on success
+        :param args:        Arguments of the function
+        :param on_success:  Callback, which is executed if the service call was successful
+        """
+        if key not in self.commands:
+            self.commands[key] = []
+        self.commands[key].append((func, args, on_success))
 
-    PvExcessControl(automation_id, appliance_priority, export_power, pv_power,
-                    load_power, home_battery_level, min_home_battery_level,
-                    dynamic_current_appliance, appliance_phases, min_current,
-                    max_current, appliance_switch, appliance_switch_interval,
-                    appliance_current_set_entity, actual_power, defined_current, appliance_on_only,
-                    grid_voltage, import_export_power, home_battery_capacity, solar_production_forecast,
-                    appliance_once_only)
+    def dispatch(self):
+        """
+        Execute all queued commands and wait until they are done
+        """
+        tasks = set()
+        for commands in self.commands.values():
+            tasks.add(task.create(_run_commands, commands, self.settle_delay))
+        self.commands = {}
+        if tasks:
+            task.wait(tasks)
 
 
+class StateSnapshot:
+    """
+    Tick-scoped cache of entity states.
+    All entities needed by one control pass are read once at the start of the tick, so every decision within the pass is
+    based on the same values. States changed by the controller itself are written back via set().
+    """
+    __slots__ = ('states', 'numbers')
 
-class PvExcessControl:
-    # TODO:
-    #  - What about other domains than switches? Enable use of other domains (e.g. light, ...)
-    #  - Make min_excess_power configurable via blueprint
-    #  - Implement updating of pv sensors history more often. E.g. every 10secs, and averaging + adding to history every minute.
-    instances = {}
-    export_power = None
-    pv_power = None
-    load_power = None
-    home_battery_level = None
-    grid_voltage = None
-    import_export_power = None
-    home_battery_capacity = None
-    solar_production_forecast = None
-    min_home_battery_level = None
-    # Exported Power history
-    export_history = [0]*60
-    export_history_buffer = []
-    # PV Excess history (PV power minus load power)
-    pv_history = [0]*60
-    pv_history_buffer = []
-    # Minimum excess power in watts. If the average min_excess_power at the specified appliance switch interval is greater than the actual
-    #  excess power, the appliance with the lowest priority will be shut off.
-    #  NOTE: Should be slightly negative, to compensate for inaccurate power corrections
-    #  WARNING: Do net set this to more than 0, otherwise some devices with dynamic current control will abruptly get switched off in some
-    #  situations.
-    min_excess_power = -10
-    on_time_counter = 0
+    def __init__(self):
+        self.states = {}
+        self.numbers = {}
+
+    def collect(self, entity_ids):
+        """
+        Read all given entities which are not yet part of the snapshot
+        :param entity_ids:  Iterable of entity IDs (None values are ignored)
+        """
+        for entity_id in entity_ids:
+            if entity_id is not None and entity_id not in self.states:
+                self.states[entity_id] = _get_state(entity_id)
 
+    def get(self, entity_id: str) -> Union[str, None]:
+        """
+        Get the (climate-mapped) state of an entity
+        :param entity_id:   Name of the entity
+        :return:            State if entity name is valid, else None
+        """
+        if entity_id not in self.states:
+            self.states[entity_id] = _get_state(entity_id)
+        return self.states[entity_id]
 
-    def __init__(self, automation_id, appliance_priority, export_power, pv_power, load_power, home_battery_level,
-                 min_home_battery_level, dynamic_current_appliance, appliance_phases, min_current,
-                 max_current, appliance_switch, appliance_switch_interval, appliance_current_set_entity,
-                 actual_power, defined_current, appliance_on_only, grid_voltage, import_export_power,
-                 home_battery_capacity, solar_production_forecast, appliance_once_only):
-        if automation_id not in PvExcessControl.instances:
-            inst = self
-        else:
-            inst = PvExcessControl.instances[automation_id]['instance']
-        inst.automation_id = automation_id
-        inst.appliance_priority = int(appliance_priority)
-        PvExcessControl.export_power = export_power
-        PvExcessControl.pv_power = pv_power
-        PvExcessControl.load_power = load_power
-        PvExcessControl.home_battery_level = home_battery_level
-        PvExcessControl.grid_voltage = grid_voltage
-        PvExcessControl.import_export_power = import_export_power
-        PvExcessControl.home_battery_capacity = home_battery_capacity
-        PvExcessControl.solar_production_forecast = solar_production_forecast
-        PvExcessControl.min_home_battery_level = float(min_home_battery_level)
-
-        inst.dynamic_current_appliance = bool(dynamic_current_appliance)
-        inst.min_current = float(min_current)
-        inst.max_current = float(max_current)
-        inst.appliance_switch = appliance_switch
-        inst.appliance_switch_interval = int(appliance_switch_interval)
-        inst.appliance_current_set_entity = appliance_current_set_entity
-        inst.actual_power = actual_power
-        inst.defined_current = float(defined_current)
-        inst.appliance_on_only = bool(appliance_on_only)
-        inst.appliance_once_only = appliance_once_only
-
-        inst.phases = appliance_phases
-
-        inst.log_prefix = f'[{inst.appliance_switch} {inst.automation_id} (Prio {inst.appliance_priority})]'
-        inst.domain = inst.appliance_switch.split('.')[0]
+    def get_num(self, entity_id: str, return_on_error: Union[float, None] = None) -> Union[float, None]:
+        """
+        Get the numerical state of an entity. The state is only validated once per snapshot.
+        :param entity_id:       Name of the entity
+        :param return_on_error: Value to return in case of error
+        :return:                Number if valid, else return_on_error
+        """
+        if entity_id not in self.numbers:
+            self.numbers[entity_id] = _validate_number(self.get(entity_id))
+        num = self.numbers[entity_id]
+        return return_on_error if num is None else num
 
+    def set(self, entity_id: str, entity_state: Union[str, float, None]):
+        """
+        Update the state of an entity after it has been changed by the controller
+        :param entity_id:       Name of the entity
+        :param entity_state:    New state
+        """
+        self.states[entity_id] = entity_state
+        self.numbers.pop(entity_id, None)
 
-        # start if needed
-        if inst.automation_id not in PvExcessControl.instances:
-            inst.switched_on_today = False
-            inst.switch_interval_counter = 0
-            inst.switched_on_time = datetime.datetime.now()
-            inst.daily_run_time = 0
-            inst.trigger_factory()
-            PvExcessControl.instances[inst.automation_id] = {'instance': inst, 'priority': inst.appliance_priority}
-            log.info(f'{self.log_prefix} Trigger Method started.')
-        PvExcessControl.instances = dict(sorted(PvExcessControl.instances.items(), key=lambda item: item[1]['priority'], reverse=True))
-        log.info(f'{inst.log_prefix} Registered appliance.')
-
-    def trigger_factory(self):
-        # trigger every 10s
-        @time_trigger('period(now, 10s)')
-        def on_time():
-            # Sanity check
-            if (not PvExcessControl.instances) or (not self.sanity_check()):
-                return on_time
-                
-            # execute only if this the first instance of the dictionary (avoid two automations acting)
-            #log.info(f'{self.log_prefix} I am around.')
-            first_item = next(iter(PvExcessControl.instances.values()))
-            if first_item["instance"] != self:
-                return on_time                
-
-            PvExcessControl.on_time_counter += 1
-            PvExcessControl._update_pv_history()
-            # ensure that control algo only runs every minute (= every 6th on_time trigger)
-            if PvExcessControl.on_time_counter % 6 != 0:
-                return on_time
-            PvExcessControl.on_time_counter = 0
 
-            # ----------------------------------- go through each appliance (highest prio to lowest) ---------------------------------------
-            # this is for determining which devices can be switched on
-            instances = []
-            for a_id, e in PvExcessControl.instances.copy().items():
-                inst = e['instance']
-                inst.switch_interval_counter += 1
-                log_prefix = inst.log_prefix
+class RingBuffer:
+    """
+    Fixed-capacity history of samples.
+    Appending is O(1) and the mean over the last k samples is calculated in O(1) from running prefix sums, so averages for
+    all window sizes are served by the same buffer. Offsets over the last k samples (see add_offset) are stored lazily
+    instead of rewriting the samples. With a floor, each sample is bounded: offsets are then applied to the samples in O(k), as
+    the bound is not linear.
+    """
+    __slots__ = ('capacity', 'count', 'prefix', 'offsets', 'floor')
 
-                # Check if automation is activated for specific instance
-                if not self.automation_activated(inst.automation_id):
-                    continue
+    def __init__(self, capacity: int, fill: float = 0, floor: Union[float, None] = None):
+        """
+        :param capacity:    Max. number of samples
+        :param fill:        Initial value of all samples
+        :param floor:       Lower bound of each sample (None for no bound)
+        """
+        self.capacity = max(1, int(capacity))
+        self.floor = floor
+        # prefix[i % (capacity + 1)] contains the sum of the first i samples
+        self.prefix = array('d', [fill * i for i in range(self.capacity + 1)])
+        self.count = self.capacity
+        # pending offsets: [value, index of first affected sample, index after last affected sample]
+        self.offsets = []
+
+    def append(self, value: float):
+        """
+        Add a sample. The oldest sample is dropped once the capacity is reached.
+        :param value:   Sample value
+        """
+        if self.floor is not None and value < self.floor:
+            value = self.floor
+        size = self.capacity + 1
+        total = self.prefix[self.count % size] + value
+        self.count += 1
+        self.prefix[self.count % size] = total
+        if self.offsets and self.offsets[0][2] <= self.count - self.capacity:
+            self.offsets = [o for o in self.offsets if o[2] > self.count - self.capacity]
+        if abs(total) > 1e12:
+            self._rebase()
+
+    def mean(self, k: int) -> float:
+        """
+        Average of the last k samples (including pending offsets)
+        :param k:   Window size in samples
+        :return:    Average value
+        """
+        k = max(1, min(int(k), self.capacity))
+        size = self.capacity + 1
+        total = self.prefix[self.count % size] - self.prefix[(self.count - k) % size]
+        for value, first, last in self.offsets:
+            overlap = min(last, self.count) - max(first, self.count - k)
+            if overlap > 0:
+                total += value * overlap
+        return total / k
+
+    def add_offset(self, value: float, k: int):
+        """
+        Add an offset to each of the last k samples
+        :param value:   Offset
+        :param k:       Number of affected samples
+        """
+        k = max(1, min(int(k), self.capacity))
+        if self.floor is None:
+            self.offsets.append([value, self.count - k, self.count])
+            return
+        size = self.capacity + 1
+        first = self.count - k
+        samples = [self.prefix[(i + 1) % size] - self.prefix[i % size] for i in range(first, self.count)]
+        total = self.prefix[first % size]
+        for i, sample in enumerate(samples, first + 1):
+            total += max(self.floor, sample + value)
+            self.prefix[i % size] = total
+
+    def values(self) -> list:
+        """
+        All samples (oldest first, including pending offsets). O(capacity), only intended for logging and persistence.
+        :return:    List of sample values
+        """
+        size = self.capacity + 1
+        first = self.count - self.capacity
+        res = [self.prefix[(i + 1) % size] - self.prefix[i % size] for i in range(first, self.count)]
+        for value, o_first, o_last in self.offsets:
+            for i in range(max(o_first, first), min(o_last, self.count)):
+                res[i - first] += value
+        return res
+
+    def _rebase(self):
+        """
+        Shift all prefix sums to keep them small and precise. O(capacity), but only needed very rarely.
+        """
+        size = self.capacity + 1
+        base = self.prefix[(self.count - self.capacity) % size]
+        for i in range(size):
+            self.prefix[i] -= base
 
-                # check min bat lvl and decide whether to regard export power or solar power minus load power
-                if PvExcessControl.home_battery_level is None:
-                    home_battery_level = 100
-                else:
-                    home_battery_level = _get_num_state(PvExcessControl.home_battery_level)
-                if home_battery_level >= PvExcessControl.min_home_battery_level or not self._force_charge_battery():
-                    # home battery charge is high enough to direct solar power to appliances, if solar power is higher than load power
-                    # calc avg based on pv excess (solar power - load power) according to specified window
-                    avg_excess_power = int(sum(PvExcessControl.pv_history[-inst.appliance_switch_interval:]) / max(1,inst.appliance_switch_interval))
-                    log.debug(f'{log_prefix} Home battery charge is sufficient ({home_battery_level}/{PvExcessControl.min_home_battery_level} %)'
-                              f' OR remaining solar forecast is higher than remaining capacity of home battery. '
-                              f'Calculated average excess power based on >> solar power - load power <<: {avg_excess_power} W')
 
-                else:
-                    # home battery charge is not yet high enough OR battery force charge is necessary.
-                    # Only use excess power (which would otherwise be exported to the grid) for appliance
-                    # calc avg based on export power history according to specified window
-                    avg_excess_power = int(sum(PvExcessControl.export_history[-inst.appliance_switch_interval:]) / max(1,inst.appliance_switch_interval))
-                    log.debug(f'{log_prefix} Home battery charge is not sufficient ({home_battery_level}/{PvExcessControl.min_home_battery_level} %), '
-                              f'OR remaining solar forecast is lower than remaining capacity of home battery. '
-                              f'Calculated average excess power based on >> export power <<: {avg_excess_power} W')
-
-                # add instance including calculated excess power to inverted list (priority from low to high)
-                instances.insert(0, {'instance': inst, 'avg_excess_power': avg_excess_power})
-
-
-                # -------------------------------------------------------------------
-                # Determine if appliance can be turned on or current can be increased
-                if _get_state(inst.appliance_switch) == 'on':
-                    # check if current of appliance can be increased
-                    log.debug(f'{log_prefix} Appliance is already switched on.')
-                    run_time = inst.daily_run_time + (datetime.datetime.now() - inst.switched_on_time).total_seconds()
-                    log.info(f'{inst.log_prefix} Application has run for {(run_time / 60):.1f} minutes')
-                    if avg_excess_power >= PvExcessControl.min_excess_power and inst.dynamic_current_appliance:
-                        # try to increase dynamic current, because excess solar power is available
-                        prev_amps = _get_num_state(inst.appliance_current_set_entity, return_on_error=inst.min_current)
-                        excess_amps = round(avg_excess_power / (PvExcessControl.grid_voltage * inst.phases), 1) + prev_amps
-                        amps = max(inst.min_current, min(excess_amps, inst.max_current))
-                        if amps > (prev_amps+0.09):
-                            _set_value(inst.appliance_current_set_entity, amps)
-                            log.info(f'{log_prefix} Setting dynamic current appliance from {prev_amps} to {amps} A per phase.')
-                            diff_power = (amps-prev_amps) * PvExcessControl.grid_voltage * inst.phases
-                            # "restart" history by subtracting power difference from each history value within the specified time frame
-                            self._adjust_pwr_history(inst, -diff_power)
-
-                elif not (inst.appliance_once_only and inst.switched_on_today):
-                    # check if appliance can be switched on
-                    if _get_state(inst.appliance_switch) != 'off':
-                        log.warning(f'{log_prefix} Appliance state (={_get_state(inst.appliance_switch)}) is neither ON nor OFF. '
-                                    f'Assuming OFF state.')
-                    defined_power = inst.defined_current * PvExcessControl.grid_voltage * inst.phases
-
-                    if avg_excess_power >= defined_power or (inst.appliance_priority > 1000 and avg_excess_power > 0):
-                        log.debug(f'{log_prefix} Average Excess power is high enough to switch on appliance.')
-                        if inst.switch_interval_counter >= inst.appliance_switch_interval:
-                            self.switch_on(inst)
-                            inst.switch_interval_counter = 0
-                            log.info(f'{log_prefix} Switched on appliance.')
-                            # "restart" history by subtracting defined power from each history value within the specified time frame
-                            self._adjust_pwr_history(inst, -defined_power)
-                            task.sleep(1)
-                            if inst.dynamic_current_appliance:
-                                _set_value(inst.appliance_current_set_entity, inst.min_current)
-                        else:
-                            log.debug(f'{log_prefix} Cannot switch on appliance, because appliance switch interval is not reached '
-                                      f'({inst.switch_interval_counter}/{inst.appliance_switch_interval}).')
-                    else:
-                        log.debug(f'{log_prefix} Average Excess power not high enough to switch on appliance.')
-                # -------------------------------------------------------------------
-
-
-            # ----------------------------------- go through each appliance (lowest prio to highest prio) ----------------------------------
-            # this is for determining which devices need to be switched off or decreased in current
-            prev_consumption_sum = 0
-            for dic in instances:
-                inst = dic['instance']
-                avg_excess_power = dic['avg_excess_power'] + prev_consumption_sum
-                log_prefix = f'[{inst.appliance_switch} (Prio {inst.appliance_priority})]'
-
-                # -------------------------------------------------------------------
-                if _get_state(inst.appliance_switch) == 'on':
-                    # check if inst.appliance_priority > 1000 and switching of will cause excess. In that case keep it on
-                    if inst.appliance_priority > 1000:
-                        if inst.actual_power is None:
-                            allowed_excess_power_consumption = inst.defined_current * PvExcessControl.grid_voltage * inst.phases
-                        else:
-                            allowed_excess_power_consumption = _get_num_state(inst.actual_power)
-                    else:
-                        allowed_excess_power_consumption = 0
-                    if avg_excess_power < PvExcessControl.min_excess_power - allowed_excess_power_consumption:
-                        log.debug(f'{log_prefix} Average Excess Power ({avg_excess_power} W) is less than minimum excess power '
-                                  f'({PvExcessControl.min_excess_power} W).')
-
-                        # check if current of dyn. curr. appliance can be reduced
-                        if inst.dynamic_current_appliance:
-                            if inst.actual_power is None:
-                                actual_current = round((inst.defined_current * PvExcessControl.grid_voltage * inst.phases) / (
-                                        PvExcessControl.grid_voltage * inst.phases), 1)
-                            else:
-                                actual_current = round(_get_num_state(inst.actual_power) / (PvExcessControl.grid_voltage * inst.phases), 1)
-                            diff_current = round(avg_excess_power / (PvExcessControl.grid_voltage * inst.phases), 1)
-                            target_current = max(inst.min_current, actual_current + diff_current)
-                            log.debug(f'{log_prefix} {actual_current=}A | {diff_current=}A | {target_current=}A')
-                            if inst.min_current < target_current < actual_current:
-                                # current can be reduced
-                                log.info(f'{log_prefix} Reducing dynamic current appliance from {actual_current} A to {target_current} A.')
-                                _set_value(inst.appliance_current_set_entity, target_current)
-                                # add released power consumption to next appliances in list
-                                diff_power = (actual_current - target_current) * PvExcessControl.grid_voltage * inst.phases
-                                prev_consumption_sum += diff_power
-                                log.debug(f'{log_prefix} Added {diff_power=} W to prev_consumption_sum, '
-                                          f'which is now {prev_consumption_sum} W.')
-                                # "restart" history by adding defined power to each history value within the specified time frame
-                                self._adjust_pwr_history(inst, diff_power)
-                            else:
-                                # current cannot be reduced
-                                # turn off appliance
-                                power_consumption = self.switch_off(inst)
-                                if power_consumption != 0:
-                                    prev_consumption_sum += power_consumption
-                                    log.debug(f'{log_prefix} Added {power_consumption=} W to prev_consumption_sum, '
-                                              f'which is now {prev_consumption_sum} W.')
-
-                        else:
-                            # Try to switch off appliance
-                            power_consumption = self.switch_off(inst)
-                            if power_consumption != 0:
-                                prev_consumption_sum += power_consumption
-                                log.debug(f'{log_prefix} Added {power_consumption=} W to prev_consumption_sum, '
-                                          f'which is now {prev_consumption_sum} W.')
-                    else:
-                        log.debug(f'{log_prefix} Average Excess Power ({avg_excess_power} W) is still greater than minimum excess power '
-                                  f'({PvExcessControl.min_excess_power} W) - Doing nothing.')
+class MultiRingBuffer:
+    """
+    Fixed-capacity history of multi-channel samples (e.g. one channel per phase), vectorised version of RingBuffer.
+    The prefix sums of all channels are interleaved in a single array, so appending a sample and averaging a window need a single
+    index calculation for all channels.
+    """
+    __slots__ = ('capacity', 'channels', 'count', 'prefix', 'offsets')
+
+    def __init__(self, capacity: int, channels: int):
+        """
+        :param capacity:    Max. number of samples
+        :param channels:    Number of channels
+        """
+        self.capacity = max(1, int(capacity))
+        self.channels = channels
+        # prefix[(i % (capacity + 1)) * channels + c] contains the sum of the first i samples of channel c
+        self.prefix = array('d', [0.0] * ((self.capacity + 1) * channels))
+        self.count = self.capacity
+        # pending offsets: [values, index of first affected sample, index after last affected sample]
+        self.offsets = []
+
+    def append(self, values: list):
+        """
+        Add a sample. The oldest sample is dropped once the capacity is reached.
+        :param values:  Sample value of each channel
+        """
+        size = self.capacity + 1
+        n = self.channels
+        prev = (self.count % size) * n
+        self.count += 1
+        cur = (self.count % size) * n
+        prefix = self.prefix
+        for c in range(n):
+            prefix[cur + c] = prefix[prev + c] + values[c]
+        if self.offsets and self.offsets[0][2] <= self.count - self.capacity:
+            self.offsets = [o for o in self.offsets if o[2] > self.count - self.capacity]
+        if abs(prefix[cur]) > 1e12:
+            self._rebase()
+
+    def mean(self, k: int) -> list:
+        """
+        Average of the last k samples of each channel (including pending offsets)
+        :param k:   Window size in samples
+        :return:    List of average values
+        """
+        k = max(1, min(int(k), self.capacity))
+        size = self.capacity + 1
+        n = self.channels
+        cur = (self.count % size) * n
+        first = ((self.count - k) % size) * n
+        prefix = self.prefix
+        totals = [prefix[cur + c] - prefix[first + c] for c in range(n)]
+        for values, o_first, o_last in self.offsets:
+            overlap = min(o_last, self.count) - max(o_first, self.count - k)
+            if overlap > 0:
+                for c in range(n):
+                    totals[c] += values[c] * overlap
+        return [total / k for total in totals]
+
+    def add_offset(self, values: list, k: int):
+        """
+        Add an offset to each of the last k samples
+        :param values:  Offset of each channel
+        :param k:       Number of affected samples
+        """
+        k = max(1, min(int(k), self.capacity))
+        self.offsets.append([list(values), self.count - k, self.count])
+
+    def values(self) -> list:
+        """
+        All samples (oldest first, including pending offsets). O(capacity), only intended for logging and persistence.
+        :return:    List of samples (list of channel values)
+        """
+        size = self.capacity + 1
+        n = self.channels
+        first = self.count - self.capacity
+        prefix = self.prefix
+        res = [[prefix[((i + 1) % size) * n + c] - prefix[(i % size) * n + c] for c in range(n)] for i in range(first, self.count)]
+        for values, o_first, o_last in self.offsets:
+            for i in range(max(o_first, first), min(o_last, self.count)):
+                for c in range(n):
+                    res[i - first][c] += values[c]
+        return res
+
+    def _rebase(self):
+        """
+        Shift all prefix sums to keep them small and precise. O(capacity), but only needed very rarely.
+        """
+        size = self.capacity + 1
+        n = self.channels
+        base = [self.prefix[((self.count - self.capacity) % size) * n + c] for c in range(n)]
+        for i in range(size):
+            for c in range(n):
+                self.prefix[i * n + c] -= base[c]
 
 
-                else:
-                    if _get_state(inst.appliance_switch) != 'off':
-                        log.warning(f'{log_prefix} Appliance state (={_get_state(inst.appliance_switch)}) is neither ON nor OFF. '
-                                    f'Assuming OFF state.')
-                    # Note: This can misfire right after an appliance has been switched on. Generally no problem.
-                    log.debug(f'{log_prefix} Appliance is already switched off.')
-                # -------------------------------------------------------------------
+class BucketStats:
+    """
+    Streaming reducer for the samples of one history bucket.
+    Keeps running (weighted) mean, min, max and count, so samples never have to be stored.
+    """
+    __slots__ = ('count', 'weight', 'total', 'min', 'max')
 
-        return on_time
+    def __init__(self):
+        self.reset()
 
-    @staticmethod
-    def _update_pv_history():
+    def reset(self):
         """
-        Update Export and PV history
+        Start a new bucket
         """
-        try:
-            if PvExcessControl.import_export_power:
-                # Calc values based on combined import/export power sensor
-                import_export_state = _get_num_state(PvExcessControl.import_export_power)
-                if import_export_state is None:
-                    raise Exception(f'Could not update Export/PV history: {PvExcessControl.import_export_power} is None.')
-                import_export = int(import_export_state)
-                # load_pwr = pv_pwr + import_export
-                export_pwr = abs(min(0, import_export))
-                excess_pwr = -import_export
-            else:
-                # Calc values based on separate sensors
-                export_pwr_state = _get_num_state(PvExcessControl.export_power)
-                pv_power_state = _get_num_state(PvExcessControl.pv_power)
-                load_power_state = _get_num_state(PvExcessControl.load_power)
-                if export_pwr_state is None or pv_power_state is None or load_power_state is None:
-                    raise Exception(f'Could not update Export/PV history {PvExcessControl.export_power=} | {PvExcessControl.pv_power=} | '
-                                    f'{PvExcessControl.load_power=} = {export_pwr_state=} | {pv_power_state=} | {load_power_state=}')
-                export_pwr = int(export_pwr_state)
-                excess_pwr = int(pv_power_state - load_power_state)
-        except Exception as e:
-            log.error(f'Could not update Export/PV history!: {e}')
-            return
-        else:
-            PvExcessControl.export_history_buffer.append(export_pwr)
-            PvExcessControl.pv_history_buffer.append(excess_pwr)
-
-        # log.debug(f'Export History Buffer: {PvExcessControl.export_history_buffer}')
-        # log.debug(f'PV Excess (PV Power - Load Power) History Buffer: {PvExcessControl.pv_history_buffer}')
-
-        if PvExcessControl.on_time_counter % 6 == 0:
-            # enforce max. 60 minute length of history
-            if len(PvExcessControl.export_history) >= 60:
-                PvExcessControl.export_history.pop(0)
-            if len(PvExcessControl.pv_history) >= 60:
-                PvExcessControl.pv_history.pop(0)
-            # calc avg of buffer
-            export_avg = round(sum(PvExcessControl.export_history_buffer) / len(PvExcessControl.export_history_buffer))
-            excess_avg = round(sum(PvExcessControl.pv_history_buffer) / len(PvExcessControl.pv_history_buffer))
-            # add avg to history
-            PvExcessControl.export_history.append(export_avg)
-            PvExcessControl.pv_history.append(excess_avg)
-            log.debug(f'Export History: {PvExcessControl.export_history}')
-            log.debug(f'PV Excess (PV Power - Load Power) History: {PvExcessControl.pv_history}')
-            # clear buffer
-            PvExcessControl.export_history_buffer = []
-            PvExcessControl.pv_history_buffer = []
-
-
-    def sanity_check(self) -> bool:
-        if PvExcessControl.import_export_power is not None and PvExcessControl.home_battery_level is not None:
-            log.warning('"Import/Export power" has been defined together with "Home Battery". This is not intended and will lead to always '
-                        'giving the home battery priority over appliances, regardless of the specified min. battery level.')
-            return True
-        if PvExcessControl.import_export_power is not None and (PvExcessControl.export_power is not None or
-                                                                PvExcessControl.load_power is not None):
-            log.error('"Import/Export power" has been defined together with either "Export power" or "Load power". This is not '
-                      'allowed. Please specify either "Import/Export power" or both "Load power" & "Export Power".')
-            return False
-        if not (PvExcessControl.import_export_power is not None or (PvExcessControl.export_power is not None and
-                                                                    PvExcessControl.load_power is not None)):
-            log.error('Either "Export power" or "Load power" have not been defined. This is not '
-                      'allowed. Please specify either "Import/Export power" or both "Load power" & "Export Power".')
-            return False
-        return True
+        self.count = 0
+        self.weight = 0.0
+        self.total = 0.0
+        self.min = None
+        self.max = None
 
-    def switch_on(self, inst):
+    def add(self, value: float, weight: float = 1.0):
         """
-        Switches an appliance on, if possible.
-        :param inst:        PVExcesscontrol Class instance
+        Add a sample to the bucket
+        :param value:   Sample value
+        :param weight:  Weight of the sample (e.g. duration in seconds)
         """
-        if inst.appliance_once_only and inst.switched_on_today:
-            log.debug(f'{inst.log_prefix} "Only-Run-Once-Appliance" detected - Appliance was already switched on today - '
-                      f'Not switching on again.')
-        elif _turn_on(inst.appliance_switch):
-            inst.switched_on_today = True
-            inst.switched_on_time = datetime.datetime.now()
+        self.count += 1
+        self.weight += weight
+        self.total += value * weight
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self) -> Union[float, None]:
+        """
+        :return:    Weighted mean of all samples in the bucket, None if the bucket is empty
+        """
+        if self.weight <= 0:
+            return None
+        return self.total / self.weight
 
-    def switch_off(self, inst) -> float:
+
+class SensorFilter:
+    """
+    Streaming quality stage of one power sensor:
+    - Outliers are detected by a Hampel filter (deviation from the median of the last accepted samples by more than hampel_k
+      times the scaled median absolute deviation) and replaced by the median. If the next sample confirms the new level, the
+      step is regarded as real and the window restarts at the new level, so steps (e.g. switched appliances) are delayed by one
+      sample.
+    - Missing samples (unavailable / invalid) are filled with the last value for up to max_gap seconds, so the samples of a bucket
+      are not shifted by short dropouts.
+    Counts the available samples for the quality score (missing and filled samples are not available). Samples replaced by the
+    Hampel filter are counted separately, as spikes and steps are not a sign of an unhealthy sensor.
+    """
+    __slots__ = ('window', 'pending', 'last', 'last_time', 'missing', 'samples', 'valid', 'spikes')
+    # number of samples regarded by the Hampel filter
+    window_size = 5
+    hampel_k = 3
+    # deviations from the median below this value (in watts) are never regarded as outliers
+    min_deviation = 500
+
+    def __init__(self):
+        self.window = []
+        # last sample regarded as outlier, None if the last sample was valid
+        self.pending = None
+        # last (filtered) value and its time
+        self.last = None
+        self.last_time = None
+        # True if the last sample was not available
+        self.missing = False
+        # samples / available samples since the last quality check
+        self.samples = 0
+        self.valid = 0
+        # samples replaced by the Hampel filter (total, diagnostic only)
+        self.spikes = 0
+
+    def filter(self, value: Union[float, None], now: float, max_gap: float, hampel: bool = True) -> Union[float, None]:
         """
-        Switches an appliance off, if possible.
-        :param inst:        PVExcesscontrol Class instance
-        :return:            Power consumption relief achieved through switching the appliance off (will be 0 if appliance could
-                             not be switched off)
+        :param value:   Sample, None if not available
+        :param now:     Current (monotonic) time in seconds
+        :param max_gap: Max. duration in seconds, for which missing samples are filled (0 = disabled)
+        :param hampel:  False to skip the outlier detection (e.g. for samples which are not equally spaced)
+        :return:        Filtered sample, None if not available
         """
-        # Check if automation is activated for specific instance
-        if not self.automation_activated(inst.automation_id):
-            return 0
-        # Do not turn off only-on-appliances
-        if inst.appliance_on_only:
-            log.debug(f'{inst.log_prefix} "Only-On-Appliance" detected - Not switching off.')
-            return 0
-        # Do not turn off if switch interval not reached
-        elif inst.switch_interval_counter < inst.appliance_switch_interval:
-            log.debug(f'{inst.log_prefix} Cannot switch off appliance, because appliance switch interval is not reached '
-                      f'({inst.switch_interval_counter}/{inst.appliance_switch_interval}).')
-            return 0
+        self.samples += 1
+        if value is None:
+            self.missing = True
+            if self.last is not None and now - self.last_time <= max_gap:
+                return self.last
+            return None
+        self.missing = False
+        self.valid += 1
+        window = self.window
+        pending = self.pending
+        if pending is not None:
+            self.pending = None
+            if abs(value - pending) <= self.min_deviation:
+                # confirmed step
+                window = self.window = [pending]
+        self.last_time = now
+        n = len(window)
+        if hampel and n >= 2:
+            # outliers are not added to the window, so they do not inflate the median absolute deviation of the next samples
+            median = sorted(window)[n // 2]
+            deviation = abs(value - median)
+            # the median absolute deviation is only needed for larger deviations
+            if deviation > self.min_deviation:
+                mad = sorted([abs(v - median) for v in window])[n // 2]
+                if deviation > self.hampel_k * 1.4826 * mad:
+                    self.pending = value
+                    self.last = median
+                    self.spikes += 1
+                    return median
+        window.append(value)
+        if n >= self.window_size:
+            del window[0]
+        self.last = value
+        return value
+
+    def quality(self) -> float:
+        """
+        Share of available samples since the last call. Without samples (sensor did not change), 0 if the last sample was not
+        available, 1 otherwise.
+        """
+        if self.samples:
+            quality = self.valid / self.samples
         else:
-            # switch off
-            # get last power consumption
-            if inst.actual_power is None:
-                power_consumption = inst.defined_current * PvExcessControl.grid_voltage * inst.phases
-            else:
-                power_consumption = _get_num_state(inst.actual_power)
-            log.debug(f'{inst.log_prefix} Current power consumption: {power_consumption} W')
-            # switch off appliance
-            _turn_off(inst.appliance_switch)
-            inst.daily_run_time += (datetime.datetime.now() - inst.switched_on_time).total_seconds()
-            log.info(f'{inst.log_prefix} Switched off appliance.')
-            log.info(f'{inst.log_prefix} Application has run for {(inst.daily_run_time / 60):.1f} minutes')
-            task.sleep(1)
-            inst.switch_interval_counter = 0
-            # "restart" history by adding defined power to each history value within the specified time frame
-            self._adjust_pwr_history(inst, power_consumption)
-            return power_consumption
+            quality = 0.0 if self.missing else 1.0
+        self.samples = 0
+        self.valid = 0
+        return quality
 
 
-    def automation_activated(self, a_id):
+class SensorHealth:
+    """
+    Health of the power sensors of a controller group. The quality score of a control pass is the share of available samples of
+    the worst sensor since the last control pass (0 if a sensor has not been reported for longer than max_age). Below min_quality,
+    the group is controlled in degraded mode: appliances are not switched on and currents are not increased.
+    """
+    __slots__ = ('filters', 'max_age', 'quality', 'sensor_quality', 'degraded')
+    # max. duration of a gap in seconds, which is filled with the last value
+    max_gap = 60
+    min_quality = 0.5
+
+    def __init__(self):
+        # entity ID -> SensorFilter
+        self.filters = {}
+        # max. age of the sensor states in seconds (0 = disabled)
+        self.max_age = 0
+        self.quality = 1.0
+        # entity ID -> quality of the last control pass
+        self.sensor_quality = {}
+        self.degraded = False
+
+    def filter(self, entity_id: str, value: Union[float, None], now: float, hampel: bool = True) -> Union[float, None]:
         """
-        Checks if the automation for a specific appliance is activated or not.
-        :param a_id:    Automation ID in Home Assistant
-        :return:        True if automation is activated, False otherwise
+        Pass a sample through the filter of a sensor (see SensorFilter.filter)
         """
-        automation_state = _get_state(a_id)
-        if automation_state == 'off':
-            log.debug(f'Doing nothing, because automation is not activated: State is {automation_state}.')
-            return False
-        elif automation_state is None:
-            log.info(f'Automation "{a_id}" was deleted. Removing related class instance.')
-            del PvExcessControl.instances[a_id]
-            return False
-        return True
+        sensor_filter = self.filters.get(entity_id)
+        if sensor_filter is None:
+            sensor_filter = self.filters[entity_id] = SensorFilter()
+        if hampel:
+            return sensor_filter.filter(value, now, self.max_gap)
+        return sensor_filter.filter(value, now, 0, False)
+
+    def check(self, entity_ids: list, ages: dict) -> bool:
+        """
+        Calculate the quality score of the current control pass
+        :param entity_ids:  Power sensors
+        :param ages:        Entity ID -> age of the state in seconds (None if not available)
+        :return:            True if the degraded mode changed
+        """
+        sensor_quality = {}
+        for entity_id in entity_ids:
+            sensor_filter = self.filters.get(entity_id)
+            quality = 0.0 if sensor_filter is None else sensor_filter.quality()
+            age = ages.get(entity_id)
+            if self.max_age and age is not None and age > self.max_age:
+                quality = 0.0
+            sensor_quality[entity_id] = quality
+        self.sensor_quality = sensor_quality
+        self.quality = min(sensor_quality.values()) if sensor_quality else 1.0
+        degraded = self.quality < self.min_quality
+        changed = degraded != self.degraded
+        self.degraded = degraded
+        return changed
+
+
+class RollingStats:
+    """
+    Statistics over the last values of a metric (fixed size ring)
+    """
+    __slots__ = ('values', 'index', 'count', 'last')
 
+    def __init__(self, size: int = 60):
+        """
+        :param size:    Number of values regarded
+        """
+        self.values = array('d', [0.0]) * size
+        self.index = 0
+        self.count = 0
+        self.last = None
+
+    def add(self, value: float):
+        self.values[self.index] = value
+        self.index = (self.index + 1) % len(self.values)
+        self.count = min(self.count + 1, len(self.values))
+        self.last = value
+
+    def summary(self, digits: int = 2) -> dict:
+        """
+        :param digits:  Number of decimal digits
+        :return:        Dict with mean, p95 and max of the regarded values
+        """
+        if not self.count:
+            return {'mean': None, 'p95': None, 'max': None}
+        values = sorted(self.values[:self.count] if self.count < len(self.values) else self.values)
+        return {'mean': round(sum(values) / self.count, digits),
+                'p95': round(values[min(self.count - 1, int(0.95 * self.count))], digits),
+                'max': round(values[-1], digits)}
 
-    def _adjust_pwr_history(self, inst, value):
-        log.debug(f'Adjusting power history by {value}.')
-        log.debug(f'Export history: {PvExcessControl.export_history}')
-        PvExcessControl.export_history[-inst.appliance_switch_interval:] = [max(0, x + value) for x in
-                                                                            PvExcessControl.export_history[-inst.appliance_switch_interval:]]
-        log.debug(f'Adjusted export history: {PvExcessControl.export_history}')
-        log.debug(f'PV Excess (solar power - load power) history: {PvExcessControl.pv_history}')
-        PvExcessControl.pv_history[-inst.appliance_switch_interval:] = [x + value for x in
-                                                                        PvExcessControl.pv_history[-inst.appliance_switch_interval:]]
-        log.debug(f'Adjusted PV Excess (solar power - load power) history: {PvExcessControl.pv_history}')
 
+class Diagnostics:
+    """
+    Instrumentation of the scheduler: durations of ticks, control passes and history updates, state reads and service calls per
+    history bucket and the decisions per appliance.
+    """
+    __slots__ = ('tick_ms', 'control_pass_ms', 'history_update_ms', 'state_reads', 'service_calls', 'decisions', 'counter_mark',
+                 'skipped_ticks')
+    # suppressed: action held back by the hysteresis within a control pass
+    decision_types = ('switch_on', 'switch_off', 'set_current', 'none', 'suppressed')
+
+    def __init__(self):
+        self.tick_ms = RollingStats()
+        self.control_pass_ms = RollingStats()
+        self.history_update_ms = RollingStats()
+        self.state_reads = RollingStats()
+        self.service_calls = RollingStats()
+        # automation_id -> {'last': decision, decision: count}
+        self.decisions = {}
+        self.counter_mark = dict(_call_counter)
+        # ticks skipped, because the previous tick was still running
+        self.skipped_ticks = 0
+
+    def record_tick(self, duration: float, history_duration: float):
+        """
+        :param duration:            Duration of the tick in seconds
+        :param history_duration:    Duration of the history update in seconds
+        """
+        self.tick_ms.add(duration * 1000)
+        self.history_update_ms.add(history_duration * 1000)
 
-    def _force_charge_battery(self, kwh_offset: float = 1):
+    def record_control_pass(self, duration: float):
         """
-        Calculates if the remaining solar power forecast is enough to ensure the specified min. home battery level is reached at the end
-        of the day.
-        :param kwh_offset:  Offset in kWh, which will be added to the calculated remaining battery capacity to ensure an earlier
-                             triggering of a force charge
-        :return:            True if force charge is necessary, False otherwise
+        Record a control pass. State reads and service calls are counted since the last control pass (= per history bucket).
+        :param duration:    Duration of the control pass in seconds
         """
-        if PvExcessControl.home_battery_level is None:
-            return False
+        self.control_pass_ms.add(duration * 1000)
+        self.state_reads.add(_call_counter['state_reads'] - self.counter_mark['state_reads'])
+        self.service_calls.add(_call_counter['service_calls'] - self.counter_mark['service_calls'])
+        self.counter_mark = dict(_call_counter)
 
-        capacity = PvExcessControl.home_battery_capacity
-        remaining_capacity = capacity - (0.01 * capacity * _get_num_state(PvExcessControl.home_battery_level, return_on_error=0))
-        remaining_forecast = _get_num_state(PvExcessControl.solar_production_forecast, return_on_error=0)
-        if remaining_forecast <= remaining_capacity + kwh_offset:
-            log.debug(f'Force battery charge necessary: {capacity=} kWh|{remaining_capacity=} kWh|{remaining_forecast=} kWh| '
-                      f'{kwh_offset=} kWh')
-            # go through appliances lowest to highest priority, and try switching them off individually
-            for a_id, e in dict(sorted(PvExcessControl.instances.items(), key=lambda item: item[1]['priority'])).items():
-                inst = e['instance']
-                self.switch_off(inst)
-            return True
-        return False
+    def record_decision(self, automation_id: str, decision: str):
+        """
+        :param automation_id:   Appliance
+        :param decision:        One of decision_types
+        """
+        if automation_id not in self.decisions:
+            self.decisions[automation_id] = dict({d: 0 for d in self.decision_types}, last=None)
+        self.decisions[automation_id][decision] += 1
+        self.decisions[automation_id]['last'] = decision
+
+    def as_dict(self) -> dict:
+        """
+        :return:    Rolling statistics of all metrics
+        """
+        return {'tick_ms': self.tick_ms.summary(), 'control_pass_ms': self.control_pass_ms.summary(),
+                'history_update_ms': self.history_update_ms.summary(3), 'state_reads': self.state_reads.summary(1),
+                'service_calls': self.service_calls.summary(1), 'decisions': self.decisions, 'skipped_ticks': self.skipped_ticks}
+
+
+class ExcessPredictor:
+    """
+    Short-horizon prediction of the excess power. The history buckets are smoothed incrementally by damped Holt exponential
+    smoothing (level + trend), so each update is O(1). The smoothing constants are defined per minute and converted to the
+    bucket width.
+    """
+    __slots__ = ('alpha', 'beta', 'level', 'trend', 'buckets_per_minute')
+    # smoothing of level and trend per minute
+    alpha_per_minute = 0.5
+    beta_per_minute = 0.2
+    # damping of the trend per minute (the trend is not extrapolated linearly over the whole horizon)
+    phi = 0.9
+
+    def __init__(self, bucket_width: float = 60):
+        """
+        :param bucket_width:    Width of one history bucket in seconds
+        """
+        self.buckets_per_minute = 60 / bucket_width
+        self.alpha = 1 - (1 - self.alpha_per_minute) ** (1 / self.buckets_per_minute)
+        self.beta = 1 - (1 - self.beta_per_minute) ** (1 / self.buckets_per_minute)
+        self.level = None
+        self.trend = 0.0
+
+    def update(self, value: float):
+        """
+        Add a completed history bucket
+        :param value:   Average of the bucket
+        """
+        if self.level is None:
+            self.level = value
+            return
+        level = self.alpha * value + (1 - self.alpha) * (self.level + self.trend)
+        self.trend = self.beta * (level - self.level) + (1 - self.beta) * self.trend
+        self.level = level
+
+    def add_offset(self, value: float):
+        """
+        Shift the level, e.g. if an appliance was switched (see PvExcessControl._adjust_pwr_history)
+        :param value:   Offset in watts
+        """
+        if self.level is not None:
+            self.level += value
+
+    def change(self, minutes: int) -> float:
+        """
+        :param minutes: Prediction horizon in minutes
+        :return:        Predicted change of the excess power within the horizon in watts
+        """
+        if self.level is None:
+            return 0.0
+        trend_per_minute = self.trend * self.buckets_per_minute
+        # sum of the damped trend over the horizon (geometric series)
+        return trend_per_minute * self.phi * (1 - self.phi ** minutes) / (1 - self.phi)
+
+
+def _timestamp(value) -> float:
+    """
+    :param value:   ISO timestamp (string) or datetime
+    :return:        Unix timestamp
+    """
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    return value.timestamp()
+
+
+def _parse_forecast(attributes: dict) -> list:
+    """
+    Parse a solar power forecast series from entity attributes
+     - Forecast.Solar: 'watts' = {timestamp: power in W}
+     - Solcast: 'detailedForecast' = [{'period_start': timestamp, 'pv_estimate': power in kW}]
+    :param attributes:  Entity attributes
+    :return:            Sorted list of (unix timestamp, power in W), empty if no series was found
+    """
+    timestamp = _timestamp
+    series = []
+    try:
+        if isinstance(attributes.get('watts'), dict):
+            series = [(timestamp(t), float(w)) for t, w in attributes['watts'].items()]
+        elif isinstance(attributes.get('detailedForecast'), list):
+            series = [(timestamp(p['period_start']), 1000 * float(p['pv_estimate'])) for p in attributes['detailedForecast']]
+    except (KeyError, TypeError, ValueError) as e:
+        log.error(f'Could not parse solar power forecast: {e}')
+        return []
+    series.sort()
+    return series
+
+
+def _forecast_power(series: list, t: float) -> float:
+    """
+    Linear interpolation of a forecast series
+    :param series:  Sorted list of (unix timestamp, power in W)
+    :param t:       Unix timestamp
+    :return:        Forecasted power in W (0 outside of the series)
+    """
+    i = bisect.bisect_right(series, (t, float('inf')))
+    if i == 0 or i == len(series):
+        return 0.0 if i == 0 or t > series[-1][0] else series[-1][1]
+    (t0, p0), (t1, p1) = series[i - 1], series[i]
+    return p0 + (p1 - p0) * (t - t0) / (t1 - t0)
+
+
+def _forecast_energy(series: list, start: float, end: float, step: float = 300) -> float:
+    """
+    Integrate a forecast series
+    :param series:  Sorted list of (unix timestamp, power in W)
+    :param start:   Unix timestamp
+    :param end:     Unix timestamp
+    :param step:    Integration step in seconds
+    :return:        Forecasted energy in kWh
+    """
+    energy = 0.0
+    t = start
+    while t < end:
+        dt = min(step, end - t)
+        energy += (_forecast_power(series, t) + _forecast_power(series, t + dt)) / 2 * dt
+        t += dt
+    return energy / 3.6e6
+
+
+def _parse_prices(attributes: dict) -> list:
+    """
+    Parse a dynamic grid price series from entity attributes
+     - Tibber: 'today' / 'tomorrow' = [{'startsAt': timestamp, 'total': price}]
+     - Nordpool: 'raw_today' / 'raw_tomorrow' = [{'start': timestamp, 'end': timestamp, 'value': price}]
+    :param attributes:  Entity attributes
+    :return:            Sorted list of (unix timestamp of the period start, price), empty if no series was found
+    """
+    series = []
+    try:
+        if isinstance(attributes.get('raw_today'), list):
+            series = [(_timestamp(p['start']), float(p['value'])) for key in ('raw_today', 'raw_tomorrow')
+                      for p in (attributes.get(key) or []) if p.get('value') is not None]
+        elif isinstance(attributes.get('today'), list):
+            series = [(_timestamp(p['startsAt']), float(p['total'])) for key in ('today', 'tomorrow')
+                      for p in (attributes.get(key) or []) if p.get('total') is not None]
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        log.error(f'Could not parse grid price series: {e}')
+        return []
+    series.sort()
+    return series
+
+
+def _price_at(series: list, t: float) -> float:
+    """
+    :param series:  Sorted list of (unix timestamp of the period start, price)
+    :param t:       Unix timestamp
+    :return:        Price of the period containing t (first / last price outside of the series)
+    """
+    i = bisect.bisect_right(series, (t, float('inf')))
+    return series[max(0, i - 1)][1]
+
+
+class PriorityIndex:
+    """
+    Registered appliances ordered by priority. Kept sorted by bisection, so adding, updating and removing an appliance does not
+    require a re-sort. Appliances with the same priority keep their registration order. The iteration orders are cached until the
+    next change.
+    """
+    __slots__ = ('entries', 'keys', 'instances', 'sequence', 'descending_cache', 'ascending_cache')
+
+    def __init__(self):
+        # sorted list of (-priority, registration sequence, automation ID)
+        self.entries = []
+        # automation ID -> entry
+        self.keys = {}
+        # automation ID -> PVExcesscontrol Class instance
+        self.instances = {}
+        self.sequence = 0
+        self.descending_cache = None
+        self.ascending_cache = None
+
+    def set(self, automation_id: str, inst, priority: int):
+        """
+        Add an appliance or update its priority
+        :param automation_id:   Automation ID
+        :param inst:            PVExcesscontrol Class instance
+        :param priority:        Priority of the appliance
+        """
+        self.instances[automation_id] = inst
+        entry = self.keys.get(automation_id)
+        if entry is not None and entry[0] == -priority:
+            return
+        if entry is None:
+            self.sequence += 1
+            sequence = self.sequence
+        else:
+            sequence = entry[1]
+            self._remove_entry(entry)
+        entry = (-priority, sequence, automation_id)
+        bisect.insort(self.entries, entry)
+        self.keys[automation_id] = entry
+        self.descending_cache = None
+        self.ascending_cache = None
+
+    def remove(self, automation_id: str):
+        """
+        Remove an appliance (if registered)
+        :param automation_id:   Automation ID
+        """
+        entry = self.keys.pop(automation_id, None)
+        if entry is None:
+            return
+        self._remove_entry(entry)
+        del self.instances[automation_id]
+        self.descending_cache = None
+        self.ascending_cache = None
+
+    def _remove_entry(self, entry: tuple):
+        i = bisect.bisect_left(self.entries, entry)
+        del self.entries[i]
+
+    def descending(self) -> tuple:
+        """
+        :return:    Instances from highest to lowest priority. Not affected by later changes of the index.
+        """
+        if self.descending_cache is None:
+            self.descending_cache = tuple(self.instances[entry[2]] for entry in self.entries)
+        return self.descending_cache
+
+    def ascending(self) -> tuple:
+        """
+        :return:    Instances from lowest to highest priority. Not affected by later changes of the index.
+        """
+        if self.ascending_cache is None:
+            self.ascending_cache = tuple(reversed(self.descending()))
+        return self.ascending_cache
+
+
+class Hysteresis:
+    """
+    Switching state machine of one appliance (OFF <-> ON) against on/off cycling and current hunting. A transition is only allowed
+    after the minimum off-time / on-time in the current state. Current increases of dynamic current appliances are rate limited,
+    current changes within the deadband are suppressed. The thresholds for switching on/off are evaluated by the allocation engine
+    (see ApplianceDemand).
+    """
+    __slots__ = ('on_margin', 'off_threshold', 'min_on_time', 'min_off_time', 'rate_limit', 'deadband', 'is_on', 'since',
+                 'current_time')
+
+    def __init__(self):
+        self.configure()
+        # observed state and (monotonic) time of the last transition, None until known
+        self.is_on = None
+        self.since = None
+        # (monotonic) time of the last current change
+        self.current_time = None
+
+    def configure(self, on_margin: float = 0, off_threshold: float = -10, min_on_time: float = 0, min_off_time: float = 0,
+                  rate_limit: float = 0, deadband: float = 0.1):
+        """
+        :param on_margin:       Excess power in watts required in addition to the power of the appliance for switching on
+        :param off_threshold:   Excess power in watts below which the appliance is switched off (or reduced in current)
+        :param min_on_time:     Minimum on-time in minutes
+        :param min_off_time:    Minimum off-time in minutes
+        :param rate_limit:      Max. current increase in amperes per minute (0 = unlimited)
+        :param deadband:        Current changes smaller than the deadband (in amperes) are suppressed
+        """
+        self.on_margin = max(0.0, float(on_margin))
+        self.off_threshold = float(off_threshold)
+        self.min_on_time = max(0.0, float(min_on_time)) * 60
+        self.min_off_time = max(0.0, float(min_off_time)) * 60
+        self.rate_limit = max(0.0, float(rate_limit))
+        self.deadband = max(0.0, float(deadband))
+
+    def observe(self, is_on: bool, now: float):
+        """
+        Synchronize with the observed appliance state (e.g. if the appliance was switched manually)
+        :param is_on:   True if the appliance is switched on
+        :param now:     Current (monotonic) time in seconds
+        """
+        if is_on != self.is_on:
+            # the dwell time of the first observed state is unknown and regarded as over
+            self.since = None if self.is_on is None else now
+            self.is_on = is_on
+
+    def transition(self, is_on: bool, now: float):
+        """
+        Record a switching action
+        :param is_on:   True if the appliance was switched on
+        :param now:     Current (monotonic) time in seconds
+        """
+        self.is_on = is_on
+        self.since = now
+        self.current_time = now
+
+    def held(self, now: float) -> bool:
+        """
+        :param now: Current (monotonic) time in seconds
+        :return:    True if the minimum on-time / off-time in the current state is not reached yet
+        """
+        if self.since is None:
+            return False
+        return now - self.since < (self.min_on_time if self.is_on else self.min_off_time)
+
+    def limit_current(self, current: float, set_current: float, now: float) -> Union[float, None]:
+        """
+        Apply deadband and rate limit to a current change. Decreases are not rate limited, as they prevent grid import.
+        :param current:     Target current in amperes
+        :param set_current: Current setpoint in amperes
+        :param now:         Current (monotonic) time in seconds
+        :return:            Current to set, None if the change is suppressed
+        """
+        if round(abs(current - set_current), 1) < self.deadband:
+            return None
+        if self.rate_limit and current > set_current and self.current_time is not None:
+            max_increase = int(self.rate_limit * (now - self.current_time) / 6) / 10
+            if current - set_current > max_increase:
+                if max_increase < max(0.1, self.deadband):
+                    return None
+                current = round(set_current + max_increase, 1)
+        return current
+
+
+class PowerModel:
+    """
+    Learned power consumption of an appliance: streaming mean of the actual power samples per current setpoint. The weight of the
+    previous mean is capped, so the model follows slow changes (e.g. a car reducing its charging current). Unknown setpoints are
+    estimated from the learned power per ampere.
+    """
+    __slots__ = ('means', 'counts')
+    # max. weight of the previous mean (in samples)
+    max_count = 20
+    # min. number of samples before a mean is used
+    min_count = 3
+
+    def __init__(self):
+        # current setpoint in amperes -> mean power in watts / number of samples
+        self.means = {}
+        self.counts = {}
+
+    def add(self, setpoint: float, power: float):
+        """
+        :param setpoint:    Current setpoint in amperes (typical current for appliances without dynamic current control)
+        :param power:       Actual power in watts
+        """
+        setpoint = round(setpoint, 1)
+        count = min(self.counts.get(setpoint, 0) + 1, self.max_count)
+        mean = self.means.get(setpoint, power)
+        self.means[setpoint] = mean + (power - mean) / count
+        self.counts[setpoint] = count
+
+    def learned(self, setpoint: float) -> Union[float, None]:
+        """
+        :param setpoint:    Current setpoint in amperes
+        :return:            Learned power in watts, None if not enough samples are available
+        """
+        setpoint = round(setpoint, 1)
+        if self.counts.get(setpoint, 0) >= self.min_count:
+            return self.means[setpoint]
+        known = [s for s, count in self.counts.items() if count >= self.min_count and s > 0]
+        if not known:
+            return None
+        # the power is regarded as proportional to the current
+        return setpoint * sum(self.means[s] for s in known) / sum(known)
+
+    def power(self, setpoint: float, power_per_amp: float) -> float:
+        """
+        :param setpoint:        Current setpoint in amperes
+        :param power_per_amp:   Nominal power per ampere (grid voltage * phases)
+        :return:                Learned power in watts, nominal power if nothing has been learned yet
+        """
+        learned = self.learned(setpoint)
+        return setpoint * power_per_amp if learned is None else learned
+
+    def as_dict(self) -> dict:
+        """
+        :return:    JSON serializable state {setpoint: [mean, count]}
+        """
+        return {str(s): [round(self.means[s], 1), self.counts[s]] for s in self.means}
+
+    def load(self, data: dict):
+        """
+        :param data:    State as returned by as_dict
+        """
+        for s, (mean, count) in data.items():
+            self.means[float(s)] = float(mean)
+            self.counts[float(s)] = int(count)
+
+
+class DeadlinePlanner:
+    """
+    Plans a required daily run time (or energy) of an appliance, which has to be reached before a deadline. The time until the
+    deadline is divided into slots, rated by the expected grid import of the appliance (solar power forecast minus the estimated
+    load) times the grid price. The appliance has to run now, if the slots rated better than the current situation cannot cover
+    the remaining run time. Ties are broken in favor of later slots, so grid power is only used when the deadline would otherwise
+    be missed. A running appliance is only interrupted for slots rated clearly better, to avoid cycling.
+    The rated slots are kept sorted and only rebuilt if the deadline, the price series, the forecast, the load estimate or the power
+    of the appliance changed. Otherwise a control pass only walks the slots, which are rated better than the current situation.
+    """
+    __slots__ = ('run_time', 'energy', 'deadline', 'key', 'slots')
+    # slot width in seconds
+    slot_width = 900
+    # min. relative improvement of the rate, before a running appliance is interrupted in favor of later slots
+    keep_running = 0.1
+
+    def __init__(self):
+        self.run_time = 0
+        self.energy = 0
+        self.deadline = None
+        # inputs of the rated slots
+        self.key = None
+        # sorted list of (rate, -slot start)
+        self.slots = []
+
+    def configure(self, run_time: float = 0, energy: float = 0, deadline: Union[str, None] = None):
+        """
+        :param run_time:    Required daily run time in minutes (0 = disabled)
+        :param energy:      Required daily energy in kWh (0 = disabled)
+        :param deadline:    Time of day ("HH:MM[:SS]"), until which the run time / energy is required
+        """
+        self.run_time = max(0.0, float(run_time or 0)) * 60
+        self.energy = max(0.0, float(energy or 0))
+        self.deadline = None
+        if deadline:
+            try:
+                self.deadline = datetime.time.fromisoformat(str(deadline))
+            except ValueError as e:
+                log.error(f'Invalid run deadline "{deadline}": {e}')
+        self.key = None
+
+    def active(self) -> bool:
+        """
+        :return:    True if a deadline and a required run time or energy is configured
+        """
+        return self.deadline is not None and (self.run_time > 0 or self.energy > 0)
+
+    def deadline_at(self, now: datetime.datetime) -> float:
+        """
+        :param now: Current time
+        :return:    Unix timestamp of today's deadline
+        """
+        return datetime.datetime.combine(now.date(), self.deadline).timestamp()
+
+    def remaining(self, run_time: float, energy: float, power: float) -> float:
+        """
+        :param run_time:    Run time of today in seconds
+        :param energy:      Energy consumed today in kWh
+        :param power:       Power of the appliance in watts
+        :return:            Remaining required run time in seconds
+        """
+        remaining = self.run_time - run_time
+        if self.energy > 0 and power > 0:
+            remaining = max(remaining, (self.energy - energy) * 3.6e6 / power)
+        return max(0.0, remaining)
+
+    def update(self, now: float, deadline: float, remaining: float, power: float, excess: float, prices: list, forecast: list,
+               load: Union[float, None], running: bool = False) -> bool:
+        """
+        :param now:         Unix timestamp
+        :param deadline:    Unix timestamp of the deadline
+        :param remaining:   Remaining required run time in seconds
+        :param power:       Power of the appliance in watts
+        :param excess:      Current average excess power (without the appliance) in watts
+        :param prices:      Grid price series (see _parse_prices), empty if not available
+        :param forecast:    Solar power forecast series (see _parse_forecast), empty if not available
+        :param load:        Estimated load (without the appliance) in watts, None without forecast
+        :param running:     True if the appliance is running
+        :return:            True if the appliance has to run now
+        """
+        if remaining <= 0 or now >= deadline:
+            return False
+        key = (deadline, round(power, -1), load, prices, forecast)
+        if key != self.key:
+            self._rate(now, deadline, power, prices, forecast, load)
+            self.key = key
+        rate = self._rate_of(power, excess, prices, now)
+        covered = 0.0
+        for slot_rate, neg_start in self.slots:
+            if slot_rate > rate or (running and slot_rate >= rate * (1 - self.keep_running)):
+                break
+            start = -neg_start
+            if start <= now:
+                # current or elapsed slot
+                continue
+            covered += min(start + self.slot_width, deadline) - start
+            if covered >= remaining:
+                return False
+        return True
+
+    def _rate(self, now: float, deadline: float, power: float, prices: list, forecast: list, load: Union[float, None]):
+        """
+        Rate all slots until the deadline
+        """
+        slots = []
+        start = now - now % self.slot_width
+        while start < deadline:
+            middle = min(start + self.slot_width / 2, deadline)
+            excess = _forecast_power(forecast, middle) - load if forecast else 0.0
+            slots.append((self._rate_of(power, excess, prices, middle), -start))
+            start += self.slot_width
+        slots.sort()
+        self.slots = slots
+
+    @staticmethod
+    def _rate_of(power: float, excess: float, prices: list, t: float) -> float:
+        """
+        :return:    Grid import of the appliance times the grid price (1 without price series)
+        """
+        grid = max(0.0, power - max(0.0, excess))
+        return round(grid * (_price_at(prices, t) if prices else 1.0), 6)
+
+
+class BatteryModel:
+    """
+    Home battery as a flexibility resource of a controller group. Once per control pass, the battery level is turned into a
+    continuous power budget of the appliances:
+    - reserve: Power the appliances must leave to the battery, to reach the min. battery level at the end of the day. This is the
+      share of the current excess power, which corresponds to the energy still needed by the battery (including the charging
+      losses) relative to the remaining solar production forecast. All excess power is left to the battery if the forecast is
+      not sufficient.
+    - borrow: Power the appliances may draw from the battery above the discharge floor (only if the min. battery level is
+      reached). The usable energy (after the discharging losses) is spread evenly over the rest of the day.
+    Charging and discharging losses are each regarded as the square root of the round-trip efficiency.
+    """
+    __slots__ = ('capacity', 'min_level', 'floor', 'efficiency', 'reserve', 'borrow')
+    # offset in kWh, which is added to the energy needed by the battery to ensure an earlier charge
+    kwh_offset = 1
+    # min. time in hours, over which the usable energy is spread
+    min_hours = 1
+
+    def __init__(self):
+        self.capacity = 0.0
+        self.min_level = 100.0
+        self.floor = 100.0
+        self.efficiency = 1.0
+        # budget of the current control pass in watts
+        self.reserve = 0.0
+        self.borrow = 0.0
+
+    def configure(self, capacity: float, min_level: float, floor: float = 100, efficiency: float = 90):
+        """
+        :param capacity:    Capacity in kWh
+        :param min_level:   Min. battery level in %, which has to be reached at the end of the day
+        :param floor:       Battery level in %, down to which appliances may draw power from the battery (100 = disabled). Raised
+                             to the min. level, otherwise borrowing below the min. level would alternate with reserving.
+        :param efficiency:  Round-trip efficiency in %
+        """
+        self.capacity = max(0.0, float(capacity or 0))
+        self.min_level = float(min_level)
+        self.floor = min(100.0, max(0.0, self.min_level, float(100 if floor is None else floor)))
+        self.efficiency = min(100.0, max(1.0, float(efficiency or 100))) / 100
+
+    def update(self, level: float, remaining_forecast: float, excess: float, hours: float):
+        """
+        Calculate the budget of the current control pass
+        :param level:               Battery level in %
+        :param remaining_forecast:  Remaining solar production forecast of today in kWh
+        :param excess:              Current excess power (solar power - load power) in watts
+        :param hours:               Remaining hours of the day
+        """
+        one_way = self.efficiency ** 0.5
+        needed = max(0.0, self.min_level - level) / 100 * self.capacity / one_way
+        self.reserve = 0.0
+        self.borrow = 0.0
+        if level < self.min_level:
+            required = needed + self.kwh_offset
+            share = 1.0 if remaining_forecast <= required else required / remaining_forecast
+            self.reserve = share * max(0.0, excess)
+        elif level > self.floor:
+            usable = (level - self.floor) / 100 * self.capacity * one_way
+            self.borrow = usable * 1000 / max(self.min_hours, hours)
+
+    def excess(self, pv_excess: float, export: float) -> float:
+        """
+        :param pv_excess:   Average excess power (solar power - load power) in watts
+        :param export:      Average export power in watts
+        :return:            Excess power available to the appliances in watts. Exported power is not taken from the battery, as
+                             the battery cannot absorb it.
+        """
+        excess = pv_excess - self.reserve + self.borrow
+        if self.reserve > 0 and export > excess:
+            return export
+        return excess
+
+
+class ApplianceDemand:
+    """
+    State and constraints of one appliance within a control pass. Input of the allocation engine.
+    """
+    __slots__ = ('inst', 'key', 'priority', 'is_on', 'dynamic', 'power_per_amp', 'start_power', 'power', 'min_current',
+                 'max_current', 'set_current', 'avg_excess', 'window', 'can_switch', 'on_only', 'blocked', 'predicted_change',
+                 'on_margin', 'off_threshold', 'held', 'suppressed', 'single_phase', 'phase', 'phase_excess',
+                 'planned')
+
+    def __init__(self, inst, is_on: bool, power_per_amp: float, power: float, set_current: Union[float, None],
+                 avg_excess: float, window: int, can_switch: bool, predicted_change: float = 0, held: bool = False,
+                 phase_excess: Union[list, None] = None):
+        """
+        :param inst:            PVExcesscontrol Class instance
+        :param is_on:           True if the appliance is currently switched on
+        :param power_per_amp:   Power in watts per ampere (grid voltage * phases)
+        :param power:           Current power consumption in watts (0 if switched off)
+        :param set_current:     Current setpoint of a dynamic current appliance in amperes
+        :param avg_excess:      Average excess power within the switch interval of the appliance in watts
+        :param window:          Switch interval of the appliance in history buckets
+        :param can_switch:      True if the switch interval of the appliance is reached
+        :param predicted_change: Predicted drop of the excess power (<= 0) in watts, regarded for switching on
+        :param held:            True if the min. on-time / off-time of the appliance is not reached (see Hysteresis)
+        :param phase_excess:    Average excess power per phase within the switch interval in watts (None without per-phase
+                                 sensors)
+        """
+        config = inst.config
+        self.inst = inst
+        self.key = inst.automation_id
+        self.priority = config.appliance_priority
+        self.is_on = is_on
+        self.dynamic = config.dynamic_current_appliance
+        self.power_per_amp = power_per_amp
+        self.start_power = inst.power_model.power(config.defined_current, power_per_amp)
+        self.power = power
+        self.min_current = config.min_current
+        self.max_current = config.max_current
+        self.set_current = set_current
+        self.avg_excess = avg_excess
+        self.window = window
+        self.can_switch = can_switch
+        self.on_only = config.appliance_on_only
+        # "Only-Run-Once-Appliance" which already ran today
+        self.blocked = config.appliance_once_only and inst.switched_on_today
+        self.predicted_change = predicted_change
+        self.on_margin = inst.hysteresis.on_margin
+        self.off_threshold = inst.hysteresis.off_threshold
+        self.held = held
+        # switching action held back by the hysteresis, set by the allocation engine
+        self.suppressed = None
+        self.single_phase = config.phases == 1
+        # phase of a single-phase appliance (index, None if not assigned yet), assigned by the PhaseAllocator
+        self.phase = inst.phase_index
+        self.phase_excess = phase_excess
+        # True if the appliance has to run now to meet its deadline (see DeadlinePlanner)
+        self.planned = False
+
+
+class GreedyAllocator:
+    """
+    Priority based allocation (default).
+    Appliances are switched on or increased in current from highest to lowest priority, and switched off or reduced in current from
+    lowest to highest priority, until the average excess power is no longer below the switch-off threshold of the appliance.
+    """
+
+    def allocate(self, demands: list, min_excess_power: float) -> dict:
+        """
+        :param demands:             List of ApplianceDemand, sorted from highest to lowest priority
+        :param min_excess_power:    Minimum excess power in watts
+        :return:                    Dict of target states: key -> (on, current). current is None for non-dynamic appliances.
+        """
+        targets = {d.key: (d.is_on, d.set_current) for d in demands}
+        # power assigned to appliances within this pass
+        allocated = 0
+        for d in demands:
+            avg_excess_power = d.avg_excess - allocated
+            if d.is_on:
+                if d.dynamic and avg_excess_power >= min_excess_power:
+                    # increase dynamic current, because excess solar power is available
+                    excess_amps = round(avg_excess_power / d.power_per_amp, 1) + d.set_current
+                    amps = max(d.min_current, min(excess_amps, d.max_current))
+                    if amps > (d.set_current + 0.09):
+                        targets[d.key] = (True, amps)
+                        allocated += (amps - d.set_current) * d.power_per_amp
+            elif not d.blocked and d.can_switch:
+                # appliances are not switched on ahead of a predicted drop of the excess power
+                avg_excess_power += d.predicted_change - d.on_margin
+                if avg_excess_power >= d.start_power or (d.priority > 1000 and avg_excess_power > 0):
+                    if d.held:
+                        d.suppressed = 'switch_on'
+                        continue
+                    targets[d.key] = (True, d.min_current if d.dynamic else None)
+                    allocated += d.start_power
+
+        # power released by appliances which were switched off or reduced in current within this pass
+        released = 0
+        for d in reversed(demands):
+            if not d.is_on:
+                continue
+            avg_excess_power = d.avg_excess - allocated + released
+            # appliances with priority > 1000 stay on as long as they get any excess power
+            allowed_excess_power_consumption = d.power if d.priority > 1000 else 0
+            if avg_excess_power >= d.off_threshold - allowed_excess_power_consumption:
+                continue
+            if d.dynamic:
+                actual_current = round(d.power / d.power_per_amp, 1)
+                target_current = max(d.min_current, actual_current + round(avg_excess_power / d.power_per_amp, 1))
+                if d.min_current < target_current < actual_current:
+                    targets[d.key] = (True, target_current)
+                    released += (actual_current - target_current) * d.power_per_amp
+                    continue
+            if d.can_switch and not d.on_only:
+                if d.held:
+                    d.suppressed = 'switch_off'
+                    continue
+                targets[d.key] = (False, None)
+                released += d.power
+        return targets
+
+
+class OptimalAllocator:
+    """
+    Global allocation maximizing self-consumption.
+    The available power is the excess power plus the consumption of all running appliances. Appliances with priority > 1000 are
+    served first. The on/off decisions of all other appliances are solved as a 0/1 knapsack, taking into account how much power the
+    dynamic current appliances can absorb. Afterwards, the remaining power is distributed to the dynamic current appliances by
+    water-filling. Running appliances are kept on while the excess power is above their (lower) switch-off threshold or while their
+    min. on-time is not reached.
+    """
+    # Min. gain of self-consumption in watts, before an appliance is switched on in favor of the current allocation
+    switch_penalty = 100
+    # Max. number of dynamic current appliances, for which all on/off combinations are evaluated
+    max_dynamic_combinations = 6
+
+    def allocate(self, demands: list, min_excess_power: float) -> dict:
+        """
+        :param demands:             List of ApplianceDemand, sorted from highest to lowest priority
+        :param min_excess_power:    Minimum excess power in watts
+        :return:                    Dict of target states: key -> (on, current). current is None for non-dynamic appliances.
+        """
+        targets = {d.key: (False, None) for d in demands}
+        if not demands:
+            return targets
+        # the most responsive averaging window defines the available power
+        excess = min(demands, key=lambda d: d.window).avg_excess
+        budget = excess - min_excess_power + sum(d.power for d in demands if d.is_on)
+        sheddable = sum(d.power for d in demands if d.is_on and d.can_switch and not d.on_only and not d.held)
+
+        filled = []
+        candidates = []
+        for d in demands:
+            weight = d.min_current * d.power_per_amp if d.dynamic else (d.power if d.is_on else d.start_power)
+            tolerated = d.off_threshold <= d.avg_excess < min_excess_power
+            if d.is_on and (d.on_only or not d.can_switch or d.held or tolerated):
+                # has to stay on
+                if d.held and d.can_switch and not d.on_only and d.avg_excess < min(min_excess_power, d.off_threshold):
+                    d.suppressed = 'switch_off'
+                targets[d.key] = (True, d.set_current)
+                budget -= weight
+                if d.dynamic:
+                    filled.append(d)
+            elif d.is_on:
+                candidates.append((d, weight))
+            elif not d.blocked and d.can_switch:
+                # only switch on if the excess power was sufficient within the whole switch interval of the appliance
+                own_budget = d.avg_excess + d.predicted_change - d.on_margin - min_excess_power + sheddable
+                if own_budget >= d.start_power or (d.priority > 1000 and own_budget > 0):
+                    if d.held:
+                        d.suppressed = 'switch_on'
+                    else:
+                        candidates.append((d, weight))
+
+        # appliances with priority > 1000 are switched on, even if the excess power is not sufficient for 100% of the needed power
+        items = []
+        for d, weight in candidates:
+            if d.priority <= 1000:
+                items.append((d, weight))
+            elif budget > 0:
+                targets[d.key] = (True, d.set_current)
+                budget = max(0, budget - weight)
+                if d.dynamic:
+                    filled.append(d)
+
+        if items and budget > 0:
+            for d, weight in self._select(items, filled, budget):
+                targets[d.key] = (True, d.set_current)
+                budget -= weight
+                if d.dynamic:
+                    filled.append(d)
+
+        if filled:
+            # distribute the remaining power to the dynamic current appliances
+            budget += sum(d.min_current * d.power_per_amp for d in filled)
+            currents = _water_fill([d.min_current for d in filled], [d.max_current for d in filled],
+                                   [d.power_per_amp for d in filled], budget)
+            for d, current in zip(filled, currents):
+                targets[d.key] = (True, current)
+        return targets
+
+    def _select(self, items: list, filled: list, budget: float) -> list:
+        """
+        Select the appliances to switch on (or keep on) with max. self-consumption
+        :param items:   List of (ApplianceDemand, weight) candidates
+        :param filled:  Dynamic current appliances which are already on
+        :param budget:  Available power in watts
+        :return:        List of selected (ApplianceDemand, weight)
+        """
+        # resolution of at least 10W and max. 500 cells
+        resolution = max(10.0, budget / 500)
+        capacity = int(budget / resolution)
+        # switching on costs a penalty to avoid switching for marginal gains, ties are broken by priority
+        n = len(items)
+        bonuses = [(0 if d.is_on else -self.switch_penalty / resolution) + 0.5 * (n - i) / (n * n) for i, (d, weight) in
+                   enumerate(items)]
+        weights = [int(-(-weight // resolution)) for d, weight in items]
+        # power (in cells), which can be absorbed by dynamic current appliances above their min. current
+        absorbable = [int((d.max_current - d.min_current) * d.power_per_amp / resolution) if d.dynamic else 0
+                      for d, weight in items]
+        absorbable_filled = sum(int((d.max_current - d.min_current) * d.power_per_amp / resolution) for d in filled)
+
+        dynamic = [i for i in range(n) if items[i][0].dynamic]
+        fixed = [i for i in range(n) if not items[i][0].dynamic]
+        if len(dynamic) <= self.max_dynamic_combinations:
+            combinations = [[dynamic[j] for j in range(len(dynamic)) if mask & (1 << j)] for mask in range(1 << len(dynamic))]
+        else:
+            combinations = [dynamic[:k] for k in range(len(dynamic) + 1)]
+
+        best_value = None
+        best_selection = []
+        for combination in combinations:
+            used = sum(weights[i] for i in combination)
+            if used > capacity:
+                continue
+            value, selection = _knapsack([weights[i] for i in fixed], [bonuses[i] for i in fixed], capacity - used,
+                                         absorbable_filled + sum(absorbable[i] for i in combination))
+            value += used + sum(bonuses[i] for i in combination)
+            if best_value is None or value > best_value:
+                best_value = value
+                best_selection = combination + [fixed[i] for i in selection]
+        return [items[i] for i in best_selection]
+
+
+@pyscript_compile
+def _knapsack(weights: list, bonuses: list, capacity: int, absorbable: int) -> tuple:
+    """
+    0/1 knapsack solved by dynamic programming. The value of a selection is the power it consumes (including the power which can
+    additionally be absorbed by dynamic current appliances, bounded by the capacity) plus the bonuses of the selected items.
+    :param weights:     Integer weights of the items
+    :param bonuses:     Bonus of each item
+    :param capacity:    Integer capacity
+    :param absorbable:  Weight, which can additionally be absorbed by dynamic current appliances
+    :return:            Tuple (value, indices of the selected items)
+    """
+    # best[c] = max. bonus of a selection with a total weight of exactly c
+    best = [0.0] + [None] * capacity
+    keep = []
+    for w, b in zip(weights, bonuses):
+        row = [False] * (capacity + 1)
+        for c in range(capacity, w - 1, -1):
+            if best[c - w] is not None and (best[c] is None or best[c - w] + b > best[c]):
+                best[c] = best[c - w] + b
+                row[c] = True
+        keep.append(row)
+    value, c = max((min(capacity, c + absorbable) + best[c], c) for c in range(capacity + 1) if best[c] is not None)
+    selected = []
+    for i in range(len(weights) - 1, -1, -1):
+        if keep[i][c]:
+            selected.append(i)
+            c -= weights[i]
+    return value, selected
+
+
+@pyscript_compile
+def _water_fill(min_currents: list, max_currents: list, power_per_amp: list, power: float) -> list:
+    """
+    Distribute power among dynamic current appliances by raising a common current level
+    :param min_currents:    Minimum current of each appliance
+    :param max_currents:    Maximum current of each appliance
+    :param power_per_amp:   Power per ampere of each appliance
+    :param power:           Power to distribute in watts (including the minimum power of all appliances)
+    :return:                Current of each appliance (rounded down to 0.1A)
+    """
+    def currents(level):
+        return [min(max(level, mn), mx) for mn, mx in zip(min_currents, max_currents)]
+
+    def used(level):
+        return sum(c * p for c, p in zip(currents(level), power_per_amp))
+
+    lo = min(min_currents)
+    hi = max(max_currents)
+    if used(hi) <= power:
+        return list(max_currents)
+    for _ in range(50):
+        mid = (lo + hi) / 2
+        if used(mid) <= power:
+            lo = mid
+        else:
+            hi = mid
+    return [max(mn, int(c * 10 + 1e-6) / 10) for c, mn in zip(currents(lo), min_currents)]
+
+
+class PhaseAllocator:
+    """
+    Phase-aware allocation for controller groups with per-phase import/export power sensors. The target states of the wrapped
+    allocation engine are checked against the excess power of each phase:
+     - single-phase appliances without a fixed phase are assigned to the phase with the most excess power when switched on
+     - switching on and current increases are capped by the excess power of the affected phases. If a switch-on is rejected, the
+       wrapped allocation engine is called again without the rejected appliance, so it can choose other appliances.
+     - appliances on a phase with a deficit are reduced in current / switched off from lowest to highest priority
+    """
+    def __init__(self, allocator):
+        """
+        :param allocator:   Wrapped allocation engine (see ALLOCATORS)
+        """
+        self.allocator = allocator
+
+    def allocate(self, demands: list, min_excess_power: float) -> dict:
+        """
+        :param demands:             List of ApplianceDemand, sorted from highest to lowest priority
+        :param min_excess_power:    Minimum excess power in watts
+        :return:                    Dict of target states: key -> (on, current). current is None for non-dynamic appliances.
+        """
+        if not demands or demands[0].phase_excess is None:
+            return self.allocator.allocate(demands, min_excess_power)
+        blocked = [d.blocked for d in demands]
+        for _ in range(len(demands)):
+            targets = self.allocator.allocate(demands, min_excess_power)
+            rejected = self._apply_phases(demands, targets, min_excess_power)
+            if not rejected:
+                break
+            # treat the rejected appliances as blocked within this pass
+            for d in rejected:
+                d.blocked = True
+        for d, was_blocked in zip(demands, blocked):
+            d.blocked = was_blocked
+        return targets
+
+    def _apply_phases(self, demands: list, targets: dict, min_excess_power: float) -> list:
+        """
+        Check the target states against the excess power of each phase
+        :param demands:             List of ApplianceDemand, sorted from highest to lowest priority
+        :param targets:             Target states of the wrapped allocation engine, changed in place
+        :param min_excess_power:    Minimum excess power in watts
+        :return:                    List of ApplianceDemand, whose switch-on was rejected
+        """
+        n = len(demands[0].phase_excess)
+        rejected = []
+        for d in demands:
+            if d.is_on and d.phase is None and d.single_phase:
+                # running appliance with unknown phase
+                d.phase = max(range(n), key=lambda i: d.phase_excess[i])
+        # power change per phase within this pass. Released power is available to all appliances.
+        used = [0.0] * n
+        for d in demands:
+            delta = self._delta(d, targets[d.key])
+            if delta < 0:
+                self._add(used, d, delta, n)
+
+        for d in demands:
+            on, current = targets[d.key]
+            delta = self._delta(d, targets[d.key])
+            if delta <= 0:
+                continue
+            if not d.is_on and d.phase is None and d.single_phase:
+                d.phase = max(range(n), key=lambda i: d.phase_excess[i] - used[i])
+            margin = 0 if d.is_on else d.on_margin
+            # max. power increase fitting into all affected phases
+            allowed = min((d.phase_excess[i] - used[i] - min_excess_power - margin) / share
+                          for i, share in enumerate(self._shares(d, n)) if share > 0)
+            if delta <= allowed or (d.priority > 1000 and allowed > 0):
+                self._add(used, d, delta, n)
+            elif d.is_on:
+                # capped current increase
+                increase = int(max(0.0, allowed) / d.power_per_amp * 10) / 10
+                if increase >= 0.1:
+                    targets[d.key] = (True, round(d.set_current + increase, 1))
+                    self._add(used, d, increase * d.power_per_amp, n)
+                else:
+                    targets[d.key] = (True, d.set_current)
+            else:
+                targets[d.key] = (False, None)
+                rejected.append(d)
+                if d.inst.config.appliance_phase is None:
+                    d.phase = None
+
+        for d in reversed(demands):
+            on, current = targets[d.key]
+            if not (on and d.is_on):
+                continue
+            shares = self._shares(d, n)
+            deficit = max((d.off_threshold - (d.phase_excess[i] - used[i])) / share for i, share in enumerate(shares) if share > 0)
+            if deficit <= 0:
+                continue
+            if d.dynamic and current is not None and current > d.min_current:
+                target_current = round(max(d.min_current, current + (-deficit * 10 // d.power_per_amp) / 10), 1)
+                targets[d.key] = (True, target_current)
+                self._add(used, d, -(current - target_current) * d.power_per_amp, n)
+                deficit -= (current - target_current) * d.power_per_amp
+                current = target_current
+                if deficit <= 0:
+                    continue
+            if d.can_switch and not d.on_only and not d.held:
+                targets[d.key] = (False, None)
+                self._add(used, d, -(d.power + self._delta(d, (True, current))), n)
+        return rejected
+
+    @staticmethod
+    def _delta(d, target: tuple) -> float:
+        """
+        :param d:       Appliance demand
+        :param target:  Target state (on, current)
+        :return:        Change of the power consumption in watts
+        """
+        on, current = target
+        if on and not d.is_on:
+            return max(d.start_power, current * d.power_per_amp) if d.dynamic and current is not None else d.start_power
+        if not on and d.is_on:
+            return -d.power
+        if on and d.dynamic and current is not None and d.set_current is not None:
+            return (current - d.set_current) * d.power_per_amp
+        return 0.0
+
+    @staticmethod
+    def _shares(d, n: int) -> list:
+        """
+        :param d:   Appliance demand
+        :param n:   Number of phases
+        :return:    Share of the power consumption per phase
+        """
+        if d.single_phase and d.phase is not None:
+            return [1.0 if i == d.phase else 0.0 for i in range(n)]
+        return [1.0 / n] * n
+
+    def _add(self, used: list, d, power: float, n: int):
+        """
+        Account a power change to the affected phases
+        :param used:    Power change per phase
+        :param d:       Appliance demand
+        :param power:   Power change in watts
+        :param n:       Number of phases
+        """
+        for i, share in enumerate(self._shares(d, n)):
+            used[i] += share * power
+
+
+# Available allocation strategies
+ALLOCATORS = {'greedy': GreedyAllocator, 'optimal': OptimalAllocator}
+
+
+@pyscript_compile
+def _write_json_atomic(path: str, data: dict):
+    """
+    Write data to a JSON file. The file is replaced atomically, so it is never left half-written.
+    Blocking, must be executed via task.executor.
+    :param path:    File path
+    :param data:    JSON serializable data
+    """
+    import json
+    import os
+    import tempfile
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@pyscript_compile
+def _read_json(path: str) -> Union[dict, None]:
+    """
+    Read a JSON file. Blocking, must be executed via task.executor.
+    :param path:    File path
+    :return:        Data, None if the file does not exist
+    """
+    import json
+    import os
+
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+# Statistics store: tables of the minute samples and the hour / day rollups (resolution -> table)
+STATISTICS_TABLES = {'minute': 'stats_minute', 'hour': 'stats_hour', 'day': 'stats_day'}
+
+
+@pyscript_compile
+def _statistics_write(path: str, rows: list, tables: list, retention: dict):
+    """
+    Write samples to the SQLite statistics store. Each sample is added to its minute and to the hour / day rollups, so queries never
+    have to aggregate raw samples. Blocking, must be executed via task.executor.
+    Each table row holds the sums of the values a and b and the number of samples n of one series within one period:
+     - controller group ("group.<group ID>"): a = excess energy (PV power - load power) in Wh, b = export energy in Wh
+     - appliance (automation ID): a = energy in Wh, b = run time in s
+    :param path:        Database file path
+    :param rows:        List of (unix timestamp, series name, a, b)
+    :param tables:      Tables of the minute, hour and day resolution (see STATISTICS_TABLES)
+    :param retention:   Unix timestamp per table, before which rows are deleted (and their pages released). Empty to skip the
+                         compaction.
+    """
+    import sqlite3
+    import time
+
+    def period_starts(ts):
+        t = time.localtime(ts)
+        ts = int(ts) - t.tm_sec
+        return ts, ts - t.tm_min * 60, ts - t.tm_min * 60 - t.tm_hour * 3600
+
+    con = sqlite3.connect(path)
+    try:
+        # only effective for a new database, free pages are released by incremental_vacuum after the compaction
+        con.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        con.execute('CREATE TABLE IF NOT EXISTS stats_series (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+        for table in tables:
+            con.execute(f'CREATE TABLE IF NOT EXISTS {table} (ts INTEGER NOT NULL, series INTEGER NOT NULL, a REAL NOT NULL, '
+                        f'b REAL NOT NULL, n INTEGER NOT NULL, PRIMARY KEY (ts, series)) WITHOUT ROWID')
+        ids = {}
+        for name in set(row[1] for row in rows):
+            con.execute('INSERT OR IGNORE INTO stats_series (name) VALUES (?)', (name,))
+            ids[name] = con.execute('SELECT id FROM stats_series WHERE name = ?', (name,)).fetchone()[0]
+        starts = [period_starts(ts) for ts, name, a, b in rows]
+        for i, table in enumerate(tables):
+            con.executemany(f'INSERT INTO {table} VALUES (?, ?, ?, ?, 1) ON CONFLICT (ts, series) DO UPDATE SET '
+                            f'a = a + excluded.a, b = b + excluded.b, n = n + 1',
+                            [(start[i], ids[name], a, b) for start, (ts, name, a, b) in zip(starts, rows)])
+        for table, cutoff in retention.items():
+            con.execute(f'DELETE FROM {table} WHERE ts < ?', (int(cutoff),))
+        con.commit()
+        if retention:
+            con.execute('PRAGMA incremental_vacuum')
+    finally:
+        con.close()
+
+
+@pyscript_compile
+def _statistics_query(path: str, table: str, start: float, end: float, series: list, total: bool) -> list:
+    """
+    Query the statistics store. Blocking, must be executed via task.executor.
+    :param path:        Database file path
+    :param table:       Table of the resolution (see STATISTICS_TABLES)
+    :param start:       Unix timestamp (including)
+    :param end:         Unix timestamp (excluding)
+    :param series:      Series names, empty for all series
+    :param total:       Sum up the whole time range instead of returning each period
+    :return:            List of (series name, period start, a, b, n), see _statistics_write
+    """
+    import os
+    import sqlite3
+
+    if not os.path.exists(path):
+        return []
+    condition = f' AND s.name IN ({", ".join("?" * len(series))})' if series else ''
+    if total:
+        sql = (f'SELECT s.name, MIN(t.ts), SUM(t.a), SUM(t.b), SUM(t.n) FROM {table} t JOIN stats_series s ON s.id = t.series '
+               f'WHERE t.ts >= ? AND t.ts < ?{condition} GROUP BY s.name ORDER BY s.name')
+    else:
+        sql = (f'SELECT s.name, t.ts, t.a, t.b, t.n FROM {table} t JOIN stats_series s ON s.id = t.series '
+               f'WHERE t.ts >= ? AND t.ts < ?{condition} ORDER BY s.name, t.ts')
+    con = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        return con.execute(sql, [int(start), int(end)] + list(series)).fetchall()
+    except sqlite3.OperationalError:
+        # no statistics written yet
+        return []
+    finally:
+        con.close()
+
+
+# Controller group of appliances registered without a group ID
+DEFAULT_GROUP = 'default'
+
+# Validated configuration of an appliance, compiled once on registration (see _compile_appliance_config). Immutable, a changed
+#  configuration is compiled into a new object. Besides the service parameters it holds the derived constants used each tick:
+#  the entity domains, the power per ampere (grid voltage * phases) and the power at the typical current draw.
+ApplianceConfig = namedtuple('ApplianceConfig', (
+    'automation_id', 'appliance_priority', 'appliance_switch', 'switch_domain', 'appliance_switch_interval',
+    'dynamic_current_appliance', 'appliance_current_set_entity', 'current_set_domain', 'actual_power', 'min_current',
+    'max_current', 'defined_current', 'phases', 'appliance_phase', 'appliance_on_only', 'appliance_once_only', 'grid_voltage',
+    'power_per_amp', 'defined_power', 'log_prefix'))
+
+
+def _entity_domain(entity_id) -> Union[str, None]:
+    """
+    :param entity_id:   Entity ID
+    :return:            Domain of the entity, None if the entity ID is not of the form "domain.object_id"
+    """
+    if not isinstance(entity_id, str) or entity_id.count('.') != 1 or ' ' in entity_id:
+        return None
+    domain, object_id = entity_id.split('.')
+    return domain if domain and object_id else None
+
+
+def _compile_appliance_config(automation_id, appliance_priority, appliance_switch, appliance_switch_interval,
+                              dynamic_current_appliance, appliance_current_set_entity, actual_power, min_current, max_current,
+                              defined_current, appliance_phases, appliance_phase, appliance_on_only, appliance_once_only,
+                              grid_voltage) -> Union[ApplianceConfig, None]:
+    """
+    Validate the service parameters of an appliance and compile them into an appliance configuration
+    :return:    Appliance configuration, None if the parameters are not valid (the errors are logged)
+    """
+    errors = []
+    switch_domain = _entity_domain(appliance_switch)
+    if switch_domain is None:
+        errors.append(f'Appliance switch "{appliance_switch}" is not a valid entity ID.')
+    dynamic_current_appliance = bool(dynamic_current_appliance)
+    appliance_current_set_entity = appliance_current_set_entity or None
+    current_set_domain = None
+    if appliance_current_set_entity is not None:
+        current_set_domain = _entity_domain(appliance_current_set_entity)
+        if current_set_domain is None:
+            errors.append(f'SetCurrent entity "{appliance_current_set_entity}" is not a valid entity ID.')
+    elif dynamic_current_appliance:
+        errors.append('Dynamic current control requires a SetCurrent entity.')
+    actual_power = actual_power or None
+    if actual_power is not None and _entity_domain(actual_power) is None:
+        errors.append(f'Actual power sensor "{actual_power}" is not a valid entity ID.')
+    try:
+        appliance_priority = int(appliance_priority)
+        appliance_switch_interval = int(appliance_switch_interval)
+        phases = int(appliance_phases)
+        min_current = float(min_current)
+        max_current = float(max_current)
+        defined_current = float(defined_current)
+        grid_voltage = float(grid_voltage)
+    except (TypeError, ValueError) as e:
+        errors.append(f'Invalid number: {e}')
+    else:
+        if appliance_switch_interval < 1:
+            errors.append(f'Appliance switch interval ({appliance_switch_interval} min) must be at least 1 minute.')
+        if not 1 <= phases <= 3:
+            errors.append(f'Number of appliance phases ({phases}) must be between 1 and 3.')
+        if grid_voltage <= 0:
+            errors.append(f'Grid voltage ({grid_voltage} V) must be positive.')
+        if defined_current < 0:
+            errors.append(f'Typical current draw ({defined_current} A) must not be negative.')
+        if dynamic_current_appliance and not 0 < min_current <= max_current:
+            errors.append(f'Min. current ({min_current} A) must be positive and not greater than the max. current '
+                          f'({max_current} A).')
+    # fixed phase (index) of a single-phase appliance, None to assign it automatically
+    phase_index = None
+    if appliance_phase in ('L1', 'L2', 'L3'):
+        phase_index = int(appliance_phase[1]) - 1
+    elif appliance_phase not in (None, 'auto'):
+        errors.append(f'Appliance phase "{appliance_phase}" not supported.')
+
+    log_prefix = f'[{appliance_switch} {automation_id} (Prio {appliance_priority})]'
+    if errors:
+        log.error(f'{log_prefix} Invalid configuration: {" ".join(errors)}')
+        return None
+    power_per_amp = grid_voltage * phases
+    return ApplianceConfig(automation_id, appliance_priority, appliance_switch, switch_domain, appliance_switch_interval,
+                           dynamic_current_appliance, appliance_current_set_entity, current_set_domain, actual_power,
+                           min_current, max_current, defined_current, phases, phase_index, bool(appliance_on_only),
+                           bool(appliance_once_only), grid_voltage, power_per_amp, defined_current * power_per_amp, log_prefix)
+
+
+def _check_controller_config(log_prefix: str, numbers: tuple) -> bool:
+    """
+    Validate the numeric controller, group and appliance behaviour parameters of a registration, before any of them is applied
+    :param log_prefix:  Log prefix of the appliance
+    :param numbers:     Tuples (name, value, type (int or float), True if the value is optional)
+    :return:            True if all values can be converted, False otherwise (the errors are logged)
+    """
+    errors = []
+    for name, value, number_type, optional in numbers:
+        if optional and value in (None, ''):
+            continue
+        try:
+            number_type(value)
+        except (TypeError, ValueError):
+            errors.append(f'"{name}" ({value}) is not a valid number.')
+    if errors:
+        log.error(f'{log_prefix} Invalid configuration: {" ".join(errors)}')
+        return False
+    return True
+
+
+class ControllerGroup:
+    """
+    One PV system (inverter / meter) with its own sensors, Export/PV histories and appliances. Appliances are assigned to a group
+    by the group ID of their automation, all groups are evaluated by the single scheduler.
+    """
+    def __init__(self, group_id: str, capacity: int, bucket_width: float):
+        """
+        :param group_id:        Group ID
+        :param capacity:        Number of history buckets
+        :param bucket_width:    Width of one history bucket in seconds
+        """
+        self.group_id = group_id
+        self.log_prefix = f'[Group {group_id}]'
+        # sensor configuration, see PvExcessControl.__init__
+        self.export_power = None
+        self.pv_power = None
+        self.load_power = None
+        self.home_battery_level = None
+        self.import_export_power = None
+        self.solar_production_forecast = None
+        # battery power sensor (positive while charging), needed with a combined import/export power sensor
+        self.battery_power = None
+        self.battery = BatteryModel()
+        self.health = SensorHealth()
+        # per-phase import/export power sensors (L1, L2, L3), empty if not available
+        self.phase_power = []
+        # Prediction: solar power forecast series (entity with 'watts' or 'detailedForecast' attribute) and the prediction of the
+        #  excess power prediction_horizon minutes ahead (0 = disabled). Appliances are not switched on ahead of a predicted drop.
+        self.solar_power_forecast = None
+        self.prediction_horizon = 0
+        self.predicted_change = 0
+        # dynamic grid price sensor (entity with Tibber or Nordpool price series), used by the deadline planner
+        self.price_sensor = None
+        # Order of the appliances of this group
+        self.priority_index = PriorityIndex()
+        # Allocation engine deciding the target state of the appliances (see ALLOCATORS)
+        self.allocator = GreedyAllocator()
+        # Event-driven sampling: latest valid sensor values and the current (export, excess) sample with its start time
+        self.sensor_values = {}
+        self.event_sample = None
+        self.event_sample_time = None
+        self.configure_history(capacity, bucket_width)
+
+    def configure_history(self, capacity: int, bucket_width: float):
+        """
+        Create empty histories
+        :param capacity:        Number of history buckets
+        :param bucket_width:    Width of one history bucket in seconds
+        """
+        # Exported Power history (bucket averages). Samples are bounded to 0, as export power cannot be negative.
+        self.export_history = RingBuffer(capacity, floor=0)
+        self.export_bucket = BucketStats()
+        # PV Excess history (PV power minus load power)
+        self.pv_history = RingBuffer(capacity)
+        self.pv_bucket = BucketStats()
+        self.predictor = ExcessPredictor(bucket_width)
+        self.configure_phases(self.phase_power, capacity)
+
+    def configure_phases(self, phase_power: list, capacity: int):
+        """
+        Set the per-phase import/export power sensors and create an empty per-phase history
+        :param phase_power: Per-phase import/export power sensors
+        :param capacity:    Number of history buckets
+        """
+        self.phase_power = phase_power
+        # Per-phase excess history (negative import/export power per phase), None without per-phase sensors
+        self.phase_history = MultiRingBuffer(capacity, len(phase_power)) if phase_power else None
+        # current bucket: weighted sums and total weight of the per-phase samples, latest event-driven sample
+        self.phase_bucket = [0.0] * len(phase_power)
+        self.phase_bucket_weight = 0.0
+        self.phase_sample = None
+
+    def add_phase_sample(self, sample: list, weight: float = 1):
+        """
+        Add a per-phase sample to the current bucket
+        :param sample:  Excess power per phase in watts
+        :param weight:  Weight of the sample (e.g. its duration)
+        """
+        for i, value in enumerate(sample):
+            self.phase_bucket[i] += value * weight
+        self.phase_bucket_weight += weight
+
+
+@time_trigger("cron(0 0 * * *)")
+def reset_midnight():
+    PvExcessControl.post(PvExcessControl._reset_daily)
+
+
+def _scheduler_factory(sampling_period: int):
+    """
+    Creates the single scheduler for all registered appliances. The scheduler samples the power sensors every sampling period and
+    runs the control pass each time a history bucket is completed.
+    :param sampling_period: Sampling period in seconds
+    :return:                Trigger function (must be referenced to stay active)
+    """
+    @time_trigger(f'period(now, {sampling_period}s)')
+    def pv_excess_control_tick():
+        PvExcessControl.on_time()
+
+    return pv_excess_control_tick
+
+
+def _sensor_trigger_factory(entity_ids: list):
+    """
+    Creates a state trigger for event-driven sampling of the power sensors
+    :param entity_ids:  Power sensor entity IDs
+    :return:            Trigger function (must be referenced to stay active)
+    """
+    @state_trigger(*entity_ids)
+    def pv_excess_control_sensor_change(var_name=None, value=None):
+        PvExcessControl._on_sensor_change(var_name, value)
+
+    return pv_excess_control_sensor_change
+
+
+@service
+def pv_excess_control(automation_id, appliance_priority, export_power, pv_power, load_power, home_battery_level,
+                      min_home_battery_level, dynamic_current_appliance, appliance_phases, min_current,
+                      max_current, appliance_switch, appliance_switch_interval, appliance_current_set_entity,
+                      actual_power, defined_current, appliance_on_only, grid_voltage, import_export_power,
+                      home_battery_capacity, solar_production_forecast, appliance_once_only, sampling_period=10,
+                      history_bucket_width=60, history_horizon=60, sampling_mode='polling', actuation_settle_delay=1,
+                      allocation_strategy='greedy', state_file=None, solar_power_forecast=None, prediction_horizon=0,
+                      diagnostic_sensors=False, group_id=DEFAULT_GROUP, switch_on_margin=0, switch_off_threshold=-10,
+                      min_on_time=0, min_off_time=0, current_rate_limit=0, current_deadband=0.1, phase_power=None,
+                      appliance_phase='auto', price_sensor=None, required_run_time=0, required_energy=0, run_deadline=None,
+                      statistics_file=None, statistics_retention=7, battery_power=None, battery_efficiency=90,
+                      battery_discharge_floor=100, sensor_max_age=0):
+
+    automation_id = automation_id[11:] if automation_id[:11] == 'automation.' else automation_id
+    automation_id = _replace_vowels(f"automation.{automation_id.strip().replace(' ', '_').lower()}")
+
+
+    PvExcessControl.post(PvExcessControl, automation_id, appliance_priority, export_power, pv_power,
+                    load_power, home_battery_level, min_home_battery_level,
+                    dynamic_current_appliance, appliance_phases, min_current,
+                    max_current, appliance_switch, appliance_switch_interval,
+                    appliance_current_set_entity, actual_power, defined_current, appliance_on_only,
+                    grid_voltage, import_export_power, home_battery_capacity, solar_production_forecast,
+                    appliance_once_only, sampling_period, history_bucket_width, history_horizon, sampling_mode,
+                    actuation_settle_delay, allocation_strategy, state_file, solar_power_forecast, prediction_horizon,
+                    diagnostic_sensors, group_id, switch_on_margin, switch_off_threshold, min_on_time, min_off_time,
+                    current_rate_limit, current_deadband, phase_power, appliance_phase, price_sensor, required_run_time,
+                    required_energy, run_deadline, statistics_file, statistics_retention, battery_power, battery_efficiency,
+                    battery_discharge_floor, sensor_max_age)
+
+
+
+@service(supports_response='only')
+def pv_excess_control_statistics(start=None, end=None, resolution='day', series=None, total=False):
+    """yaml
+name: PV Excess Control statistics
+description: Query the excess, export and appliance energy and run time aggregates from the statistics store.
+fields:
+  start:
+    description: Start of the time range (default - 1 hour / 1 day / 30 days, depending on the resolution)
+    example: "2025-06-01T00:00:00"
+    selector:
+      datetime:
+  end:
+    description: End of the time range (default - now)
+    example: "2025-07-01T00:00:00"
+    selector:
+      datetime:
+  resolution:
+    description: Resolution of the aggregates (minute, hour or day)
+    example: day
+    default: day
+    selector:
+      select:
+        options:
+          - minute
+          - hour
+          - day
+  series:
+    description: Automation IDs of appliances and/or "group.<group ID>" of controller groups (default - all)
+    example: automation.wallbox
+  total:
+    description: Sum up the whole time range instead of returning each period
+    example: true
+    default: false
+    selector:
+      boolean:
+"""
+    return PvExcessControl.query_statistics(start, end, resolution, series, total)
+
+
+class PvExcessControl:
+    # TODO:
+    #  - What about other domains than switches? Enable use of other domains (e.g. light, ...)
+    #  - Make min_excess_power configurable via blueprint
+    instances = {}
+    # Controller groups (group ID -> ControllerGroup), each with its own sensors, histories and appliances
+    groups = {}
+    # Sampling configuration: sensors are sampled every sampling_period seconds (sampling_mode 'polling') or on each state change
+    #  (sampling_mode 'event'), the samples are aggregated to buckets of bucket_width seconds and history_horizon minutes of
+    #  buckets are kept.
+    sampling_mode = 'polling'
+    sampling_period = None
+    bucket_width = 60
+    history_horizon = 60
+    samples_per_bucket = 6
+    scheduler = None
+    # Event-driven sampling: trigger for the power sensors of all groups and the groups using each sensor (entity ID -> groups)
+    sensor_trigger = None
+    sensor_groups = {}
+    # Minimum excess power in watts. If the average min_excess_power at the specified appliance switch interval is greater than the actual
+    #  excess power, the appliance with the lowest priority will be shut off.
+    #  NOTE: Should be slightly negative, to compensate for inaccurate power corrections
+    #  WARNING: Do net set this to more than 0, otherwise some devices with dynamic current control will abruptly get switched off in some
+    #  situations.
+    min_excess_power = -10
+    # Delay in seconds between two consecutive service calls for the same appliance
+    actuation_settle_delay = 1
+    # Instrumentation, published as sensor.pv_excess_control_* entities if diagnostic_sensors is enabled
+    diagnostics = Diagnostics()
+    diagnostic_sensors = False
+    # True if debug logging is enabled (updated each control pass), expensive debug messages are skipped otherwise
+    debug_log = False
+    # Persistence: runtime state is saved to state_file at most every state_save_interval seconds (or on important changes) and
+    #  restored on startup, if it is not older than state_max_age seconds.
+    state_file = None
+    state_save_interval = 300
+    state_max_age = 900
+    state_saved = 0
+    state_dirty = False
+    restored_state = None
+    # Concurrency: all pyscript functions run as tasks in the event loop of Home Assistant and only interleave at awaits (service
+    #  calls, task.sleep / task.wait / task.executor). The scheduler owns the shared state (instances, groups, histories, counters)
+    #  while busy: registrations, the midnight reset and the removal of deleted appliances are posted as messages and applied
+    #  between two ticks, never within a control pass. A tick arriving while busy is skipped instead of running concurrently
+    #  (logged once per busy period, busy_skipped counts the skipped ticks of the current busy period).
+    busy = False
+    busy_skipped = 0
+    messages = []
+    # Statistics store (SQLite): samples are buffered and written every statistics_write_interval seconds. Minute samples are kept
+    #  for statistics_retention days, hour rollups for statistics_hour_retention days and day rollups forever. The retention is
+    #  enforced every statistics_compact_interval seconds.
+    statistics_file = None
+    statistics_rows = []
+    statistics_write_interval = 300
+    statistics_written = 0
+    statistics_retention = 7
+    statistics_hour_retention = 400
+    statistics_compact_interval = 3600
+    statistics_compacted = 0
+    on_time_counter = 0
+
+
+    def __init__(self, automation_id, appliance_priority, export_power, pv_power, load_power, home_battery_level,
+                 min_home_battery_level, dynamic_current_appliance, appliance_phases, min_current,
+                 max_current, appliance_switch, appliance_switch_interval, appliance_current_set_entity,
+                 actual_power, defined_current, appliance_on_only, grid_voltage, import_export_power,
+                 home_battery_capacity, solar_production_forecast, appliance_once_only, sampling_period=10,
+                 history_bucket_width=60, history_horizon=60, sampling_mode='polling', actuation_settle_delay=1,
+                 allocation_strategy='greedy', state_file=None, solar_power_forecast=None, prediction_horizon=0,
+                 diagnostic_sensors=False, group_id=DEFAULT_GROUP, switch_on_margin=0, switch_off_threshold=-10,
+                 min_on_time=0, min_off_time=0, current_rate_limit=0, current_deadband=0.1, phase_power=None,
+                 appliance_phase='auto', price_sensor=None, required_run_time=0, required_energy=0, run_deadline=None,
+                 statistics_file=None, statistics_retention=7, battery_power=None, battery_efficiency=90,
+                 battery_discharge_floor=100, sensor_max_age=0):
+        if automation_id not in PvExcessControl.instances:
+            inst = self
+        else:
+            inst = PvExcessControl.instances[automation_id]['instance']
+        # the configuration is only recompiled if the appliance parameters have changed, an invalid configuration is rejected
+        #  (an already registered appliance keeps its previous configuration)
+        params = (automation_id, appliance_priority, appliance_switch, appliance_switch_interval, dynamic_current_appliance,
+                  appliance_current_set_entity, actual_power, min_current, max_current, defined_current, appliance_phases,
+                  appliance_phase, appliance_on_only, appliance_once_only, grid_voltage)
+        if inst is not self and inst.config_params == params:
+            config = inst.config
+        else:
+            config = _compile_appliance_config(*params)
+        numbers = (('sampling_period', sampling_period, int, False), ('history_bucket_width', history_bucket_width, float, False),
+                   ('history_horizon', history_horizon, int, False),
+                   ('actuation_settle_delay', actuation_settle_delay, float, False),
+                   ('statistics_retention', statistics_retention, int, False),
+                   ('prediction_horizon', prediction_horizon, int, False),
+                   ('min_home_battery_level', min_home_battery_level, float, False),
+                   ('home_battery_capacity', home_battery_capacity, float, True),
+                   ('battery_discharge_floor', battery_discharge_floor, float, True),
+                   ('battery_efficiency', battery_efficiency, float, True), ('sensor_max_age', sensor_max_age, float, True),
+                   ('switch_on_margin', switch_on_margin, float, False),
+                   ('switch_off_threshold', switch_off_threshold, float, False), ('min_on_time', min_on_time, float, False),
+                   ('min_off_time', min_off_time, float, False), ('current_rate_limit', current_rate_limit, float, False),
+                   ('current_deadband', current_deadband, float, False),
+                   ('required_run_time', required_run_time, float, True), ('required_energy', required_energy, float, True))
+        valid = _check_controller_config(f'[{appliance_switch} {automation_id}]', numbers)
+        if config is None or not valid:
+            if inst is self:
+                log.error(f'Appliance "{automation_id}" has not been registered, because of an invalid configuration.')
+            else:
+                log.error(f'{inst.config.log_prefix} Configuration update rejected, keeping the previous configuration.')
+            return
+        inst.config = config
+        inst.config_params = params
+        inst.automation_id = automation_id
+        PvExcessControl.diagnostic_sensors = bool(diagnostic_sensors)
+        PvExcessControl.actuation_settle_delay = float(actuation_settle_delay)
+        PvExcessControl._configure_sampling(sampling_period, history_bucket_width, history_horizon, sampling_mode)
+        state_file = state_file or None
+        if state_file != PvExcessControl.state_file:
+            PvExcessControl.state_file = state_file
+            PvExcessControl._load_state()
+        statistics_file = statistics_file or None
+        if statistics_file != PvExcessControl.statistics_file:
+            PvExcessControl._write_statistics(force=True)
+            PvExcessControl.statistics_file = statistics_file
+        PvExcessControl.statistics_retention = max(1, int(statistics_retention))
+
+        group = PvExcessControl._get_group(str(group_id or '').strip() or DEFAULT_GROUP)
+        group.export_power = export_power
+        group.pv_power = pv_power
+        group.load_power = load_power
+        group.home_battery_level = home_battery_level
+        group.import_export_power = import_export_power
+        group.solar_production_forecast = solar_production_forecast
+        group.solar_power_forecast = solar_power_forecast
+        group.prediction_horizon = max(0, int(prediction_horizon))
+        group.price_sensor = price_sensor
+        group.battery_power = battery_power or None
+        group.battery.configure(home_battery_capacity, min_home_battery_level, battery_discharge_floor, battery_efficiency)
+        group.health.max_age = max(0.0, float(sensor_max_age or 0))
+        if isinstance(phase_power, str):
+            phase_power = [phase_power]
+        phase_power = [e for e in (phase_power or []) if e]
+        if phase_power != group.phase_power:
+            log.info(f'{group.log_prefix} Configuring per-phase history of {phase_power}.')
+            group.configure_phases(phase_power, PvExcessControl._history_capacity())
+            PvExcessControl._restore_phase_history(group)
+        if allocation_strategy not in ALLOCATORS:
+            log.error(f'Allocation strategy "{allocation_strategy}" not supported. Using "greedy".')
+            allocation_strategy = 'greedy'
+        allocator = group.allocator.allocator if isinstance(group.allocator, PhaseAllocator) else group.allocator
+        if not isinstance(allocator, ALLOCATORS[allocation_strategy]):
+            allocator = ALLOCATORS[allocation_strategy]()
+        group.allocator = PhaseAllocator(allocator) if phase_power else allocator
+
+        # start if needed
+        if inst.automation_id not in PvExcessControl.instances:
+            inst.hysteresis = Hysteresis()
+            inst.power_model = PowerModel()
+            inst.planner = DeadlinePlanner()
+            inst.phase_index = config.appliance_phase
+            inst.switched_on_today = False
+            inst.switch_interval_counter = 0
+            inst.switched_on_time = datetime.datetime.now()
+            inst.daily_run_time = 0
+            inst.daily_energy = 0
+            PvExcessControl._restore_appliance(inst)
+            PvExcessControl.instances[inst.automation_id] = {'instance': inst, 'priority': config.appliance_priority}
+            log.info(f'{config.log_prefix} Added appliance to scheduler.')
+        else:
+            PvExcessControl.instances[inst.automation_id]['priority'] = config.appliance_priority
+            if inst.group is not group:
+                log.info(f'{config.log_prefix} Moving appliance from group "{inst.group.group_id}" to "{group.group_id}".')
+                PvExcessControl._remove_from_group(inst)
+        if config.appliance_phase is not None:
+            inst.phase_index = config.appliance_phase
+        inst.hysteresis.configure(switch_on_margin, switch_off_threshold, min_on_time, min_off_time, current_rate_limit,
+                                  current_deadband)
+        inst.planner.configure(required_run_time, required_energy, run_deadline)
+        inst.group = group
+        group.priority_index.set(inst.automation_id, inst, config.appliance_priority)
+        PvExcessControl._configure_event_sampling()
+        log.info(f'{config.log_prefix} Registered appliance in group "{group.group_id}".')
+
+    @staticmethod
+    def _get_group(group_id: str) -> ControllerGroup:
+        """
+        Get a controller group, a new group is created (and its history restored from the state file) if needed
+        :param group_id:    Group ID
+        :return:            Controller group
+        """
+        group = PvExcessControl.groups.get(group_id)
+        if group is None:
+            group = ControllerGroup(group_id, PvExcessControl._history_capacity(), PvExcessControl.bucket_width)
+            PvExcessControl._restore_group(group)
+            PvExcessControl.groups[group_id] = group
+            log.info(f'{group.log_prefix} Added controller group.')
+        return group
+
+    @staticmethod
+    def _remove_from_group(inst):
+        """
+        Remove an appliance from its controller group. Groups without appliances are removed.
+        :param inst:    PVExcesscontrol Class instance
+        """
+        group = inst.group
+        group.priority_index.remove(inst.automation_id)
+        if not group.priority_index.instances:
+            PvExcessControl.groups.pop(group.group_id, None)
+            log.info(f'{group.log_prefix} Removed controller group without appliances.')
+            PvExcessControl._configure_event_sampling()
+
+    @staticmethod
+    def on_time():
+        """
+        Scheduler tick: applies the posted messages and runs the tick. Skipped if the previous tick (or a message) is still
+        being processed, so ticks never overlap or pile up.
+        """
+        if PvExcessControl.busy:
+            PvExcessControl.diagnostics.skipped_ticks += 1
+            PvExcessControl.busy_skipped += 1
+            if PvExcessControl.busy_skipped == 1:
+                log.warning('Skipping ticks, because the previous tick is still running.')
+            return
+        PvExcessControl.busy = True
+        try:
+            PvExcessControl._process_messages()
+            PvExcessControl._tick()
+            # messages posted while the tick was waiting for service calls
+            PvExcessControl._process_messages()
+        finally:
+            PvExcessControl.busy = False
+            if PvExcessControl.busy_skipped:
+                log.info(f'Skipped {PvExcessControl.busy_skipped} ticks, because the previous tick was still running.')
+                PvExcessControl.busy_skipped = 0
+
+    @staticmethod
+    def post(func, *args):
+        """
+        Post a message changing the shared state. The message is applied immediately if the scheduler is idle, otherwise after
+        the running tick.
+        :param func:    Function applying the message
+        :param args:    Arguments of the function
+        """
+        PvExcessControl.messages.append((func, args))
+        if PvExcessControl.busy:
+            return
+        PvExcessControl.busy = True
+        try:
+            PvExcessControl._process_messages()
+        finally:
+            PvExcessControl.busy = False
+
+    @staticmethod
+    def _process_messages():
+        """
+        Apply the posted messages in order. Must only be called while busy.
+        """
+        while PvExcessControl.messages:
+            func, args = PvExcessControl.messages.pop(0)
+            try:
+                func(*args)
+            except Exception as e:
+                log.error(f'Could not process message {getattr(func, "__name__", func)}: {e}')
+
+    @staticmethod
+    def _reset_daily():
+        """
+        Reset the daily run times and 'Only-Run-Once' flags (message posted at midnight)
+        """
+        log.info("Resetting 'switched_on_today' instance variables.")
+        for e in PvExcessControl.instances.values():
+            inst = e['instance']
+            inst.switched_on_today = False
+            inst.daily_run_time = 0
+            inst.daily_energy = 0
+        PvExcessControl.state_dirty = True
+
+    @staticmethod
+    def _remove_appliance(a_id: str):
+        """
+        Remove a deleted appliance (message posted by automation_activated)
+        :param a_id:    Automation ID
+        """
+        e = PvExcessControl.instances.pop(a_id, None)
+        if e is None:
+            return
+        log.info(f'Automation "{a_id}" was deleted. Removed related class instance.')
+        PvExcessControl._remove_from_group(e['instance'])
+        PvExcessControl.diagnostics.decisions.pop(a_id, None)
+
+    @staticmethod
+    def _tick():
+        """
+        Sample the power sensors and run the control pass once per history bucket for all registered appliances
+        """
+        if not PvExcessControl.groups:
+            return
+
+        tick_start = time.perf_counter()
+        PvExcessControl.on_time_counter += 1
+        # Sanity check (per group, a misconfigured group does not affect the others)
+        groups = [group for group in PvExcessControl.groups.values() if PvExcessControl.sanity_check(group)]
+        # read all sensors needed in this tick only once (sensors shared by several groups are read once as well)
+        snapshot = StateSnapshot()
+        if PvExcessControl.sampling_mode == 'event':
+            # samples have been collected by the sensor trigger, only the current buckets need to be completed
+            now = time.monotonic()
+            for group in groups:
+                PvExcessControl._update_event_history(group, now)
+        else:
+            for group in groups:
+                snapshot.collect(PvExcessControl._sensor_entities(group))
+            for group in groups:
+                PvExcessControl._update_pv_history(group, snapshot)
+        history_duration = time.perf_counter() - tick_start
+        # ensure that control algo only runs once per history bucket
+        if PvExcessControl.on_time_counter < PvExcessControl.samples_per_bucket:
+            PvExcessControl.diagnostics.record_tick(time.perf_counter() - tick_start, history_duration)
+            return
+        PvExcessControl.on_time_counter = 0
+        PvExcessControl.debug_log = _debug_enabled()
+        for group in groups:
+            snapshot.collect(PvExcessControl._sensor_entities(group))
+        snapshot.collect(PvExcessControl._appliance_entities())
+        # service calls of all groups are collected and dispatched at the end of the control pass
+        actuation = ActuationQueue(PvExcessControl.actuation_settle_delay)
+        for group in groups:
+            PvExcessControl._control_group(group, snapshot, actuation)
+
+        # execute all decided service calls
+        actuation.dispatch()
+        PvExcessControl._save_state()
+        PvExcessControl._write_statistics()
+
+        duration = time.perf_counter() - tick_start
+        PvExcessControl.diagnostics.record_tick(duration, history_duration)
+        PvExcessControl.diagnostics.record_control_pass(duration)
+        if PvExcessControl.diagnostic_sensors:
+            PvExcessControl._publish_diagnostics()
+
+    @staticmethod
+    def _control_group(group: ControllerGroup, snapshot: StateSnapshot, actuation: ActuationQueue):
+        """
+        Decide the target states of the appliances of a controller group
+        :param group:       Controller group
+        :param snapshot:    State snapshot of the current tick
+        :param actuation:   Actuation queue of the current tick
+        """
+        forecast = _parse_forecast(_get_attributes(group.solar_power_forecast)) if group.solar_power_forecast else []
+        PvExcessControl._update_prediction(group, forecast)
+        prices = None
+
+        PvExcessControl._check_health(group, snapshot)
+        # power the appliances must leave to / may borrow from the home battery
+        PvExcessControl._update_battery(group, snapshot, forecast)
+
+        # ----------------------------------- go through each appliance (highest prio to lowest) ---------------------------------------
+        demands = []
+        for inst in group.priority_index.descending():
+            inst.switch_interval_counter += 1
+            # Check if automation is activated for specific instance
+            if not PvExcessControl.automation_activated(inst.automation_id, snapshot):
+                continue
+            d = PvExcessControl._build_demand(inst, snapshot)
+            if inst.planner.active():
+                if prices is None:
+                    prices = _parse_prices(_get_attributes(group.price_sensor)) if group.price_sensor else []
+                d.planned = PvExcessControl._plan(d, prices, forecast)
+            demands.append(d)
+
+        # determine the target states of all appliances at once and queue the required actions
+        targets = PvExcessControl._allocate(group, demands)
+        if group.health.degraded:
+            PvExcessControl._restrict_degraded(demands, targets)
+        for d in demands:
+            PvExcessControl._apply_target(d, targets[d.key], snapshot, actuation)
+
+    @staticmethod
+    def _check_health(group: ControllerGroup, snapshot: StateSnapshot):
+        """
+        Update the sensor quality score of a controller group and enter / leave the degraded mode
+        :param group:       Controller group
+        :param snapshot:    State snapshot of the current tick
+        """
+        health = group.health
+        entity_ids = [e for e in PvExcessControl._power_entities(group) if e is not None]
+        ages = {e: _state_age(snapshot.get(e)) for e in entity_ids} if health.max_age else {}
+        if health.check(entity_ids, ages):
+            if health.degraded:
+                sensors = {e: f'{snapshot.get(e)} ({q:.0%})' for e, q in health.sensor_quality.items()}
+                log.warning(f'{group.log_prefix} Sensor quality {health.quality:.0%} too low, entering degraded mode (no '
+                            f'switch-ons or current increases): {sensors}')
+            else:
+                log.info(f'{group.log_prefix} Sensor quality {health.quality:.0%} recovered, leaving degraded mode.')
+        elif PvExcessControl.debug_log:
+            log.debug(f'{group.log_prefix} Sensor quality: {health.quality:.0%}')
+
+    @staticmethod
+    def _restrict_degraded(demands: list, targets: dict):
+        """
+        Restrict the target states to safe actions in degraded mode: Appliances may be switched off and currents decreased, but
+        no appliance is switched on and no current is increased.
+        :param demands: List of ApplianceDemand
+        :param targets: Dict of target states: key -> (on, current), updated in place
+        """
+        for d in demands:
+            on, current = targets[d.key]
+            if on and not d.is_on:
+                targets[d.key] = (False, None)
+            elif on and d.dynamic and current is not None and d.set_current is not None and current > d.set_current:
+                targets[d.key] = (True, d.set_current)
+
+    @staticmethod
+    def _allocate(group: ControllerGroup, demands: list) -> dict:
+        """
+        Determine the target states of the appliances of a controller group. Appliances, which have to run now to meet their
+        deadline (see DeadlinePlanner), are served first: They are switched on (or kept on) regardless of the excess power and the
+        power they need when switching on is not available to the other appliances.
+        :param group:   Controller group
+        :param demands: List of ApplianceDemand, sorted from highest to lowest priority
+        :return:        Dict of target states: key -> (on, current)
+        """
+        planned = [d for d in demands if d.planned]
+        if not planned:
+            return group.allocator.allocate(demands, PvExcessControl.min_excess_power)
+        starting = {d.key: d for d in planned if not (d.is_on or d.blocked or d.held)}
+        claimed = sum(PvExcessControl._planned_power(d) for d in starting.values())
+        others = [d for d in demands if d.key not in starting]
+        if claimed:
+            for d in others:
+                d.avg_excess -= claimed
+                if d.phase_excess is not None:
+                    d.phase_excess = [value - claimed / len(d.phase_excess) for value in d.phase_excess]
+        targets = group.allocator.allocate(others, PvExcessControl.min_excess_power)
+        for d in planned:
+            on, current = targets.get(d.key, (False, None))
+            if not on:
+                targets[d.key] = (True, d.min_current if d.dynamic else None)
+                d.suppressed = None
+        return targets
+
+    @staticmethod
+    def _planned_power(d: ApplianceDemand) -> float:
+        """
+        :param d:   Appliance demand
+        :return:    Power of the appliance when running for its deadline (at min. current for dynamic current appliances)
+        """
+        if d.dynamic:
+            return max(d.start_power, d.inst.power_model.power(d.min_current, d.power_per_amp))
+        return d.start_power
+
+    @staticmethod
+    def _plan(d: ApplianceDemand, prices: list, forecast: list) -> bool:
+        """
+        Update the deadline plan of an appliance
+        :param d:           Appliance demand
+        :param prices:      Grid price series (see _parse_prices)
+        :param forecast:    Solar power forecast series (see _parse_forecast)
+        :return:            True if the appliance has to run now to meet its deadline
+        """
+        inst = d.inst
+        now = datetime.datetime.now()
+        run_time = inst.daily_run_time
+        if d.is_on:
+            run_time += (now - inst.switched_on_time).total_seconds()
+        power = PvExcessControl._planned_power(d)
+        remaining = inst.planner.remaining(run_time, inst.daily_energy, power)
+        # excess power without the appliance itself
+        excess = d.avg_excess + d.power
+        t = now.timestamp()
+        load = round((_forecast_power(forecast, t) - excess) / 100) * 100 if forecast else None
+        planned = inst.planner.update(t, inst.planner.deadline_at(now), remaining, power, excess, prices, forecast, load, d.is_on)
+        if planned:
+            log.info(f'{inst.config.log_prefix} Deadline planner: Running appliance to meet its deadline '
+                     f'({remaining / 60:.0f} min remaining).')
+        return planned
+
+    @staticmethod
+    def _build_demand(inst, snapshot: StateSnapshot) -> ApplianceDemand:
+        """
+        Collect the current state of an appliance for the allocation engine
+        :param inst:        PVExcesscontrol Class instance
+        :param snapshot:    State snapshot of the current tick
+        :return:            Appliance demand
+        """
+        config = inst.config
+        log_prefix = config.log_prefix
+        window = PvExcessControl._interval_buckets(inst)
+        group = inst.group
+        battery = group.battery
+        avg_export_power = group.export_history.mean(window)
+        excess = battery.excess(group.pv_history.mean(window), avg_export_power)
+        avg_excess_power = int(excess)
+
+        appliance_state = snapshot.get(config.appliance_switch)
+        is_on = appliance_state == 'on'
+        if not is_on and appliance_state != 'off':
+            log.warning(f'{log_prefix} Appliance state (={appliance_state}) is neither ON nor OFF. Assuming OFF state.')
+        now = time.monotonic()
+        inst.hysteresis.observe(is_on, now)
+
+        set_current = None
+        if config.dynamic_current_appliance:
+            set_current = snapshot.get_num(config.appliance_current_set_entity, return_on_error=config.min_current)
+        if not is_on:
+            power = 0
+        elif config.actual_power is not None:
+            power = snapshot.get_num(config.actual_power, return_on_error=0)
+            PvExcessControl._learn_power(inst, set_current, power, now)
+        elif config.dynamic_current_appliance:
+            power = set_current * config.power_per_amp
+        else:
+            power = config.defined_power
+        if is_on:
+            inst.daily_energy += power * PvExcessControl.bucket_width / 3.6e6
+            PvExcessControl._record_statistics(inst.automation_id, power * PvExcessControl.bucket_width / 3600,
+                                               PvExcessControl.bucket_width)
+            run_time = inst.daily_run_time + (datetime.datetime.now() - inst.switched_on_time).total_seconds()
+            log.info(f'{log_prefix} Application has run for {(run_time / 60):.1f} minutes')
+        if PvExcessControl.debug_log:
+            log.debug(f'{log_prefix} Average excess power: {avg_excess_power} W | State: {appliance_state} | '
+                      f'Power consumption: {power} W')
+        phase_excess = None
+        if group.phase_history is not None:
+            # the per-phase sensors measure the grid power: the power available beyond the grid export (absorbed by the battery
+            #  or borrowed from it) is shared equally
+            phase_excess = group.phase_history.mean(window)
+            budget = excess - avg_export_power
+            if budget > 0:
+                phase_excess = [value + budget / len(phase_excess) for value in phase_excess]
+        return ApplianceDemand(inst, is_on, config.power_per_amp, power, set_current, avg_excess_power, window,
+                               inst.switch_interval_counter >= window, inst.group.predicted_change, inst.hysteresis.held(now),
+                               phase_excess)
+
+    @staticmethod
+    def _learn_power(inst, set_current: Union[float, None], power: float, now: float):
+        """
+        Add an actual power sample to the power model of an appliance. Samples taken shortly after a switching action or current
+        change are skipped, as the appliance (and the power sensor) may not have settled yet.
+        :param inst:        PVExcesscontrol Class instance
+        :param set_current: Current setpoint of a dynamic current appliance in amperes
+        :param power:       Actual power in watts
+        :param now:         Current (monotonic) time in seconds
+        """
+        config = inst.config
+        changed = inst.hysteresis.current_time
+        if power <= 0 or (changed is not None and now - changed < PvExcessControl.bucket_width / 2):
+            return
+        setpoint = set_current if config.dynamic_current_appliance else config.defined_current
+        inst.power_model.add(setpoint, power)
+        if PvExcessControl.debug_log:
+            log.debug(f'{config.log_prefix} Learned power at {setpoint} A: {inst.power_model.learned(setpoint)} W')
+
+    @staticmethod
+    def _apply_target(d: ApplianceDemand, target: tuple, snapshot: StateSnapshot, actuation: ActuationQueue):
+        """
+        Queue the actions needed to bring an appliance to its target state
+        :param d:           Appliance demand
+        :param target:      Target state (on, current)
+        :param snapshot:    State snapshot of the current tick
+        :param actuation:   Actuation queue of the current tick
+        """
+        inst = d.inst
+        config = inst.config
+        log_prefix = config.log_prefix
+        on, current = target
+        diagnostics = PvExcessControl.diagnostics
+        if d.suppressed is not None:
+            log.info(f'{log_prefix} Hysteresis: {d.suppressed.replace("_", " ")} suppressed '
+                     f'(min. {"on" if d.is_on else "off"}-time not reached).')
+            diagnostics.record_decision(inst.automation_id, 'suppressed')
+            return
+        if on and d.phase is not None:
+            inst.phase_index = d.phase
+        if on and not d.is_on:
+            # the switch interval does not delay planned runs
+            if d.blocked or not (d.can_switch or d.planned) or d.held:
+                diagnostics.record_decision(inst.automation_id, 'none')
+                return
+            diagnostics.record_decision(inst.automation_id, 'switch_on')
+            PvExcessControl.switch_on(inst, snapshot, actuation)
+            inst.switch_interval_counter = 0
+            log.info(f'{log_prefix} Switched on appliance.')
+            power = d.start_power
+            if d.dynamic:
+                current = d.min_current if current is None else current
+                # executed after the settle delay
+                actuation.add(inst.automation_id, _set_value,
+                              (config.appliance_current_set_entity, current, config.current_set_domain))
+                snapshot.set(config.appliance_current_set_entity, current)
+                log.info(f'{log_prefix} Setting dynamic current appliance to {current} A per phase.')
+                power = max(power, inst.power_model.power(current, d.power_per_amp))
+            # "restart" history by subtracting defined power from each history value within the specified time frame
+            PvExcessControl._adjust_pwr_history(inst, -power)
+        elif not on and d.is_on:
+            diagnostics.record_decision(inst.automation_id, 'switch_off')
+            power_consumption = PvExcessControl.switch_off(inst, snapshot, actuation)
+            if power_consumption != 0:
+                log.debug(f'{log_prefix} Released {power_consumption} W by switching off appliance.')
+        elif on and d.is_on and d.dynamic and current is not None and abs(current - d.set_current) > 0.09:
+            now = time.monotonic()
+            current = inst.hysteresis.limit_current(current, d.set_current, now)
+            if current is None:
+                if PvExcessControl.debug_log:
+                    log.debug(f'{log_prefix} Hysteresis: current change suppressed (deadband / rate limit).')
+                diagnostics.record_decision(inst.automation_id, 'suppressed')
+                return
+            inst.hysteresis.current_time = now
+            diagnostics.record_decision(inst.automation_id, 'set_current')
+            log.info(f'{log_prefix} Setting dynamic current appliance from {d.set_current} to {current} A per phase.')
+            actuation.add(inst.automation_id, _set_value,
+                              (config.appliance_current_set_entity, current, config.current_set_domain))
+            snapshot.set(config.appliance_current_set_entity, current)
+            # "restart" history by subtracting power difference from each history value within the specified time frame
+            model = inst.power_model
+            PvExcessControl._adjust_pwr_history(inst, -(model.power(current, d.power_per_amp) -
+                                                        model.power(d.set_current, d.power_per_amp)))
+        else:
+            diagnostics.record_decision(inst.automation_id, 'none')
+            if PvExcessControl.debug_log:
+                log.debug(f'{log_prefix} Doing nothing.')
+
+    @staticmethod
+    def _sensor_entities(group: ControllerGroup) -> list:
+        """
+        Get all sensor entities of a controller group, which are needed for updating the history and for the control algorithm
+        :param group:   Controller group
+        :return:        List of entity IDs
+        """
+        return [group.import_export_power, group.export_power, group.pv_power, group.load_power, group.home_battery_level,
+                group.battery_power, group.solar_production_forecast] + group.phase_power
+
+    @staticmethod
+    def _appliance_entities() -> list:
+        """
+        Get all appliance related entities of all registered instances
+        :return:    List of entity IDs
+        """
+        entity_ids = []
+        for e in PvExcessControl.instances.values():
+            config = e['instance'].config
+            entity_ids.extend([config.automation_id, config.appliance_switch, config.appliance_current_set_entity,
+                               config.actual_power])
+        return entity_ids
+
+    @staticmethod
+    def _power_entities(group: ControllerGroup) -> list:
+        """
+        Get the power sensor entities, which are used for updating the Export and PV history of a controller group
+        :param group:   Controller group
+        :return:        List of entity IDs
+        """
+        if group.import_export_power:
+            return [group.import_export_power] + ([group.battery_power] if group.battery_power else []) + group.phase_power
+        return [group.export_power, group.pv_power, group.load_power] + group.phase_power
+
+    @staticmethod
+    def _calc_power_sample(group: ControllerGroup, get_num) -> tuple:
+        """
+        Calculate export power and PV excess power from the power sensors of a controller group
+        :param group:   Controller group
+        :param get_num: Function returning the numerical state of a sensor (or None)
+        :return:        Tuple (export power, excess power) in watts
+        """
+        if group.import_export_power:
+            # Calc values based on combined import/export power sensor
+            import_export_state = get_num(group.import_export_power)
+            if import_export_state is None:
+                raise Exception(f'Could not update Export/PV history: {group.import_export_power} is None.')
+            import_export = int(import_export_state)
+            # load_pwr = pv_pwr + import_export - battery_pwr
+            battery = 0
+            if group.battery_power:
+                battery_state = get_num(group.battery_power)
+                if battery_state is None:
+                    raise Exception(f'Could not update Export/PV history: {group.battery_power} is None.')
+                battery = int(battery_state)
+            return abs(min(0, import_export)), battery - import_export
+
+        # Calc values based on separate sensors
+        export_pwr_state = get_num(group.export_power)
+        pv_power_state = get_num(group.pv_power)
+        load_power_state = get_num(group.load_power)
+        if export_pwr_state is None or pv_power_state is None or load_power_state is None:
+            raise Exception(f'Could not update Export/PV history {group.export_power=} | {group.pv_power=} | '
+                            f'{group.load_power=} = {export_pwr_state=} | {pv_power_state=} | {load_power_state=}')
+        return int(export_pwr_state), int(pv_power_state - load_power_state)
+
+    @staticmethod
+    def _calc_phase_sample(group: ControllerGroup, get_num) -> Union[list, None]:
+        """
+        Calculate the excess power per phase from the per-phase import/export power sensors of a controller group
+        :param group:   Controller group
+        :param get_num: Function returning the numerical state of a sensor (or None)
+        :return:        List of excess power per phase in watts, None if a sensor is not available
+        """
+        values = [get_num(e) for e in group.phase_power]
+        if None in values:
+            if PvExcessControl.debug_log:
+                log.debug(f'{group.log_prefix} Could not update per-phase history: {dict(zip(group.phase_power, values))}')
+            return None
+        return [-v for v in values]
+
+    @staticmethod
+    def _update_pv_history(group: ControllerGroup, snapshot: StateSnapshot):
+        """
+        Update Export and PV history of a controller group
+        :param group:       Controller group
+        :param snapshot:    State snapshot of the current tick
+        """
+        # sensor quality stage: outliers are replaced, short gaps filled
+        health = group.health
+        now = time.monotonic()
+        values = {}
+        for entity_id in PvExcessControl._power_entities(group):
+            if entity_id is not None:
+                values[entity_id] = health.filter(entity_id, snapshot.get_num(entity_id), now)
+        try:
+            export_pwr, excess_pwr = PvExcessControl._calc_power_sample(group, values.get)
+        except Exception as e:
+            # reported by the sensor health check of the control pass
+            if PvExcessControl.debug_log:
+                log.debug(f'{group.log_prefix} Could not update Export/PV history!: {e}')
+        else:
+            group.export_bucket.add(export_pwr)
+            group.pv_bucket.add(excess_pwr)
+        if group.phase_history is not None:
+            phase_sample = PvExcessControl._calc_phase_sample(group, values.get)
+            if phase_sample is not None:
+                group.add_phase_sample(phase_sample)
+
+        if PvExcessControl.on_time_counter >= PvExcessControl.samples_per_bucket:
+            PvExcessControl._close_bucket(group)
+
+    @staticmethod
+    def _update_event_history(group: ControllerGroup, now: float):
+        """
+        Complete the current bucket of a controller group in event-driven sampling mode. The last sample is weighted up to now.
+        :param group:   Controller group
+        :param now:     Current (monotonic) time in seconds
+        """
+        PvExcessControl._integrate_event_sample(group, now)
+        if PvExcessControl.on_time_counter >= PvExcessControl.samples_per_bucket:
+            PvExcessControl._close_bucket(group)
+
+    @staticmethod
+    def _on_sensor_change(entity_id: str, value):
+        """
+        Callback of the sensor trigger in event-driven sampling mode. Only the groups using the changed sensor are updated.
+        :param entity_id:   Changed power sensor
+        :param value:       New state
+        """
+        now = time.monotonic()
+        raw = _validate_number(value)
+        for group in PvExcessControl.sensor_groups.get(entity_id, ()):
+            PvExcessControl._integrate_event_sample(group, now)
+            # changes are not equally spaced: no outlier detection and no gap filling
+            group.sensor_values[entity_id] = group.health.filter(entity_id, raw, now, hampel=False)
+            PvExcessControl._set_event_sample(group)
+
+    @staticmethod
+    def _set_event_sample(group: ControllerGroup):
+        """
+        Calculate the current sample of a controller group from the latest sensor values. Invalid values pause sampling until the
+        next valid change.
+        :param group:   Controller group
+        """
+        try:
+            group.event_sample = PvExcessControl._calc_power_sample(group, group.sensor_values.get)
+        except Exception as e:
+            # reported by the sensor health check of the control pass
+            if PvExcessControl.debug_log:
+                log.debug(f'{group.log_prefix} Could not update Export/PV history!: {e}')
+            group.event_sample = None
+        if group.phase_history is not None:
+            group.phase_sample = PvExcessControl._calc_phase_sample(group, group.sensor_values.get)
+
+    @staticmethod
+    def _integrate_event_sample(group: ControllerGroup, now: float):
+        """
+        Add the current sample to the bucket of a controller group, weighted by the time it has been valid
+        :param group:   Controller group
+        :param now:     Current (monotonic) time in seconds
+        """
+        sample = group.event_sample
+        if sample is not None and group.event_sample_time is not None:
+            weight = now - group.event_sample_time
+            if weight > 0:
+                group.export_bucket.add(sample[0], weight)
+                group.pv_bucket.add(sample[1], weight)
+        if group.phase_sample is not None and group.event_sample_time is not None and now > group.event_sample_time:
+            group.add_phase_sample(group.phase_sample, now - group.event_sample_time)
+        group.event_sample_time = now
+
+    @staticmethod
+    def _close_bucket(group: ControllerGroup):
+        """
+        Add the averages of the current bucket to the histories of a controller group and start a new bucket
+        :param group:   Controller group
+        """
+        export_avg = group.export_bucket.mean()
+        excess_avg = group.pv_bucket.mean()
+        if export_avg is None or excess_avg is None:
+            # already reported when entering the degraded mode
+            if not group.health.degraded:
+                log.warning(f'{group.log_prefix} No valid samples within the last history bucket. Export/PV history not updated.')
+        else:
+            # add avg to history (oldest value is dropped automatically)
+            group.export_history.append(round(export_avg))
+            group.pv_history.append(round(excess_avg))
+            group.predictor.update(excess_avg)
+            PvExcessControl._record_statistics(f'group.{group.group_id}', excess_avg * PvExcessControl.bucket_width / 3600,
+                                               export_avg * PvExcessControl.bucket_width / 3600)
+            if PvExcessControl.debug_log:
+                log.debug(f'{group.log_prefix} Export bucket: avg={export_avg:.0f} W | min={group.export_bucket.min} W | '
+                          f'max={group.export_bucket.max} W | samples={group.export_bucket.count}')
+                log.debug(f'{group.log_prefix} PV Excess (PV Power - Load Power) bucket: avg={excess_avg:.0f} W | '
+                          f'min={group.pv_bucket.min} W | max={group.pv_bucket.max} W | samples={group.pv_bucket.count}')
+                log.debug(f'{group.log_prefix} Export History: {group.export_history.values()}')
+                log.debug(f'{group.log_prefix} PV Excess (PV Power - Load Power) History: {group.pv_history.values()}')
+        group.export_bucket.reset()
+        group.pv_bucket.reset()
+        if group.phase_history is not None and group.phase_bucket_weight > 0:
+            group.phase_history.append([round(value / group.phase_bucket_weight) for value in group.phase_bucket])
+            if PvExcessControl.debug_log:
+                log.debug(f'{group.log_prefix} Per-phase excess bucket: {group.phase_history.mean(1)}')
+            group.phase_bucket = [0.0] * len(group.phase_bucket)
+            group.phase_bucket_weight = 0.0
+
+    @staticmethod
+    def _history_capacity() -> int:
+        """
+        :return:    Number of history buckets needed for the history horizon
+        """
+        return max(1, round(PvExcessControl.history_horizon * 60 / PvExcessControl.bucket_width))
+
+    @staticmethod
+    def _configure_sampling(sampling_period, bucket_width, history_horizon, sampling_mode='polling'):
+        """
+        Apply the sampling configuration. Histories are only reset and the triggers are only restarted if the configuration
+        changed.
+        :param sampling_period: Sampling period in seconds (only relevant for polling)
+        :param bucket_width:    Width of one history bucket in seconds (rounded to a multiple of the sampling period)
+        :param history_horizon: Length of the history in minutes
+        :param sampling_mode:   'polling' to sample the sensors periodically, 'event' to sample them on each state change
+        """
+        if sampling_mode not in ('polling', 'event'):
+            log.error(f'Sampling mode "{sampling_mode}" not supported. Using "polling".')
+            sampling_mode = 'polling'
+        sampling_period = max(1, int(sampling_period))
+        if sampling_mode == 'event':
+            # the scheduler only needs to complete the buckets
+            bucket_width = max(1, round(float(bucket_width)))
+            sampling_period = bucket_width
+            samples_per_bucket = 1
+        else:
+            samples_per_bucket = max(1, round(float(bucket_width) / sampling_period))
+            bucket_width = samples_per_bucket * sampling_period
+        history_horizon = max(1, int(history_horizon))
+
+        if bucket_width != PvExcessControl.bucket_width or history_horizon != PvExcessControl.history_horizon:
+            PvExcessControl.bucket_width = bucket_width
+            PvExcessControl.history_horizon = history_horizon
+            capacity = PvExcessControl._history_capacity()
+            log.info(f'Configuring history: {capacity} buckets of {bucket_width}s ({history_horizon} min).')
+            for group in PvExcessControl.groups.values():
+                group.configure_history(capacity, bucket_width)
+            PvExcessControl.on_time_counter = 0
+        PvExcessControl.samples_per_bucket = samples_per_bucket
+
+        if sampling_period != PvExcessControl.sampling_period:
+            log.info(f'Starting scheduler with a period of {sampling_period}s.')
+            PvExcessControl.sampling_period = sampling_period
+            PvExcessControl.scheduler = _scheduler_factory(sampling_period)
+
+        PvExcessControl.sampling_mode = sampling_mode
+
+    @staticmethod
+    def _configure_event_sampling():
+        """
+        Start (or stop) the sensor trigger for event-driven sampling of the power sensors of all controller groups. Groups and the
+        trigger are only re-initialized if their power sensors changed.
+        """
+        if PvExcessControl.sampling_mode != 'event':
+            for group in PvExcessControl.groups.values():
+                group.sensor_values = {}
+            PvExcessControl.sensor_groups = {}
+            PvExcessControl.sensor_trigger = None
+            return
+        sensor_groups = {}
+        for group in PvExcessControl.groups.values():
+            power_entities = [e for e in PvExcessControl._power_entities(group) if e is not None]
+            if power_entities != list(group.sensor_values):
+                log.info(f'{group.log_prefix} Starting event-driven sampling of {power_entities}.')
+                # initialize with the current sensor values, as the sensors might not change for a while
+                now = time.monotonic()
+                group.sensor_values = {e: group.health.filter(e, _get_num_state(e), now, hampel=False) for e in power_entities}
+                PvExcessControl._set_event_sample(group)
+                group.event_sample_time = now
+            for e in power_entities:
+                sensor_groups.setdefault(e, []).append(group)
+        if PvExcessControl.sensor_trigger is None or sorted(sensor_groups) != sorted(PvExcessControl.sensor_groups):
+            PvExcessControl.sensor_trigger = _sensor_trigger_factory(sorted(sensor_groups)) if sensor_groups else None
+        PvExcessControl.sensor_groups = sensor_groups
+
+    @staticmethod
+    def _save_state(force: bool = False):
+        """
+        Save the runtime state (histories, run times, once-only flags, power models) to the state file. Throttled to once per
+        state_save_interval, unless the state is marked dirty.
+        :param force:   Save regardless of the throttling
+        """
+        if not PvExcessControl.state_file:
+            return
+        now = time.time()
+        if not (force or PvExcessControl.state_dirty or now - PvExcessControl.state_saved >= PvExcessControl.state_save_interval):
+            return
+        appliances = {}
+        for a_id, e in PvExcessControl.instances.items():
+            inst = e['instance']
+            appliances[a_id] = {'switched_on_today': inst.switched_on_today,
+                                'daily_run_time': inst.daily_run_time,
+                                'daily_energy': round(inst.daily_energy, 4),
+                                'switched_on_time': inst.switched_on_time.isoformat(),
+                                'switch_interval_counter': inst.switch_interval_counter,
+                                'power_model': inst.power_model.as_dict()}
+        groups = {}
+        for group_id, group in PvExcessControl.groups.items():
+            groups[group_id] = {'export_history': group.export_history.values(),
+                                'pv_history': group.pv_history.values(),
+                                'phase_history': [] if group.phase_history is None else group.phase_history.values()}
+        data = {'version': 2,
+                'saved': now,
+                'date': datetime.date.today().isoformat(),
+                'bucket_width': PvExcessControl.bucket_width,
+                'history_horizon': PvExcessControl.history_horizon,
+                'groups': groups,
+                'appliances': appliances}
+        try:
+            task.executor(_write_json_atomic, PvExcessControl.state_file, data)
+        except Exception as e:
+            log.error(f'Could not save state to {PvExcessControl.state_file}: {e}')
+        PvExcessControl.state_saved = now
+        PvExcessControl.state_dirty = False
+
+    @staticmethod
+    def _record_statistics(series: str, a: float, b: float):
+        """
+        Buffer a sample for the statistics store (see _statistics_write)
+        :param series:  Series name
+        :param a:       Energy in Wh
+        :param b:       Export energy in Wh (controller group) or run time in s (appliance)
+        """
+        if PvExcessControl.statistics_file:
+            PvExcessControl.statistics_rows.append((time.time(), series, round(a, 3), round(b, 3)))
+
+    @staticmethod
+    def _write_statistics(force: bool = False):
+        """
+        Write the buffered samples to the statistics store as one batch. Throttled to once per statistics_write_interval.
+        :param force:   Write regardless of the throttling
+        """
+        if not PvExcessControl.statistics_file:
+            return
+        now = time.time()
+        if not (force or now - PvExcessControl.statistics_written >= PvExcessControl.statistics_write_interval):
+            return
+        retention = {}
+        if now - PvExcessControl.statistics_compacted >= PvExcessControl.statistics_compact_interval:
+            retention = {STATISTICS_TABLES['minute']: now - PvExcessControl.statistics_retention * 86400,
+                         STATISTICS_TABLES['hour']: now - PvExcessControl.statistics_hour_retention * 86400}
+        rows = PvExcessControl.statistics_rows
+        PvExcessControl.statistics_rows = []
+        PvExcessControl.statistics_written = now
+        if not rows and not retention:
+            return
+        try:
+            task.executor(_statistics_write, PvExcessControl.statistics_file, rows, list(STATISTICS_TABLES.values()), retention)
+        except Exception as e:
+            log.error(f'Could not write {len(rows)} samples to statistics store {PvExcessControl.statistics_file}: {e}')
+            return
+        if retention:
+            PvExcessControl.statistics_compacted = now
+
+    @staticmethod
+    def query_statistics(start=None, end=None, resolution: str = 'day', series=None, total: bool = False) -> dict:
+        """
+        Query aggregates from the statistics store (see pv_excess_control_statistics)
+        :param start:       Start of the time range (ISO timestamp or datetime), default depending on the resolution
+        :param end:         End of the time range (ISO timestamp or datetime), default now
+        :param resolution:  Resolution (minute, hour or day)
+        :param series:      Series name or list of series names, None for all series
+        :param total:       Sum up the whole time range instead of returning each period
+        :return:            Response {'resolution', 'start', 'end', 'series': {name: [period] or total}}. Each period / total
+                             contains 'excess_kwh' and 'export_kwh' (controller group) or 'energy_kwh' and 'run_time_h' (appliance)
+                             and 'samples'. Contains 'error' if the query failed.
+        """
+        if not PvExcessControl.statistics_file:
+            return {'error': 'Statistics store not configured'}
+        if resolution not in STATISTICS_TABLES:
+            return {'error': f'Resolution "{resolution}" not supported'}
+        try:
+            end = time.time() if end is None else _timestamp(end)
+            start = end - {'minute': 3600, 'hour': 86400, 'day': 30 * 86400}[resolution] if start is None else _timestamp(start)
+        except (TypeError, ValueError) as e:
+            return {'error': f'Invalid time range: {e}'}
+        if isinstance(series, str):
+            series = [series]
+        # include the buffered samples
+        PvExcessControl._write_statistics(force=True)
+        try:
+            rows = task.executor(_statistics_query, PvExcessControl.statistics_file, STATISTICS_TABLES[resolution], start, end,
+                                 series or [], bool(total))
+        except Exception as e:
+            log.error(f'Could not query statistics store {PvExcessControl.statistics_file}: {e}')
+            return {'error': str(e)}
+        result = {}
+        for name, ts, a, b, n in rows:
+            if name.startswith('group.'):
+                values = {'excess_kwh': round(a / 1000, 3), 'export_kwh': round(b / 1000, 3), 'samples': n}
+            else:
+                values = {'energy_kwh': round(a / 1000, 3), 'run_time_h': round(b / 3600, 3), 'samples': n}
+            if total:
+                result[name] = values
+            else:
+                values['start'] = datetime.datetime.fromtimestamp(ts).isoformat()
+                result.setdefault(name, []).append(values)
+        return {'resolution': resolution, 'start': datetime.datetime.fromtimestamp(start).isoformat(),
+                'end': datetime.datetime.fromtimestamp(end).isoformat(), 'series': result}
+
+    @staticmethod
+    def _load_state():
+        """
+        Load the state file, if the state is recent enough. Histories and appliance states are restored on registration (see
+        _restore_group and _restore_appliance).
+        """
+        PvExcessControl.restored_state = None
+        if not PvExcessControl.state_file:
+            return
+        try:
+            data = task.executor(_read_json, PvExcessControl.state_file)
+        except Exception as e:
+            log.error(f'Could not load state from {PvExcessControl.state_file}: {e}')
+            return
+        if data is None or data.get('version') not in (1, 2):
+            return
+        if data['version'] == 1:
+            # single history of the controller before groups were introduced
+            data['groups'] = {DEFAULT_GROUP: {'export_history': data.pop('export_history'),
+                                              'pv_history': data.pop('pv_history')}}
+        age = time.time() - data['saved']
+        if not 0 <= age <= PvExcessControl.state_max_age:
+            log.info(f'Not restoring state from {PvExcessControl.state_file}: State is {age:.0f}s old.')
+            return
+        PvExcessControl.restored_state = data
+
+    @staticmethod
+    def _restore_group(group: ControllerGroup):
+        """
+        Restore the histories of a new controller group from the loaded state file, if the history configuration is unchanged
+        :param group:   Controller group
+        """
+        data = PvExcessControl.restored_state
+        if data is None or group.group_id not in data['groups']:
+            return
+        if data['bucket_width'] != PvExcessControl.bucket_width or data['history_horizon'] != PvExcessControl.history_horizon:
+            return
+        saved = data['groups'][group.group_id]
+        age = max(0.0, time.time() - data['saved'])
+        # fill the buckets missed during the restart with the last known values
+        missed = min(int(age // PvExcessControl.bucket_width), group.pv_history.capacity)
+        for history, values in ((group.export_history, saved['export_history']), (group.pv_history, saved['pv_history'])):
+            for value in values[-history.capacity:] + values[-1:] * missed:
+                history.append(value)
+        log.info(f'{group.log_prefix} Restored Export/PV history from {PvExcessControl.state_file} ({age:.0f}s old).')
+
+    @staticmethod
+    def _restore_phase_history(group: ControllerGroup):
+        """
+        Restore the per-phase history of a controller group from the loaded state file, if the history configuration and the number
+        of phases are unchanged. Called when the per-phase sensors of the group are configured.
+        :param group:   Controller group
+        """
+        data = PvExcessControl.restored_state
+        if data is None or group.phase_history is None or group.group_id not in data['groups']:
+            return
+        if data['bucket_width'] != PvExcessControl.bucket_width or data['history_horizon'] != PvExcessControl.history_horizon:
+            return
+        values = data['groups'][group.group_id].get('phase_history', [])
+        if not values or len(values[-1]) != group.phase_history.channels:
+            return
+        missed = min(int(max(0.0, time.time() - data['saved']) // PvExcessControl.bucket_width), group.phase_history.capacity)
+        for value in values[-group.phase_history.capacity:] + values[-1:] * missed:
+            group.phase_history.append(value)
+
+    @staticmethod
+    def _restore_appliance(inst):
+        """
+        Restore the runtime state of a newly registered appliance from the loaded state file
+        :param inst:    PVExcesscontrol Class instance
+        """
+        data = PvExcessControl.restored_state
+        if data is None or inst.automation_id not in data['appliances']:
+            return
+        appliance = data['appliances'][inst.automation_id]
+        inst.switch_interval_counter = appliance['switch_interval_counter']
+        inst.switched_on_time = datetime.datetime.fromisoformat(appliance['switched_on_time'])
+        inst.power_model.load(appliance.get('power_model', {}))
+        if data['date'] == datetime.date.today().isoformat():
+            inst.switched_on_today = appliance['switched_on_today']
+            inst.daily_run_time = appliance['daily_run_time']
+            inst.daily_energy = appliance.get('daily_energy', 0)
+        log.info(f'{inst.config.log_prefix} Restored appliance state.')
+
+    @staticmethod
+    def _interval_buckets(inst) -> int:
+        """
+        Convert the appliance switch interval to a number of history buckets (= control passes)
+        :param inst:    PVExcesscontrol Class instance
+        :return:        Number of buckets
+        """
+        return max(1, round(inst.config.appliance_switch_interval * 60 / PvExcessControl.bucket_width))
+
+    @staticmethod
+    def sanity_check(group: ControllerGroup) -> bool:
+        """
+        Check the sensor configuration of a controller group
+        :param group:   Controller group
+        :return:        True if the group can be controlled, False otherwise
+        """
+        if group.import_export_power is not None and group.home_battery_level is not None and group.battery_power is None:
+            log.warning(f'{group.log_prefix} "Import/Export power" has been defined together with "Home Battery", but without '
+                        f'"Battery power". This will lead to always giving the home battery priority over appliances, regardless '
+                        f'of the specified min. battery level.')
+            return True
+        if group.import_export_power is not None and (group.export_power is not None or group.load_power is not None):
+            log.error(f'{group.log_prefix} "Import/Export power" has been defined together with either "Export power" or "Load power". '
+                      f'This is not allowed. Please specify either "Import/Export power" or both "Load power" & "Export Power".')
+            return False
+        if not (group.import_export_power is not None or (group.export_power is not None and group.load_power is not None)):
+            log.error(f'{group.log_prefix} Either "Export power" or "Load power" have not been defined. This is not '
+                      f'allowed. Please specify either "Import/Export power" or both "Load power" & "Export Power".')
+            return False
+        return True
+
+    @staticmethod
+    def switch_on(inst, snapshot: StateSnapshot, actuation: ActuationQueue):
+        """
+        Switches an appliance on, if possible.
+        :param inst:        PVExcesscontrol Class instance
+        :param snapshot:    State snapshot of the current tick
+        :param actuation:   Actuation queue of the current tick
+        """
+        config = inst.config
+        if config.appliance_once_only and inst.switched_on_today:
+            log.debug(f'{config.log_prefix} "Only-Run-Once-Appliance" detected - Appliance was already switched on today - '
+                      f'Not switching on again.')
+        else:
+            def on_success():
+                inst.switched_on_today = True
+                inst.switched_on_time = datetime.datetime.now()
+                if config.appliance_once_only:
+                    # must survive a restart, otherwise the appliance could run twice
+                    PvExcessControl.state_dirty = True
+
+            actuation.add(inst.automation_id, _turn_on, (config.appliance_switch, config.switch_domain), on_success)
+            snapshot.set(config.appliance_switch, 'on')
+            inst.hysteresis.transition(True, time.monotonic())
+
+    @staticmethod
+    def switch_off(inst, snapshot: StateSnapshot, actuation: ActuationQueue) -> float:
+        """
+        Switches an appliance off, if possible.
+        :param inst:        PVExcesscontrol Class instance
+        :param snapshot:    State snapshot of the current tick
+        :param actuation:   Actuation queue of the current tick
+        :return:            Power consumption relief achieved through switching the appliance off (will be 0 if appliance could
+                             not be switched off)
+        """
+        config = inst.config
+        # Check if automation is activated for specific instance
+        if not PvExcessControl.automation_activated(inst.automation_id, snapshot):
+            return 0
+        # Do not turn off only-on-appliances
+        if config.appliance_on_only:
+            log.debug(f'{config.log_prefix} "Only-On-Appliance" detected - Not switching off.')
+            return 0
+        # Do not turn off if switch interval not reached
+        elif inst.switch_interval_counter < PvExcessControl._interval_buckets(inst):
+            log.debug(f'{config.log_prefix} Cannot switch off appliance, because appliance switch interval is not reached '
+                      f'({inst.switch_interval_counter}/{PvExcessControl._interval_buckets(inst)}).')
+            return 0
+        elif inst.hysteresis.held(time.monotonic()):
+            log.debug(f'{config.log_prefix} Cannot switch off appliance, because min. on-time is not reached.')
+            PvExcessControl.diagnostics.record_decision(inst.automation_id, 'suppressed')
+            return 0
+        else:
+            # switch off
+            # get power consumption (learned, otherwise last actual or typical power consumption)
+            if config.dynamic_current_appliance:
+                setpoint = snapshot.get_num(config.appliance_current_set_entity, return_on_error=config.min_current)
+            else:
+                setpoint = config.defined_current
+            power_consumption = inst.power_model.learned(setpoint)
+            if power_consumption is not None:
+                power_consumption = round(power_consumption)
+            elif config.actual_power is None:
+                power_consumption = config.defined_power
+            else:
+                power_consumption = snapshot.get_num(config.actual_power, return_on_error=0)
+            log.debug(f'{config.log_prefix} Current power consumption: {power_consumption} W')
+            # switch off appliance
+            actuation.add(inst.automation_id, _turn_off, (config.appliance_switch, config.switch_domain))
+            snapshot.set(config.appliance_switch, 'off')
+            inst.hysteresis.transition(False, time.monotonic())
+            inst.daily_run_time += (datetime.datetime.now() - inst.switched_on_time).total_seconds()
+            log.info(f'{config.log_prefix} Switched off appliance.')
+            log.info(f'{config.log_prefix} Application has run for {(inst.daily_run_time / 60):.1f} minutes')
+            inst.switch_interval_counter = 0
+            # "restart" history by adding defined power to each history value within the specified time frame
+            PvExcessControl._adjust_pwr_history(inst, power_consumption)
+            inst.phase_index = config.appliance_phase
+            return power_consumption
+
+
+    @staticmethod
+    def automation_activated(a_id, snapshot: StateSnapshot):
+        """
+        Checks if the automation for a specific appliance is activated or not.
+        :param a_id:        Automation ID in Home Assistant
+        :param snapshot:    State snapshot of the current tick
+        :return:            True if automation is activated, False otherwise
+        """
+        automation_state = snapshot.get(a_id)
+        if automation_state == 'off':
+            log.debug(f'Doing nothing, because automation is not activated: State is {automation_state}.')
+            return False
+        elif automation_state is None:
+            # not removed within the control pass, the removal is applied after the pass
+            PvExcessControl.post(PvExcessControl._remove_appliance, a_id)
+            return False
+        return True
+
+
+    @staticmethod
+    def _adjust_pwr_history(inst, value):
+        """
+        "Restart" the history of the appliance switch interval by adding an offset to each history value within this time frame
+        :param inst:    PVExcesscontrol Class instance
+        :param value:   Offset in watts
+        """
+        group = inst.group
+        if PvExcessControl.debug_log:
+            log.debug(f'{group.log_prefix} Adjusting power history by {value}.')
+        group.export_history.add_offset(value, PvExcessControl._interval_buckets(inst))
+        group.pv_history.add_offset(value, PvExcessControl._interval_buckets(inst))
+        group.predictor.add_offset(value)
+        if group.phase_history is not None:
+            n = group.phase_history.channels
+            if inst.config.phases == 1 and inst.phase_index is not None and inst.phase_index < n:
+                offsets = [value if i == inst.phase_index else 0 for i in range(n)]
+            else:
+                offsets = [value / n] * n
+            group.phase_history.add_offset(offsets, PvExcessControl._interval_buckets(inst))
+
+
+    @staticmethod
+    def _publish_diagnostics():
+        """
+        Publish the instrumentation as sensor entities (values of the last control pass, rolling statistics as attributes)
+        """
+        diagnostics = PvExcessControl.diagnostics
+        stats = diagnostics.as_dict()
+        sensors = (('control_pass_ms', diagnostics.control_pass_ms.last, 'ms',
+                    {'control_pass_ms': stats['control_pass_ms'], 'tick_ms': stats['tick_ms'],
+                     'skipped_ticks': stats['skipped_ticks']}),
+                   ('history_update_ms', diagnostics.history_update_ms.last, 'ms', stats['history_update_ms']),
+                   ('state_reads', diagnostics.state_reads.last, None, stats['state_reads']),
+                   ('service_calls', diagnostics.service_calls.last, None, stats['service_calls']))
+        for name, value, unit, attributes in sensors:
+            attributes = dict(attributes)
+            if unit is not None:
+                attributes['unit_of_measurement'] = unit
+            state.set(f'sensor.pv_excess_control_{name}', round(value, 3), new_attributes=attributes)
+        actions = sum(1 for d in stats['decisions'].values() if d['last'] not in ('none', 'suppressed'))
+        state.set('sensor.pv_excess_control_decisions', actions,
+                  new_attributes={a_id: dict(d) for a_id, d in stats['decisions'].items()})
+        state.set('sensor.pv_excess_control_suppressed_actions', sum(d['suppressed'] for d in stats['decisions'].values()),
+                  new_attributes={a_id: d['suppressed'] for a_id, d in stats['decisions'].items()})
+        groups = PvExcessControl.groups
+        if groups:
+            attributes = {g_id: {'quality': round(g.health.quality, 2), 'degraded': g.health.degraded,
+                                 'sensors': {e: round(q, 2) for e, q in g.health.sensor_quality.items()},
+                                 'spikes': {e: f.spikes for e, f in g.health.filters.items()}}
+                          for g_id, g in groups.items()}
+            attributes['unit_of_measurement'] = '%'
+            state.set('sensor.pv_excess_control_sensor_quality', round(min(g.health.quality for g in groups.values()) * 100),
+                      new_attributes=attributes)
+
+    @staticmethod
+    def _update_prediction(group: ControllerGroup, forecast: list):
+        """
+        Predict the change of the excess power of a controller group within the prediction horizon. The trend of the history is
+        combined with the change of the solar power forecast (if available).
+        :param group:       Controller group
+        :param forecast:    Solar power forecast series, see _parse_forecast
+        """
+        minutes = group.prediction_horizon
+        if not minutes:
+            group.predicted_change = 0
+            return
+        change = group.predictor.change(minutes)
+        if forecast:
+            now = time.time()
+            forecast_change = _forecast_power(forecast, now + minutes * 60) - _forecast_power(forecast, now)
+            change = (change + forecast_change) / 2
+        group.predicted_change = min(0, round(change))
+        if PvExcessControl.debug_log:
+            log.debug(f'{group.log_prefix} Predicted change of the excess power within {minutes} min: {change:.0f} W')
+
+    @staticmethod
+    def _update_battery(group: ControllerGroup, snapshot: StateSnapshot, forecast: list = None):
+        """
+        Calculate the power budget of the home battery of a controller group for the current control pass (see BatteryModel)
+        :param group:       Controller group
+        :param snapshot:    State snapshot of the current tick
+        :param forecast:    Solar power forecast series (see _parse_forecast). If available, the remaining forecast is integrated from
+                             the series instead of using the remaining solar production forecast entity.
+        """
+        battery = group.battery
+        if group.home_battery_level is None:
+            battery.reserve = battery.borrow = 0.0
+            return
+
+        level = snapshot.get_num(group.home_battery_level)
+        if level is None:
+            # keep the budget of the last control pass
+            if PvExcessControl.debug_log:
+                log.debug(f'{group.log_prefix} Home battery level not available.')
+            return
+        now = datetime.datetime.now()
+        midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+        if forecast:
+            remaining_forecast = _forecast_energy(forecast, now.timestamp(), midnight.timestamp())
+        elif group.solar_production_forecast is None:
+            remaining_forecast = 0
+        else:
+            remaining_forecast = snapshot.get_num(group.solar_production_forecast, return_on_error=0)
+        battery.update(level, remaining_forecast, group.pv_history.mean(1), (midnight - now).total_seconds() / 3600)
+        if PvExcessControl.debug_log:
+            log.debug(f'{group.log_prefix} Home battery: {level}/{battery.min_level} % | {remaining_forecast=} kWh | '
+                      f'reserve: {battery.reserve:.0f} W | borrow: {battery.borrow:.0f} W')
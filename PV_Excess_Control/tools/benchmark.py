@@ -0,0 +1,269 @@
+"""
+Benchmark of the PV Excess Control hot paths (control pass, history updates, registration) against the fake pyscript objects of
+the replay harness.
+
+Usage:
+    python benchmark.py [--quick] [--save-baseline] [--baseline benchmark_baseline.json] [--compare-latency] [--tolerance 2]
+
+Each scenario registers a number of appliances and runs the scheduler for a number of history buckets with a synthetic, noisy
+solar power. Reported per scenario:
+    - latency percentiles of sampling ticks and of control passes
+    - latency of _update_pv_history, _adjust_pwr_history and of the registration (including the priority re-sort)
+    - peak memory allocated within a control pass
+    - state reads, state writes and service calls per control pass
+
+By default, only the deterministic metrics (state reads, state writes and service calls per control pass) are compared to the
+stored baseline, they must not increase. Latencies depend on the machine (and its load): they are only compared with
+--compare-latency, against a baseline created on the same machine with --save-baseline (with the given tolerance, differences
+below 5us are ignored). The committed baseline only contains the deterministic metrics. Regressions are printed and result in
+exit code 1.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from replay import SERVICE_DEFAULTS, SimClock, load_module
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# (appliances, history horizon in minutes, sampling period in seconds)
+SCENARIOS = [(n, horizon, period) for n in (1, 10, 50, 200) for horizon in (60, 1440) for period in (1, 10)]
+QUICK_SCENARIOS = [(1, 60, 10), (50, 60, 10), (200, 1440, 1)]
+
+# metrics compared with the tolerance (only with --compare-latency) / which must not increase
+LATENCY_METRICS = ('sample_tick_p50_us', 'control_pass_p50_us', 'update_pv_history_us', 'adjust_pwr_history_us',
+                   'register_us')
+COUNT_METRICS = ('state_gets_per_pass', 'state_sets_per_pass', 'service_calls_per_pass')
+
+
+def _percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def _best_of(func, runs: int = 5, repeat: int = 200) -> float:
+    """
+    :param func:    Function to measure, called with the iteration index
+    :param runs:    Number of runs
+    :param repeat:  Calls per run
+    :return:        Mean duration of one call in seconds in the fastest run
+    """
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        for i in range(repeat):
+            func(i)
+        duration = (time.perf_counter() - start) / repeat
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+class Scenario:
+    """
+    Controller with a number of synthetic appliances
+    """
+    def __init__(self, appliances: int, horizon: int, period: int, seed: int = 1):
+        """
+        :param appliances:  Number of registered appliances
+        :param horizon:     History horizon in minutes
+        :param period:      Sampling period in seconds
+        :param seed:        Seed of the synthetic solar power
+        """
+        self.random = random.Random(seed)
+        self.clock = SimClock(1750000000)
+        self.module = load_module(self.clock, 'error')
+        self.state = self.module['state']
+        self.service = self.module['service']
+        self.pv_excess_control = self.module['PvExcessControl']
+        self.pv = 3000.0
+        self.params = []
+        states = self.state.states
+        states.update({'sensor.export_power': '0', 'sensor.pv_power': '0', 'sensor.load_power': '0'})
+        for i in range(appliances):
+            params = dict(SERVICE_DEFAULTS)
+            params.update(automation_id=f'appliance_{i}', appliance_priority=appliances - i,
+                          appliance_switch=f'switch.appliance_{i}', appliance_switch_interval=1 + i % 5,
+                          defined_current=1 + i % 8, history_horizon=horizon, sampling_period=period)
+            if i % 4 == 3:
+                params.update(dynamic_current_appliance=True, appliance_current_set_entity=f'number.appliance_{i}_current')
+                states[params['appliance_current_set_entity']] = str(params['min_current'])
+            states[params['appliance_switch']] = 'off'
+            states[f'automation.appliance_{i}'] = 'on'
+            self.params.append(params)
+        self.register_times = []
+        register = self.service.registered['pv_excess_control']
+        for params in self.params:
+            start = time.perf_counter()
+            register(**params)
+            self.register_times.append(time.perf_counter() - start)
+
+    def update_sensors(self):
+        """
+        Random walk of the solar power, the load includes the running appliances
+        """
+        states = self.state.states
+        self.pv = min(10000.0, max(0.0, self.pv + self.random.gauss(0, 300)))
+        load = 400.0
+        for params in self.params:
+            if states[params['appliance_switch']] == 'on':
+                if params['dynamic_current_appliance']:
+                    load += float(states[params['appliance_current_set_entity']]) * params['grid_voltage']
+                else:
+                    load += params['defined_current'] * params['grid_voltage']
+        states['sensor.pv_power'] = str(round(self.pv))
+        states['sensor.load_power'] = str(round(load))
+        states['sensor.export_power'] = str(round(max(0.0, self.pv - load)))
+
+    def tick(self) -> tuple:
+        """
+        Run one scheduler tick
+        :return:    Tuple (True if the tick was a control pass, duration in seconds, state reads, state writes, service calls)
+        """
+        self.update_sensors()
+        self.clock.now += self.pv_excess_control.sampling_period
+        gets, sets, calls = self.state.gets, self.state.sets, self.service.calls
+        control_pass = self.pv_excess_control.on_time_counter + 1 >= self.pv_excess_control.samples_per_bucket
+        start = time.perf_counter()
+        self.pv_excess_control.on_time()
+        duration = time.perf_counter() - start
+        return (control_pass, duration, self.state.gets - gets, self.state.sets - sets, self.service.calls - calls)
+
+
+def run_scenario(appliances: int, horizon: int, period: int, buckets: int) -> dict:
+    """
+    :param appliances:  Number of registered appliances
+    :param horizon:     History horizon in minutes
+    :param period:      Sampling period in seconds
+    :param buckets:     Number of measured history buckets (= control passes)
+    :return:            Metrics
+    """
+    scenario = Scenario(appliances, horizon, period)
+    pv_excess_control = scenario.pv_excess_control
+    # warm up: fill the history and let the appliances settle
+    for _ in range(10 * pv_excess_control.samples_per_bucket):
+        scenario.tick()
+
+    gc.collect()
+    sample_ticks, control_passes = [], []
+    gets, sets, calls = 0, 0, 0
+    while len(control_passes) < buckets:
+        control_pass, duration, tick_gets, tick_sets, tick_calls = scenario.tick()
+        if control_pass:
+            control_passes.append(duration)
+            gets, sets, calls = gets + tick_gets, sets + tick_sets, calls + tick_calls
+        else:
+            sample_ticks.append(duration)
+
+    # peak memory of a control pass (measured separately, tracemalloc distorts the latencies)
+    peaks = []
+    tracemalloc.start()
+    while len(peaks) < min(buckets, 20):
+        scenario.update_sensors()
+        if pv_excess_control.on_time_counter + 1 >= pv_excess_control.samples_per_bucket:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            pv_excess_control.on_time()
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        else:
+            pv_excess_control.on_time()
+    tracemalloc.stop()
+
+    # single operations
+    snapshot = scenario.module['StateSnapshot']()
+    inst = next(iter(pv_excess_control.instances.values()))['instance']
+    snapshot.collect(pv_excess_control._sensor_entities(inst.group))
+    update_pv_history = _best_of(lambda i: pv_excess_control._update_pv_history(inst.group, snapshot))
+    adjust_pwr_history = _best_of(lambda i: pv_excess_control._adjust_pwr_history(inst, 1 if i % 2 else -1))
+
+    return {'appliances': appliances, 'history_horizon': horizon, 'sampling_period': period,
+            'sample_tick_p50_us': round(_percentile(sample_ticks, 50) * 1e6, 1) if sample_ticks else None,
+            'sample_tick_p99_us': round(_percentile(sample_ticks, 99) * 1e6, 1) if sample_ticks else None,
+            'control_pass_p50_us': round(_percentile(control_passes, 50) * 1e6, 1),
+            'control_pass_p95_us': round(_percentile(control_passes, 95) * 1e6, 1),
+            'control_pass_p99_us': round(_percentile(control_passes, 99) * 1e6, 1),
+            'update_pv_history_us': round(update_pv_history * 1e6, 2),
+            'adjust_pwr_history_us': round(adjust_pwr_history * 1e6, 2),
+            'register_us': round(sum(scenario.register_times) / len(scenario.register_times) * 1e6, 1),
+            'control_pass_peak_kib': round(max(peaks) / 1024, 1),
+            'state_gets_per_pass': round(gets / buckets, 1),
+            'state_sets_per_pass': round(sets / buckets, 1),
+            'service_calls_per_pass': round(calls / buckets, 1)}
+
+
+def _key(result: dict) -> str:
+    return f"{result['appliances']}/{result['history_horizon']}/{result['sampling_period']}"
+
+
+def compare(results: list, baseline: list, tolerance: float, latency: bool = False) -> list:
+    """
+    :param results:     Current results
+    :param baseline:    Baseline results
+    :param tolerance:   Max. allowed ratio of current and baseline latencies
+    :param latency:     True to compare the latencies (baseline of the same machine), otherwise only the call counts
+    :return:            List of regressions (text)
+    """
+    baseline = {_key(b): b for b in baseline}
+    regressions = []
+    for result in results:
+        base = baseline.get(_key(result))
+        if base is None:
+            continue
+        for metric in (LATENCY_METRICS if latency else ()):
+            if result[metric] is not None and base.get(metric) and result[metric] > max(base[metric] * tolerance,
+                                                                                         base[metric] + 5):
+                regressions.append(f'{_key(result)} {metric}: {result[metric]} (baseline {base[metric]})')
+        for metric in COUNT_METRICS:
+            if metric in base and result[metric] > base[metric]:
+                regressions.append(f'{_key(result)} {metric}: {result[metric]} (baseline {base[metric]})')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark PV Excess Control.')
+    parser.add_argument('--quick', action='store_true', help='Run a reduced set of scenarios')
+    parser.add_argument('--buckets', type=int, default=30, help='Measured control passes per scenario')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as new baseline')
+    parser.add_argument('--compare-latency', action='store_true',
+                        help='Also compare the latencies (only meaningful with a baseline created on the same machine)')
+    parser.add_argument('--tolerance', type=float, default=2.0, help='Max. allowed ratio of current and baseline latencies')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    for appliances, horizon, period in (QUICK_SCENARIOS if args.quick else SCENARIOS):
+        result = run_scenario(appliances, horizon, period, args.buckets)
+        results.append(result)
+        if not args.json:
+            print(f"appliances={appliances:>3} horizon={horizon:>4}min period={period:>2}s | "
+                  f"sample tick p50={result['sample_tick_p50_us']}us p99={result['sample_tick_p99_us']}us | "
+                  f"control pass p50={result['control_pass_p50_us']}us p95={result['control_pass_p95_us']}us "
+                  f"p99={result['control_pass_p99_us']}us | peak={result['control_pass_peak_kib']}KiB | "
+                  f"per pass: gets={result['state_gets_per_pass']} sets={result['state_sets_per_pass']} "
+                  f"calls={result['service_calls_per_pass']} | register={result['register_us']}us "
+                  f"update_history={result['update_pv_history_us']}us adjust_history={result['adjust_pwr_history_us']}us")
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Baseline saved to {args.baseline}.')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.compare_latency)
+        if regressions:
+            print('Regressions:')
+            for regression in regressions:
+                print(f'  {regression}')
+            sys.exit(1)
+        print('No regressions.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,653 @@
+"""
+Offline replay of recorded sensor data through the PV Excess Control logic.
+
+The pyscript module is executed with in-memory replacements of the objects injected by pyscript (state, service, log, task and
+the trigger decorators) and a simulated clock, so the control loop runs outside of Home Assistant and faster than real time.
+
+Usage:
+    python replay.py config.json recording.csv [--strategy greedy optimal] [--json]
+
+The recording contains the solar power and the household load *without* the controlled appliances, either as wide CSV
+(first column timestamp, one column per entity) or in the long format exported from the Home Assistant recorder
+(columns entity_id, state, last_changed). Parquet files with the same layout are supported if pandas is installed.
+
+The config (JSON) maps the recorded entities and defines the controller and the appliances:
+    {
+        "pv": "sensor.pv_power",                    recorded solar power in W
+        "base_load": "sensor.house_load",           recorded load without the controlled appliances in W
+        "battery_level": "sensor.battery_level",    optional, recorded home battery level in %
+        "battery": {"capacity": 10, "level": 50,    optional, simulated home battery instead of a recorded level: capacity in kWh,
+                    "max_power": 5000,               initial level in %, max. charging / discharging power in W and round-trip
+                    "efficiency": 0.9},              efficiency. The battery charges from any surplus and covers any deficit
+                                                     (like a hybrid inverter) and updates the home_battery_level and
+                                                     battery_power entities of the controller.
+        "perfect_forecast": true,                   optional, provide the recorded solar power as forecast series ('watts'
+                                                     attribute of the solar_power_forecast entity of the controller)
+        "hourly_prices": [0.25, ...],               optional, grid price per hour of the day (24 values). Provided as Nordpool price
+                                                     series ('raw_today' / 'raw_tomorrow' attributes of the price_sensor entity of
+                                                     the controller) and used for the reported grid cost.
+        "base_load_phases": [0.5, 0.3, 0.2],        optional, share of the base load per phase if the controller has per-phase
+                                                     sensors ("phase_power"). The solar power is split equally. Single-phase
+                                                     appliances run on the phase assigned by the controller.
+        "controller": {...},                        parameters of the pv_excess_control service shared by all appliances
+        "appliances": [{..., "power": 2000}, ...]   parameters per appliance, "power" is the real power consumption in W
+    }                                                (defaults to defined_current * phases * grid_voltage), "power_per_amp" the
+                                                     real power per ampere of dynamic current appliances. If "actual_power"
+                                                     is set, the sensor is updated with the real power consumption.
+"""
+import argparse
+import bisect
+import csv
+import datetime as _datetime
+import json
+import logging
+import os
+import sys
+import time as _time
+import types
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pyscript', 'pv_excess_control.py')
+
+# Default parameters of the pv_excess_control service, see the blueprint
+SERVICE_DEFAULTS = dict(export_power='sensor.export_power', pv_power='sensor.pv_power', load_power='sensor.load_power',
+                        home_battery_level=None, min_home_battery_level=100, dynamic_current_appliance=False,
+                        appliance_phases=1, min_current=6, max_current=16, appliance_switch_interval=5,
+                        appliance_current_set_entity=None, actual_power=None, defined_current=6, appliance_on_only=False,
+                        grid_voltage=230, import_export_power=None, home_battery_capacity=0, solar_production_forecast=None,
+                        appliance_once_only=False, sampling_period=10, history_bucket_width=60, history_horizon=60,
+                        sampling_mode='polling', actuation_settle_delay=0, allocation_strategy='greedy', state_file=None,
+                        solar_power_forecast=None, prediction_horizon=0, diagnostic_sensors=False, group_id='default',
+                        switch_on_margin=0, switch_off_threshold=-10, min_on_time=0, min_off_time=0, current_rate_limit=0,
+                        current_deadband=0.1, phase_power=None, appliance_phase='auto',
+                        price_sensor=None, required_run_time=0, required_energy=0, run_deadline=None, statistics_file=None,
+                        statistics_retention=7, battery_power=None, battery_efficiency=90, battery_discharge_floor=100,
+                        sensor_max_age=0)
+
+
+class SimClock:
+    """
+    Simulated clock. Replaces the time and datetime modules within the replayed module.
+    """
+    def __init__(self, start: float):
+        """
+        :param start:   Start time (unix timestamp)
+        """
+        self.now = start
+        clock = self
+
+        class SimDatetime(_datetime.datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return _datetime.datetime.fromtimestamp(clock.now, tz)
+
+        class SimDate(_datetime.date):
+            @classmethod
+            def today(cls):
+                return _datetime.date.fromtimestamp(clock.now)
+
+        self.time = types.SimpleNamespace(time=lambda: clock.now, monotonic=lambda: clock.now,
+                                          perf_counter=_time.perf_counter, sleep=lambda seconds: None)
+        self.datetime = types.SimpleNamespace(datetime=SimDatetime, date=SimDate, timedelta=_datetime.timedelta,
+                                              time=_datetime.time, timezone=_datetime.timezone)
+
+
+class FakeLog:
+    """
+    Replacement of the pyscript logger. Only messages of at least the given level are printed.
+    """
+    levels = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+    def __init__(self, level: str = 'warning'):
+        self.level = self.levels[level]
+        self.errors = 0
+
+    def _log(self, level: str, msg: str):
+        if self.levels[level] >= self.level:
+            print(f'{level.upper()}: {msg}', file=sys.stderr)
+
+    def debug(self, msg):
+        if self.level <= 10:
+            self._log('debug', msg)
+
+    def info(self, msg):
+        if self.level <= 20:
+            self._log('info', msg)
+
+    def warning(self, msg):
+        self._log('warning', msg)
+
+    def error(self, msg):
+        self.errors += 1
+        self._log('error', msg)
+
+
+class FakeState:
+    """
+    In-memory entity states, replacement of the pyscript state object.
+    """
+    def __init__(self):
+        self.states = {}
+        self.attributes = {}
+        self.gets = 0
+        self.sets = 0
+
+    def get(self, entity_id: str):
+        self.gets += 1
+        try:
+            return self.states[entity_id]
+        except KeyError:
+            raise NameError(f'name {entity_id} is not defined')
+
+    def getattr(self, entity_id: str) -> dict:
+        self.gets += 1
+        if entity_id not in self.states:
+            raise NameError(f'name {entity_id} is not defined')
+        return self.attributes.get(entity_id, {})
+
+    def set(self, entity_id: str, value=None, new_attributes=None, **kwargs):
+        self.sets += 1
+        self.states[entity_id] = value
+        if new_attributes is not None:
+            self.attributes[entity_id] = new_attributes
+
+
+class FakeService:
+    """
+    Replacement of the pyscript service object. Used as decorator while loading the module, service calls change the fake
+    entity states.
+    """
+    def __init__(self, fake_state: FakeState):
+        self.fake_state = fake_state
+        self.registered = {}
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        if args and callable(args[0]):
+            self.registered[args[0].__name__] = args[0]
+            return args[0]
+
+        def decorator(func):
+            self.registered[func.__name__] = func
+            return func
+        return decorator
+
+    def has_service(self, domain: str, name: str) -> bool:
+        return True
+
+    def call(self, domain: str, name: str, entity_id: str = None, value=None, **kwargs):
+        self.calls += 1
+        if name == 'turn_on':
+            self.fake_state.states[entity_id] = 'on'
+        elif name == 'turn_off':
+            self.fake_state.states[entity_id] = 'off'
+        elif name == 'set_value':
+            self.fake_state.states[entity_id] = str(value)
+
+
+class FakeTask:
+    """
+    Replacement of the pyscript task object. Everything is executed synchronously, sleeping takes no time.
+    """
+    def sleep(self, seconds: float):
+        pass
+
+    def create(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+    def wait(self, tasks, **kwargs):
+        return set(), set()
+
+    def executor(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+
+def _trigger(*args, **kwargs):
+    """
+    Replacement of the pyscript trigger decorators. Triggers are driven by the replay loop.
+    """
+    return lambda func: func
+
+
+def load_module(clock: SimClock, log_level: str = 'warning') -> dict:
+    """
+    Execute the pyscript module with fake pyscript objects
+    :param clock:       Simulated clock
+    :param log_level:   Min. level of printed log messages
+    :return:            Module namespace
+    """
+    fake_state = FakeState()
+    namespace = {'__name__': 'pv_excess_control', 'state': fake_state, 'service': FakeService(fake_state),
+                 'log': FakeLog(log_level), 'task': FakeTask(), 'time_trigger': _trigger, 'state_trigger': _trigger,
+                 'event_trigger': _trigger, 'pyscript_compile': lambda func: func}
+    # expensive debug messages are only created if debug logging is enabled for the module logger
+    logging.getLogger('custom_components.pyscript.file.pv_excess_control').setLevel(
+        logging.DEBUG if log_level == 'debug' else logging.WARNING)
+    with open(MODULE_PATH) as f:
+        exec(compile(f.read(), MODULE_PATH, 'exec'), namespace)
+    # replace the modules imported by the pyscript module
+    namespace['time'] = clock.time
+    namespace['datetime'] = clock.datetime
+    return namespace
+
+
+def _parse_timestamp(value: str) -> float:
+    """
+    :param value:   Unix timestamp or ISO 8601 date
+    :return:        Unix timestamp
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return _datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def _parse_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def load_recording(path: str, entity_ids: list) -> dict:
+    """
+    Load recorded sensor data
+    :param path:        CSV or Parquet file, wide (timestamp + one column per entity) or long format (entity_id, state, last_changed)
+    :param entity_ids:  Entities to load
+    :return:            Dict entity_id -> (sorted timestamps, values). Unavailable states are skipped.
+    """
+    if path.endswith('.parquet'):
+        try:
+            import pandas
+        except ImportError:
+            raise SystemExit('Reading Parquet files requires pandas (and pyarrow).')
+        frame = pandas.read_parquet(path)
+        header = [str(c) for c in frame.columns]
+        rows = frame.astype(str).itertuples(index=False, name=None)
+    else:
+        f = open(path, newline='')
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = reader
+
+    series = {e: [] for e in entity_ids}
+    if 'entity_id' in header and 'state' in header:
+        e_col, s_col = header.index('entity_id'), header.index('state')
+        t_col = header.index('last_changed' if 'last_changed' in header else 'last_updated')
+        for row in rows:
+            if row[e_col] in series:
+                value = _parse_number(row[s_col])
+                if value is not None:
+                    series[row[e_col]].append((_parse_timestamp(row[t_col]), value))
+    else:
+        missing = [e for e in entity_ids if e not in header]
+        if missing:
+            raise SystemExit(f'Entities {missing} not found in {path}.')
+        columns = [(e, header.index(e)) for e in entity_ids]
+        for row in rows:
+            t = _parse_timestamp(row[0])
+            for e, col in columns:
+                value = _parse_number(row[col])
+                if value is not None:
+                    series[e].append((t, value))
+
+    result = {}
+    for e, points in series.items():
+        if not points:
+            raise SystemExit(f'No valid values of {e} in {path}.')
+        points.sort()
+        result[e] = ([p[0] for p in points], [p[1] for p in points])
+    return result
+
+
+class Series:
+    """
+    Step-wise (sample and hold) access to a recorded time series with a forward-moving cursor
+    """
+    def __init__(self, times: list, values: list):
+        self.times = times
+        self.values = values
+        self.index = 0
+
+    def at(self, t: float) -> float:
+        times = self.times
+        i = self.index
+        if i + 1 < len(times) and times[i + 1] <= t:
+            # usually the next sample, otherwise skip ahead
+            i = i + 1 if i + 2 >= len(times) or times[i + 2] > t else bisect.bisect_right(times, t) - 1
+            self.index = i
+        return self.values[i]
+
+
+class ApplianceStats:
+    """
+    Replay results of one appliance
+    """
+    def __init__(self):
+        self.switch_ons = 0
+        self.run_time = 0.0
+        self.energy = 0.0
+
+
+class Replay:
+    """
+    Replays a recording through the control loop and accumulates energy flows
+    """
+    def __init__(self, config: dict, recording: dict, strategy: str = None, log_level: str = 'warning'):
+        """
+        :param config:      Replay configuration (see module docstring)
+        :param recording:   Recorded series (see load_recording)
+        :param strategy:    Allocation strategy, overrides the configuration
+        :param log_level:   Min. level of printed log messages
+        """
+        self.config = config
+        self.start = min(times[0] for times, values in recording.values())
+        self.end = max(times[-1] for times, values in recording.values())
+        self.clock = SimClock(self.start)
+        self.module = load_module(self.clock, log_level)
+        self.pv = Series(*recording[config['pv']])
+        self.base_load = Series(*recording[config['base_load']])
+        self.battery_level = Series(*recording[config['battery_level']]) if config.get('battery_level') else None
+        self.battery = config.get('battery')
+        self.battery_soc = float(self.battery.get('level', 50)) if self.battery else None
+        self.recording = recording
+
+        controller = dict(SERVICE_DEFAULTS)
+        controller.update(config.get('controller', {}))
+        if strategy is not None:
+            controller['allocation_strategy'] = strategy
+        self.controller = controller
+        # resolution of the replay. In event-driven sampling mode, the sensors are updated with this resolution as well.
+        self.step = max(1, int(controller['sampling_period']))
+        self.event_mode = controller['sampling_mode'] == 'event'
+
+        states = self.module['state'].states
+        register = self.module['service'].registered['pv_excess_control']
+        pv_excess_control = self.module['PvExcessControl']
+        self.appliances = []
+        # registered instances by appliance switch (the automation IDs are normalized by the registration)
+        self.instances = {}
+        for appliance in config['appliances']:
+            params = dict(controller)
+            params.update({k: v for k, v in appliance.items() if k not in ('power', 'power_per_amp')})
+            states[params['appliance_switch']] = 'off'
+            if params['dynamic_current_appliance']:
+                states[params['appliance_current_set_entity']] = str(params['min_current'])
+            power_per_amp = appliance.get('power_per_amp', params['appliance_phases'] * params['grid_voltage'])
+            power = appliance.get('power', params['defined_current'] * params['appliance_phases'] * params['grid_voltage'])
+            self.appliances.append((params, power, power_per_amp, ApplianceStats()))
+        self._update_sensors(*self._power_flows())
+        for params, power, power_per_amp, stats in self.appliances:
+            register(**params)
+        for automation_id, entry in pv_excess_control.instances.items():
+            states[automation_id] = 'on'
+            self.instances[entry['instance'].config.appliance_switch] = entry['instance']
+
+        self.pv_energy = 0.0
+        self.export_energy = 0.0
+        self.import_energy = 0.0
+        self.load_energy = 0.0
+        self.grid_cost = 0.0
+        self.phase_import_energy = [0.0] * len(self.phase_power)
+        self.battery_charged = 0.0
+        self.battery_discharged = 0.0
+
+    @property
+    def phase_power(self) -> list:
+        phase_power = self.controller['phase_power'] or []
+        return [phase_power] if isinstance(phase_power, str) else phase_power
+
+    def _power_flows(self) -> tuple:
+        """
+        :return:    Tuple (solar power, load power, load power per phase) at the current time, including the controlled
+                     appliances. The load power per phase is None without per-phase sensors.
+        """
+        t = self.clock.now
+        states = self.module['state'].states
+        load = self.base_load.at(t)
+        n = len(self.phase_power)
+        shares = self.config.get('base_load_phases', [1 / n] * n) if n else []
+        phase_load = [load * share for share in shares] if n else None
+        for params, power, power_per_amp, stats in self.appliances:
+            if states[params['appliance_switch']] != 'on':
+                power = 0.0
+            elif params['dynamic_current_appliance']:
+                power = float(states[params['appliance_current_set_entity']]) * power_per_amp
+            load += power
+            if n:
+                inst = self.instances.get(params['appliance_switch'])
+                phase = inst.phase_index if inst is not None and params['appliance_phases'] == 1 else None
+                for i in range(n):
+                    phase_load[i] += (power if i == phase else 0.0) if phase is not None else power / n
+            if params['actual_power']:
+                states[params['actual_power']] = str(round(power))
+        return self.pv.at(t), load, phase_load
+
+    def _battery_power(self, pv: float, load: float) -> float:
+        """
+        :param pv:      Solar power in W
+        :param load:    Load power in W
+        :return:        Charging power (negative while discharging) of the simulated battery in W, 0 without battery
+        """
+        if self.battery is None:
+            return 0.0
+        max_power = self.battery.get('max_power', 5000)
+        power = min(max_power, max(-max_power, pv - load))
+        if (power > 0 and self.battery_soc >= 100) or (power < 0 and self.battery_soc <= 0):
+            return 0.0
+        return power
+
+    def _charge_battery(self, power: float, seconds: float):
+        """
+        Update the level of the simulated battery
+        :param power:   Charging power (negative while discharging) in W
+        :param seconds: Duration in seconds
+        """
+        one_way = self.battery.get('efficiency', 0.9) ** 0.5
+        energy = power * seconds
+        if power > 0:
+            self.battery_charged += energy
+            stored = energy * one_way
+        else:
+            self.battery_discharged -= energy
+            stored = energy / one_way
+        self.battery_soc = min(100.0, max(0.0, self.battery_soc + stored / 3.6e6 / self.battery['capacity'] * 100))
+
+    def _update_sensors(self, pv: float, load: float, phase_load: list = None):
+        """
+        Update the fake power sensors
+        :param pv:          Solar power in W
+        :param load:        Load power in W
+        :param phase_load:  Load power per phase in W (if per-phase sensors are configured)
+        """
+        t = self.clock.now
+        states = self.module['state'].states
+        c = self.controller
+        changed = []
+        battery = self._battery_power(pv, load)
+        values = [(c['pv_power'], pv), (c['load_power'], load), (c['export_power'], max(0.0, pv - load - battery)),
+                  (c['import_export_power'], load - pv + battery), (c['battery_power'], battery)]
+        if self.battery is not None:
+            values.append((c['home_battery_level'], self.battery_soc))
+        elif self.battery_level is not None:
+            values.append((c['home_battery_level'], self.battery_level.at(t)))
+        elif c['home_battery_level']:
+            values.append((c['home_battery_level'], 100))
+        if phase_load is not None:
+            n = len(phase_load)
+            values += [(entity_id, value + (battery - pv) / n) for entity_id, value in zip(self.phase_power, phase_load)]
+        for entity_id, value in values:
+            if entity_id:
+                value = str(round(value))
+                if states.get(entity_id) != value:
+                    states[entity_id] = value
+                    changed.append((entity_id, value))
+        if self.event_mode and self.module['PvExcessControl'].instances:
+            for entity_id, value in changed:
+                self.module['PvExcessControl']._on_sensor_change(entity_id, value)
+
+    def _set_forecast(self, day: _datetime.date):
+        """
+        Provide the recorded solar power of a day as forecast series (15 min averages), if configured
+        :param day: Day of the forecast
+        """
+        entity_id = self.controller['solar_power_forecast']
+        if not self.config.get('perfect_forecast') or not entity_id:
+            return
+        pv = Series(*self.recording[self.config['pv']])
+        start = _datetime.datetime.combine(day, _datetime.time()).timestamp()
+        watts = {}
+        for period_start in range(int(start), int(start) + 86400, 900):
+            power = sum(pv.at(period_start + i * 60) for i in range(15)) / 15
+            watts[_datetime.datetime.fromtimestamp(period_start + 450).isoformat()] = round(power)
+        self.module['state'].set(entity_id, round(sum(watts.values()) / 4000, 2), new_attributes={'watts': watts})
+
+    def _set_prices(self, day: _datetime.date):
+        """
+        Provide the configured hourly prices of a day and the next day as Nordpool price series, if configured
+        :param day: Day of the prices
+        """
+        entity_id = self.controller['price_sensor']
+        prices = self.config.get('hourly_prices')
+        if not prices or not entity_id:
+            return
+        attributes = {}
+        for key, offset in (('raw_today', 0), ('raw_tomorrow', 1)):
+            start = _datetime.datetime.combine(day + _datetime.timedelta(days=offset), _datetime.time())
+            attributes[key] = [{'start': (start + _datetime.timedelta(hours=h)).isoformat(),
+                                'end': (start + _datetime.timedelta(hours=h + 1)).isoformat(),
+                                'value': prices[h]} for h in range(24)]
+        self.module['state'].set(entity_id, prices[_datetime.datetime.fromtimestamp(self.clock.now).hour],
+                                 new_attributes=attributes)
+
+    def run(self) -> dict:
+        """
+        Run the replay
+        :return:    Report (see report)
+        """
+        states = self.module['state'].states
+        on_time = self.module['PvExcessControl'].on_time
+        reset_midnight = self.module['reset_midnight']
+        step = self.step
+        # period of the scheduler of the controller
+        tick_period = self.module['PvExcessControl'].sampling_period
+        next_tick = self.start + tick_period
+        day = _datetime.date.fromtimestamp(self.start)
+        self._set_forecast(day)
+        self._set_prices(day)
+        prices = self.config.get('hourly_prices')
+        wall_start = _time.perf_counter()
+        was_on = [False] * len(self.appliances)
+
+        t = self.start
+        while t <= self.end:
+            self.clock.now = t
+            if _datetime.date.fromtimestamp(t) != day:
+                day = _datetime.date.fromtimestamp(t)
+                reset_midnight()
+                self._set_forecast(day)
+                self._set_prices(day)
+            self._update_sensors(*self._power_flows())
+            if t >= next_tick:
+                on_time()
+                next_tick += tick_period
+            # the power flows (after the actions of this tick) are constant until the next tick
+            pv, load, phase_load = self._power_flows()
+            battery = self._battery_power(pv, load)
+            if battery:
+                self._charge_battery(battery, step)
+            self.pv_energy += pv * step
+            self.load_energy += load * step
+            self.export_energy += max(0.0, pv - load - battery) * step
+            self.import_energy += max(0.0, load - pv + battery) * step
+            if prices:
+                self.grid_cost += max(0.0, load - pv + battery) * step * prices[_datetime.datetime.fromtimestamp(t).hour]
+            if phase_load is not None:
+                for i, value in enumerate(phase_load):
+                    self.phase_import_energy[i] += max(0.0, value + (battery - pv) / len(phase_load)) * step
+            for i, (params, power, power_per_amp, stats) in enumerate(self.appliances):
+                is_on = states[params['appliance_switch']] == 'on'
+                if is_on:
+                    if not was_on[i]:
+                        stats.switch_ons += 1
+                    if params['dynamic_current_appliance']:
+                        power = float(states[params['appliance_current_set_entity']]) * power_per_amp
+                    stats.run_time += step
+                    stats.energy += power * step
+                was_on[i] = is_on
+            t += step
+        return self.report(_time.perf_counter() - wall_start)
+
+    def report(self, wall_time: float) -> dict:
+        """
+        :param wall_time:   Real duration of the replay in seconds
+        :return:            Energies in kWh, run times in hours
+        """
+        pv_kwh = self.pv_energy / 3.6e6
+        export_kwh = self.export_energy / 3.6e6
+        return {'strategy': self.controller['allocation_strategy'],
+                'simulated_hours': round((self.end - self.start) / 3600, 2),
+                'wall_time_s': round(wall_time, 2),
+                'pv_kwh': round(pv_kwh, 3),
+                'load_kwh': round(self.load_energy / 3.6e6, 3),
+                'export_kwh': round(export_kwh, 3),
+                'grid_import_kwh': round(self.import_energy / 3.6e6, 3),
+                'grid_cost': round(self.grid_cost / 3.6e6, 2) if self.config.get('hourly_prices') else None,
+                'phase_import_kwh': [round(e / 3.6e6, 3) for e in self.phase_import_energy],
+                'battery': {'charged_kwh': round(self.battery_charged / 3.6e6, 3),
+                            'discharged_kwh': round(self.battery_discharged / 3.6e6, 3),
+                            'level': round(self.battery_soc, 1)} if self.battery else None,
+                'self_consumption': round(1 - export_kwh / pv_kwh, 4) if pv_kwh else None,
+                'switch_ons': sum(stats.switch_ons for params, power, ppa, stats in self.appliances),
+                'service_calls': self.module['service'].calls,
+                'suppressed_actions': sum(d['suppressed'] for d in
+                                          self.module['PvExcessControl'].diagnostics.decisions.values()),
+                'errors': self.module['log'].errors,
+                'appliances': {params['automation_id']: {'switch_ons': stats.switch_ons,
+                                                         'run_time_h': round(stats.run_time / 3600, 2),
+                                                         'energy_kwh': round(stats.energy / 3.6e6, 3)}
+                               for params, power, ppa, stats in self.appliances}}
+
+
+def _print_report(report: dict):
+    print(f"--- strategy: {report['strategy']} ---")
+    print(f"simulated {report['simulated_hours']} h in {report['wall_time_s']} s")
+    print(f"PV: {report['pv_kwh']} kWh | load: {report['load_kwh']} kWh | export: {report['export_kwh']} kWh | "
+          f"grid import: {report['grid_import_kwh']} kWh")
+    if report['grid_cost'] is not None:
+        print(f"grid cost: {report['grid_cost']}")
+    if report['phase_import_kwh']:
+        print(f"grid import per phase: {' | '.join(f'{e} kWh' for e in report['phase_import_kwh'])}")
+    if report['battery'] is not None:
+        print(f"battery: charged {report['battery']['charged_kwh']} kWh | discharged {report['battery']['discharged_kwh']} kWh | "
+              f"level at the end {report['battery']['level']} %")
+    if report['self_consumption'] is not None:
+        print(f"self-consumption: {report['self_consumption'] * 100:.1f} %")
+    print(f"switch-ons: {report['switch_ons']} | service calls: {report['service_calls']} | "
+          f"suppressed actions: {report['suppressed_actions']} | errors: {report['errors']}")
+    for automation_id, stats in report['appliances'].items():
+        print(f"  {automation_id}: {stats['switch_ons']} switch-ons, {stats['run_time_h']} h, {stats['energy_kwh']} kWh")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded sensor data through PV Excess Control.')
+    parser.add_argument('config', help='Replay configuration (JSON)')
+    parser.add_argument('recording', help='Recorded sensor data (CSV or Parquet)')
+    parser.add_argument('--strategy', nargs='+', default=[None], help='Allocation strategies to compare')
+    parser.add_argument('--log-level', default='warning', choices=FakeLog.levels.keys())
+    parser.add_argument('--json', action='store_true', help='Print the reports as JSON')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    entity_ids = [config['pv'], config['base_load']] + ([config['battery_level']] if config.get('battery_level') else [])
+    recording = load_recording(args.recording, entity_ids)
+    reports = [Replay(config, recording, strategy, args.log_level).run() for strategy in args.strategy]
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            _print_report(report)
+
+
+if __name__ == '__main__':
+    main()